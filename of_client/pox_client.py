@@ -29,6 +29,7 @@
 ################################################################################
 
 import threading
+from contextlib import contextmanager
 
 import pox.openflow.libopenflow_01 as of
 import pox.openflow.nicira as nx
@@ -52,6 +53,14 @@ ARP_TYPE = 0x806
 # updating in both places eventually.
 CUSTOM_NEXT_TABLE_PORT = 0xfff4
 
+# Flow mods of install batches are written to a switch once this many bytes
+# are buffered, or this long after the first was buffered. The interval is
+# only checked as messages are buffered, not on a timer: whatever is left is
+# written at the next barrier or at the end of the batch, which the backend
+# handles in one go, so no message waits on later input.
+FLUSH_BYTES = 64 * 1024
+FLUSH_INTERVAL_SEC = 0.05
+
 def inport_value_hack(outport):
     if outport > 1:
         return 1
@@ -59,7 +68,41 @@ def inport_value_hack(outport):
         return 2
 
 
-class BackendChannel(asynchat.async_chat):
+class FlowModBuffer(object):
+    """Packs the OpenFlow messages sent to a switch and writes them to its
+    connection together, once enough bytes are buffered or the first of
+    them has waited long enough (checked when a message is buffered), and
+    whenever flush is called.
+    """
+    def __init__(self, connection, flush_bytes, flush_interval):
+        self.connection = connection
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.data = []
+        self.size = 0
+        self.first_time = None
+
+    def send(self, msg):
+        data = msg.pack()
+        self.data.append(data)
+        self.size += len(data)
+        now = time.time()
+        if self.first_time is None:
+            self.first_time = now
+        if (self.size >= self.flush_bytes or
+            now - self.first_time >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        if self.data:
+            data = ''.join(self.data)
+            self.data = []
+            self.size = 0
+            self.first_time = None
+            self.connection.send(data)
+
+
+class BackendChannel(MessageChannel, asynchat.async_chat):
     """Sends messages to the server and receives responses.
     """
     def __init__(self, host, port, of_client):
@@ -77,6 +120,8 @@ class BackendChannel(asynchat.async_chat):
         self.interval = 0
         self.total_interval = 0
         self.num_intervals  = 0
+        # offer the protocols we support beyond JSON
+        self.push(serialize(['hello', PROTOCOLS]))
         return
 
     def handle_connect(self):
@@ -105,10 +150,24 @@ class BackendChannel(asynchat.async_chat):
     def found_terminator(self):
         """The end of a command or message has been seen."""
         with self.of_client.channel_lock:
-            msg = deserialize(self.received_data)
+            msg = self.read_message()
+        if msg is not NO_MESSAGE:
+            self.handle_message(msg)
+
+    def handle_message(self, msg):
+        if msg[0] == 'batch':
+            for m in msg[1]:
+                self.handle_message(m)
+        elif msg[0] == 'hello':
+            # the frontend picked a protocol: frames follow its reply
+            if msg[1] == FRAMED_PROTOCOL:
+                self.start_framed_input()
+                with self.of_client.channel_lock:
+                    self.push(serialize(['hello', FRAMED_PROTOCOL]))
+                    self.framed_out = True
 
         # Set up time for starting rule installs.
-        if msg[0] == 'reset_install_time':
+        elif msg[0] == 'reset_install_time':
             self.start_time = time.time()
             # TODO(): need logging levels in of client also!
             # print "[path_queries] Last rule interval:", self.interval,
@@ -126,6 +185,11 @@ class BackendChannel(asynchat.async_chat):
         elif msg[0] == 'packet':
             packet = self.dict2OF(msg[1])
             self.of_client.send_to_switch(packet)
+        elif msg[0] == 'install_batch':
+            switch = msg[1]
+            with self.of_client.bulk_send(switch):
+                for m in msg[2]:
+                    self.handle_message(m)
         elif msg[0] == 'install' or msg[0] == 'modify':
             pred = self.dict2OF(msg[1])
             priority = int(msg[2])
@@ -148,7 +212,8 @@ class BackendChannel(asynchat.async_chat):
             self.of_client.clear(switch, table_id)
         elif msg[0] == 'barrier':
             switch = msg[1]
-            self.of_client.barrier(switch)
+            xid = msg[2] if len(msg) > 2 else None
+            self.of_client.barrier(switch, xid)
         elif msg[0] == 'flow_stats_request':
             switch = msg[1]
             self.of_client.flow_stats_request(switch)
@@ -158,7 +223,8 @@ class BackendChannel(asynchat.async_chat):
 
 class POXClient(revent.EventMixin):
     # NOT **kwargs
-    def __init__(self,show_traces=False,debug_packet_in=False,ip='127.0.0.1',port=BACKEND_PORT,use_nx=False,pipeline=None):
+    def __init__(self,show_traces=False,debug_packet_in=False,ip='127.0.0.1',port=BACKEND_PORT,use_nx=False,pipeline=None,
+                 flush_bytes=FLUSH_BYTES,flush_interval=FLUSH_INTERVAL_SEC):
         self.switches = {}
         self.show_traces = show_traces
         self.debug_packet_in = debug_packet_in
@@ -171,6 +237,10 @@ class POXClient(revent.EventMixin):
         self.packetno = 0
         self.channel_lock = threading.Lock()
         self.send_time = 0.0
+        self.barrier_xids = set() # (switch, xid) of barriers to reply to
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.buffers = {} # switch -> FlowModBuffer of its install batch
 
         if core.hasComponent("openflow"):
             self.listenTo(core.openflow)
@@ -279,10 +349,9 @@ class POXClient(revent.EventMixin):
 
 
     def send_to_pyretic(self,msg):
-        serialized_msg = serialize(msg)
         try:
             with self.channel_lock:
-                self.backend_channel.push(serialized_msg)
+                self.backend_channel.push(self.backend_channel.encode(msg))
         except IndexError as e:
             print "ERROR PUSHING MESSAGE %s" % msg
             pass
@@ -766,12 +835,44 @@ class POXClient(revent.EventMixin):
                                   cookie=cookie,
                                   actions=of_actions)
         try:
-            self.switches[switch]['connection'].send(msg)
+            self.send_to_connection(switch, msg)
         except RuntimeError, e:
             print "WARNING:install_flow: %s to switch %d" % (str(e),switch)
         except KeyError, e:
             print "WARNING:install_flow: No connection to switch %d available" % switch
 
+    def send_to_connection(self,switch,msg):
+        """ Send an OpenFlow message to a switch, through the buffer of its
+        install batch if there is one. """
+        buf = self.buffers.get(switch)
+        if buf is None:
+            self.switches[switch]['connection'].send(msg)
+        else:
+            buf.send(msg)
+
+    @contextmanager
+    def bulk_send(self,switch):
+        """ Buffer the OpenFlow messages sent to switch within the block, and
+        write them in a few large writes. """
+        try:
+            connection = self.switches[switch]['connection']
+        except KeyError:
+            connection = None
+        if connection is None or switch in self.buffers:
+            yield
+            return
+        buf = self.buffers[switch] = FlowModBuffer(connection,
+                                                   self.flush_bytes,
+                                                   self.flush_interval)
+        try:
+            yield
+        finally:
+            del self.buffers[switch]
+            try:
+                buf.flush()
+            except RuntimeError, e:
+                print "WARNING:bulk_send: %s to switch %d" % (str(e),switch)
+
     def install_flow(self,pred,priority,action_list,cookie,notify,table_id):
         self.flow_mod_action(pred,priority,action_list,cookie,of.OFPFC_ADD,notify,table_id)
 
@@ -789,20 +890,36 @@ class POXClient(revent.EventMixin):
                               priority=priority,
                               match=match)
         try:
-            self.switches[switch]['connection'].send(msg)
+            self.send_to_connection(switch, msg)
         except RuntimeError, e:
             print "WARNING:delete_flow: %s to switch %d" % (str(e),switch)
         except KeyError, e:
             print "WARNING:delete_flow: No connection to switch %d available" % switch
 
-    def barrier(self,switch):
-        b = of.ofp_barrier_request()
+    def barrier(self,switch,xid=None):
+        if xid is None:
+            b = of.ofp_barrier_request()
+        else:
+            b = of.ofp_barrier_request(xid=xid)
+            self.barrier_xids.add((switch, xid))
         try:
-            self.switches[switch]['connection'].send(b)
+            self.send_to_connection(switch, b)
+            # the switch can't reply before it has the barrier
+            buf = self.buffers.get(switch)
+            if buf is not None:
+                buf.flush()
         except KeyError, e:
+            self.barrier_xids.discard((switch, xid))
             print "WARNING: couldn't send barrier to switch %s (%s)" % (
                 str(switch), e)
 
+    def _handle_BarrierIn(self, event):
+        # only the barriers pyretic asked a reply for
+        key = (event.dpid, event.xid)
+        if key in self.barrier_xids:
+            self.barrier_xids.remove(key)
+            self.send_to_pyretic(['barrier_reply', event.dpid, event.xid])
+
     def flow_stats_request(self,switch):
         sr = of.ofp_stats_request()
         sr.body = of.ofp_flow_stats_request()
@@ -825,7 +942,7 @@ class POXClient(revent.EventMixin):
                 d = nx.nx_flow_mod(command = of.OFPFC_DELETE, table_id=table_id)
             else:
                 d = of.ofp_flow_mod(command = of.OFPFC_DELETE)
-            self.switches[switch]['connection'].send(d) 
+            self.send_to_connection(switch, d)
 
     def __nx_switch_pipeline_init(self, dpid, p):
         """ Initialize switch `dpid` according to the input pipeline
@@ -964,6 +1081,11 @@ class POXClient(revent.EventMixin):
             flow_stat_dict['byte_count'] = flow_stat.byte_count
             match = self.of_match_to_dict(flow_stat.match)
             flow_stat_dict['match'] = match
+            for (field, (ip, prefixlen)) in [
+                    ('srcip', flow_stat.match.get_nw_src()),
+                    ('dstip', flow_stat.match.get_nw_dst())]:
+                if not ip is None:
+                    flow_stat_dict[field + '_prefixlen'] = prefixlen
             actions = self.of_actions_to_dicts(flow_stat.actions)
             flow_stat_dict['actions'] = actions
             return flow_stat_dict
@@ -1153,13 +1275,15 @@ class POXClient(revent.EventMixin):
         self.send_to_pyretic(['packet',received,cookie])
         
        
-def launch(use_nx=False, pipeline=None):
+def launch(use_nx=False, pipeline=None, flush_bytes=FLUSH_BYTES,
+           flush_interval=FLUSH_INTERVAL_SEC):
 
     class asyncore_loop(threading.Thread):
         def run(self):
             asyncore.loop()
 
-    POXClient(use_nx=use_nx,pipeline=pipeline)
+    POXClient(use_nx=use_nx,pipeline=pipeline,flush_bytes=int(flush_bytes),
+              flush_interval=float(flush_interval))
     al = asyncore_loop()
     al.start()
 
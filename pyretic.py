@@ -30,6 +30,7 @@
 
 from pyretic.core.runtime import Runtime
 from pyretic.backend.backend import Backend
+from pyretic.core.netkat import netkat_backend, NETKAT_WORKERS
 import sys
 import threading
 import signal
@@ -95,8 +96,8 @@ def parseArgs():
     op.add_option( '--frontend-only', '-f', action="store_true", 
                      dest="frontend_only", help = 'only start the frontend'  )
     op.add_option( '--mode', '-m', type='choice',
-                     choices=['interpreted','i','reactive0','r0','proactive0','p0','proactive1','p1'], 
-                     help = '|'.join( ['interpreted/i','reactive0/r0','proactiveN/pN for N={0,1}'] )  )
+                     choices=['interpreted','i','reactive0','r0','reactive1','r1','proactive0','p0','proactive1','p1','proactive2','p2','proactive3','p3'], 
+                     help = '|'.join( ['interpreted/i','reactiveN/rN for N={0,1}','proactiveN/pN for N={0,1,2,3}'] )  )
     op.add_option( '--nx', action="store_true",
                    dest="nx", help="use nicira extensions in pox" )
     op.add_option( '--pipeline', dest="pipeline",
@@ -151,9 +152,32 @@ def parseArgs():
     op.add_option('--write_log', dest="write_log",
                   help = ("Location of the runtime's write log for post-run"
                           "debugging"))
+    op.add_option('--use_fdd_compiler', action="store_true",
+                  dest = 'use_fdd_compiler',
+                  help = ("Use the native compiler through forwarding decision"
+                          " diagrams (implies --use_pyretic)"))
+    op.add_option('--eval_engine', type='choice',
+                  choices=['interpreter', 'compiled'], dest='eval_engine',
+                  help = ("How the controller evaluates packets in interpreted"
+                          " and reactive modes: walk the policy, or use a"
+                          " decision tree built from the compiled policy"))
     op.add_option('--use_fdd', action="store_true",
                   dest = 'use_fdd',
                   help = "Use FDD for predicate decomposition")
+    op.add_option('--event_loop', action="store_true",
+                  dest = 'event_loop',
+                  help = ("Handle OpenFlow events and packet-ins on event"
+                          " loops, and recompile policies in the background,"
+                          " so that recompiles don't hold up other events"))
+    op.add_option('--netkat_cache_dir', dest='netkat_cache_dir',
+                  help = ("Also keep NetKAT compiler outputs in this"
+                          " directory, reusing them across restarts"))
+    op.add_option('--netkat_workers', type='int', dest='netkat_workers',
+                  help = ("Number of policies sent to the NetKAT compile"
+                          " server at once, e.g. by path query compilation"))
+    op.add_option('--packet_in_rate', type='float', dest='packet_in_rate',
+                  help = ("Packet-ins per second admitted from each switch,"
+                          " the others being dropped (no limit by default)"))
     op.set_defaults(frontend_only=False, mode='proactive0', enable_profile=False,
                     disjoint_enabled=False, default_enabled=False,
                     integrate_enabled=False, multitable_enabled=False,
@@ -162,6 +186,9 @@ def parseArgs():
                     edge_contraction_enabled=False,
                     preddecomp_enabled=False,
                     nx=False, use_pyretic=False, use_fdd=False,
+                    use_fdd_compiler=False, eval_engine='interpreter',
+                    event_loop=False, netkat_cache_dir=None,
+                    netkat_workers=NETKAT_WORKERS, packet_in_rate=None,
                     write_log="rt_log.txt")
 
     options, args = op.parse_args()
@@ -176,10 +203,19 @@ def main():
         options.mode = 'interpreted'
     elif options.mode == 'r0':
         options.mode = 'reactive0'
+    elif options.mode == 'r1':
+        options.mode = 'reactive1'
     elif options.mode == 'p0':
         options.mode = 'proactive0'
     elif options.mode == 'p1':
         options.mode = 'proactive1'
+    elif options.mode == 'p2':
+        options.mode = 'proactive2'
+    elif options.mode == 'p3':
+        options.mode = 'proactive3'
+    if options.mode == 'proactive3' and options.nx:
+        print 'proactive3 (consistent updates) needs single-stage tables'
+        sys.exit(1)
     try:
         module_name = args[0]
     except IndexError:
@@ -249,7 +285,8 @@ def main():
         Stat.start(options.eval_result_path)
 
     """ Start the frenetic compiler-server """
-    if not options.use_pyretic and options.mode == 'proactive0':
+    if (not (options.use_pyretic or options.use_fdd_compiler) and
+        options.mode == 'proactive0'):
         netkat_cmd = "bash start-frenetic.sh"
         try:
             output = subprocess.Popen(netkat_cmd, shell=True,
@@ -259,6 +296,9 @@ def main():
             print e
             sys.exit(1)
 
+    netkat_backend.cache.directory = options.netkat_cache_dir
+    netkat_backend.workers.workers = options.netkat_workers
+
     """ Start the runtime. """
     opt_flags_arg = (options.disjoint_enabled, options.default_enabled,
                      options.integrate_enabled, options.multitable_enabled,
@@ -272,7 +312,11 @@ def main():
                       pipeline=options.pipeline,
                       use_pyretic=options.use_pyretic,
                       use_fdd=options.use_fdd,
-                      write_log=options.write_log)
+                      write_log=options.write_log,
+                      eval_engine=options.eval_engine,
+                      use_fdd_compiler=options.use_fdd_compiler,
+                      event_loop=options.event_loop,
+                      packet_in_rate=options.packet_in_rate)
 
     """ Start pox backend. """
     if not options.frontend_only:
@@ -28,6 +28,7 @@
 ################################################################################
 
 import threading
+from contextlib import contextmanager
 from pyretic.backend.comm import *
 
 class BackendServer(asyncore.dispatcher):
@@ -59,7 +60,7 @@ class BackendServer(asyncore.dispatcher):
         self.close()
 
 
-class BackendChannel(asynchat.async_chat):
+class BackendChannel(MessageChannel, asynchat.async_chat):
     """Handles echoing messages from a single backend.
     """
     def __init__(self, backend, sock):
@@ -81,38 +82,63 @@ class BackendChannel(asynchat.async_chat):
     def found_terminator(self):
         """The end of a command or message has been seen."""
         with self.backend.channel_lock:
-            msg = deserialize(self.received_data)
+            msg = self.read_message()
+        if msg is not NO_MESSAGE:
+            self.handle_message(msg)
 
+    def handle_message(self, msg):
         # USE DESERIALIZED MSG
         if msg is None or len(msg) == 0:
             print "ERROR: empty message"
+        elif msg[0] == 'batch':
+            for m in msg[1]:
+                self.handle_message(m)
+        elif msg[0] == 'hello':
+            if self.framed_out:
+                # the client acknowledges the protocol
+                self.start_framed_input()
+            elif FRAMED_PROTOCOL in msg[1]:
+                with self.backend.channel_lock:
+                    self.push(serialize(['hello', FRAMED_PROTOCOL]))
+                    self.framed_out = True
         elif msg[0] == 'switch':
             if msg[1] == 'join':
                 if msg[3] == 'BEGIN':
-                    self.backend.runtime.handle_switch_join(msg[2])
+                    self.backend.dispatch(
+                        self.backend.runtime.handle_switch_join, msg[2])
             elif msg[1] == 'part':
-                self.backend.runtime.handle_switch_part(msg[2])
+                self.backend.dispatch(
+                    self.backend.runtime.handle_switch_part, msg[2])
             else:
                 print "ERROR: Bad switch event"
         elif msg[0] == 'port':
             if msg[1] == 'join':
-                self.backend.runtime.handle_port_join(msg[2],msg[3],msg[4],msg[5],msg[6])
+                self.backend.dispatch(self.backend.runtime.handle_port_join,
+                                      msg[2],msg[3],msg[4],msg[5],msg[6])
             elif msg[1] == 'mod':
-                self.backend.runtime.handle_port_mod(msg[2],msg[3],msg[4],msg[5],msg[6])
+                self.backend.dispatch(self.backend.runtime.handle_port_mod,
+                                      msg[2],msg[3],msg[4],msg[5],msg[6])
             elif msg[1] == 'part':
-                self.backend.runtime.handle_port_part(msg[2],msg[3])
+                self.backend.dispatch(self.backend.runtime.handle_port_part,
+                                      msg[2],msg[3])
             else:
                 print "ERROR: Bad port event"
         elif msg[0] == 'link':
-            self.backend.runtime.handle_link_update(msg[1],msg[2],msg[3],msg[4])
+            self.backend.dispatch(self.backend.runtime.handle_link_update,
+                                  msg[1],msg[2],msg[3],msg[4])
         elif msg[0] == 'packet':
             packet = msg[1]
             cookie = msg[2]
-            self.backend.runtime.handle_packet_in(packet, cookie)
+            self.backend.runtime.admit_packet_in(packet, cookie)
+        elif msg[0] == 'barrier_reply':
+            # thread-safe, and never waits behind other events
+            self.backend.runtime.handle_barrier_reply(msg[1],msg[2])
         elif msg[0] == 'flow_stats_reply':
-            self.backend.runtime.handle_flow_stats_reply(msg[1],msg[2])
+            self.backend.dispatch(self.backend.runtime.handle_flow_stats_reply,
+                                  msg[1],msg[2])
         elif msg[0] == 'flow_removed':
-            self.backend.runtime.handle_flow_removed(msg[1], msg[2])
+            self.backend.dispatch(self.backend.runtime.handle_flow_removed,
+                                  msg[1], msg[2])
         else:
             print 'ERROR: Unknown msg from backend %s' % msg
         return
@@ -127,7 +153,9 @@ class Backend(object):
     def __init__(self):
         self.backend_channel = None
         self.runtime = None
+        self.event_loop = None # runs the runtime's handlers, if set
         self.channel_lock = threading.Lock()
+        self.batches = threading.local()
 
         address = ('localhost', BACKEND_PORT) # USE KNOWN PORT
         self.backend_server = BackendServer(self,address)
@@ -136,6 +164,14 @@ class Backend(object):
         self.al.daemon = True
         self.al.start()
 
+    def dispatch(self, handler, *args):
+        """ Run a runtime handler for a message from the OF client: on the
+        runtime's event loop if it has one, and right away otherwise. """
+        if self.event_loop is None:
+            handler(*args)
+        else:
+            self.event_loop.call_soon(handler, *args)
+
     def send_reset_install_time(self):
         self.send_to_OF_client(['reset_install_time'])
 
@@ -157,14 +193,60 @@ class Backend(object):
     def send_flow_stats_request(self,switch):
         self.send_to_OF_client(['flow_stats_request',switch])
 
-    def send_barrier(self,switch):
-        self.send_to_OF_client(['barrier',switch])
+    def send_barrier(self,switch,xid=None):
+        if xid is None:
+            self.send_to_OF_client(['barrier',switch])
+        else:
+            # the OF client replies with ['barrier_reply',switch,xid]
+            self.send_to_OF_client(['barrier',switch,xid])
 
     def inject_discovery_packet(self,dpid, port):
         self.send_to_OF_client(['inject_discovery_packet',dpid,port])
 
+    @contextmanager
+    def batch(self):
+        """ Send the messages sent by this thread within the block together,
+        as batch messages if the OF client supports them. """
+        if getattr(self.batches, 'msgs', None) is not None:
+            yield # already batching
+            return
+        self.batches.msgs = []
+        try:
+            yield
+        finally:
+            msgs = self.batches.msgs
+            self.batches.msgs = None
+            with self.channel_lock:
+                if msgs and not self.backend_channel is None:
+                    self.backend_channel.push(
+                        self.backend_channel.encode_batch(msgs))
+
+    @contextmanager
+    def install_batch(self, switch):
+        """ Send the flow table messages for switch sent by this thread within
+        the block as one install_batch message, whose flow mods the OF client
+        writes to the switch in bulk. """
+        if getattr(self.batches, 'switch_msgs', None) is not None:
+            yield # already batching
+            return
+        self.batches.switch_msgs = []
+        try:
+            yield
+        finally:
+            msgs = self.batches.switch_msgs
+            self.batches.switch_msgs = None
+            if msgs:
+                self.send_to_OF_client(['install_batch', switch, msgs])
+
     def send_to_OF_client(self,msg):
-        serialized_msg = serialize(msg)
+        switch_msgs = getattr(self.batches, 'switch_msgs', None)
+        if switch_msgs is not None:
+            switch_msgs.append(msg)
+            return
+        msgs = getattr(self.batches, 'msgs', None)
+        if msgs is not None:
+            msgs.append(msg)
+            return
         with self.channel_lock:
             if not self.backend_channel is None:
-                self.backend_channel.push(serialized_msg)
+                self.backend_channel.push(self.backend_channel.encode(msg))
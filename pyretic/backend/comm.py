@@ -32,10 +32,29 @@ import asyncore
 import socket
 
 import json
+import marshal
+import struct
 
 BACKEND_PORT=41414
 TERM_CHAR='\n'
 
+# The framed protocol, which the OF client and the backend switch to when both
+# support it, sends each message as a 4-byte length and a kind byte followed by
+# the payload. Message frames hold the marshal encoding of a message: both ends
+# are local Python 2 processes, which marshal is fast and compact for. 'batch'
+# messages carry a list of messages. Packet frames hold the switch, port and
+# cookie of a packet-in or packet-out followed by its raw bytes, which are
+# handed on as they are.
+FRAMED_PROTOCOL='framed'
+PROTOCOLS=[FRAMED_PROTOCOL]
+FRAME_HEADER=struct.Struct('>Ic')
+MESSAGE_FRAME='m'
+PACKET_FRAME='p'
+PACKET_HEADER=struct.Struct('>QIQ')
+MARSHAL_VERSION=2
+BATCH_SIZE=1000
+NO_MESSAGE=object()
+
 def serialize(msg):
     jsonable_msg = to_jsonable_format(msg)
     jsoned_msg = json.dumps(jsonable_msg)
@@ -86,7 +105,7 @@ def dict_to_ascii(d):
 def bytelist2ascii(packet_dict):
     def convert(h,val):
         if h in ['srcmac','dstmac','srcip','dstip','raw']:
-            return ''.join([chr(d) for d in val])
+            return str(bytearray(val))
         else:
             return val
     return { h : convert(h,val) for (h, val) in packet_dict.items()}
@@ -95,7 +114,7 @@ def bytelist2ascii(packet_dict):
 def ascii2bytelist(packet_dict):
     def convert(h,val):
         if h in ['srcmac','dstmac','srcip','dstip','raw']:
-            return [ord(c) for c in val]
+            return list(bytearray(val))
         else:
             return val
     return { h : convert(h,val) for (h, val) in packet_dict.items()}
@@ -110,3 +129,108 @@ def to_jsonable_format(item):
         return map(to_jsonable_format,item)
     else:
         return item
+
+
+def to_framed_format(item):
+    """ Like to_jsonable_format, but leaving addresses and raw packets as
+    byte strings. """
+    if isinstance(item, dict):
+        return dict_to_ascii(item)
+    elif isinstance(item, (list, tuple)):
+        return map(to_framed_format,item)
+    else:
+        return item
+
+def is_raw_packet(msg):
+    """ Whether msg is a packet message whose packet fits in a packet frame,
+    which only carries the switch, port and raw bytes. """
+    if msg[0] != 'packet':
+        return False
+    packet = msg[1]
+    cookie = msg[2] if len(msg) > 2 else 0
+    try:
+        return (isinstance(packet['raw'], str) and
+                0 <= packet['switch'] < 2**64 and 0 <= packet['port'] < 2**32
+                and 0 <= cookie < 2**64)
+    except (KeyError, TypeError):
+        return False
+
+def frame(msg):
+    if is_raw_packet(msg):
+        packet = msg[1]
+        cookie = msg[2] if len(msg) > 2 else 0
+        raw = packet['raw']
+        return (FRAME_HEADER.pack(PACKET_HEADER.size + len(raw), PACKET_FRAME) +
+                PACKET_HEADER.pack(packet['switch'], packet['port'], cookie) +
+                raw)
+    payload = marshal.dumps(to_framed_format(msg), MARSHAL_VERSION)
+    return FRAME_HEADER.pack(len(payload), MESSAGE_FRAME) + payload
+
+def unframe(kind, payload):
+    if kind == PACKET_FRAME:
+        (switch, port, cookie) = PACKET_HEADER.unpack_from(payload)
+        packet = {'switch' : switch, 'port' : port,
+                  'raw' : payload[PACKET_HEADER.size:]}
+        return ['packet', packet, cookie]
+    return marshal.loads(payload)
+
+
+class MessageChannel(object):
+    """
+    Mixin for the async_chat channels between the backend and the OF client,
+    reading and writing messages in the JSON protocol or, once negotiated,
+    the framed one. The OF client offers the protocols it supports with a
+    ['hello', protocols] message, to which the backend replies with
+    ['hello', protocol] and from then on sends framed messages. The client
+    acknowledges with ['hello', protocol] and sends framed messages too.
+    """
+    framed_in = False
+    framed_out = False
+    frame_len = None
+    frame_kind = None
+
+    def start_framed_input(self):
+        self.framed_in = True
+        self.frame_len = None
+        self.set_terminator(FRAME_HEADER.size)
+
+    def read_message(self):
+        """ Return the message completed by the terminator just found, or
+        NO_MESSAGE if only the header of a frame was read. """
+        if not self.framed_in:
+            return deserialize(self.received_data)
+        data = ''.join(self.received_data)
+        del self.received_data[:]
+        if self.frame_len is None:
+            (self.frame_len, self.frame_kind) = FRAME_HEADER.unpack(data)
+            self.set_terminator(self.frame_len)
+            return NO_MESSAGE
+        self.frame_len = None
+        self.set_terminator(FRAME_HEADER.size)
+        return unframe(self.frame_kind, data)
+
+    def encode(self, msg):
+        if self.framed_out:
+            return frame(msg)
+        return serialize(msg)
+
+    def encode_batch(self, msgs):
+        """ Return the encoding of the messages, in batches of BATCH_SIZE if
+        the framed protocol is used. Packets keep their own frames, in
+        order between the batches. """
+        if not self.framed_out:
+            return ''.join(map(serialize, msgs))
+        frames = []
+        batch = []
+        for msg in msgs:
+            packet = is_raw_packet(msg)
+            if batch and (packet or len(batch) == BATCH_SIZE):
+                frames.append(frame(['batch', batch]))
+                batch = []
+            if packet:
+                frames.append(frame(msg))
+            else:
+                batch.append(msg)
+        if batch:
+            frames.append(frame(['batch', batch]))
+        return ''.join(frames)
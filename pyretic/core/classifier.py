@@ -1,5 +1,6 @@
 
 from collections import deque
+import heapq
 import copy
 from pyretic.evaluations import stat
 ###############################################################################
@@ -233,6 +234,304 @@ def _cross_rules(r1,r2):
     return c
 #### End of exposed classifier helper functions ####
 
+#### Shadow elimination index ####
+# Only matches agreeing exactly on all of their non-IP fields, and whose IP
+# prefixes contain the candidate's, can cover it. Index the kept matches on
+# those so each new rule is only checked against plausible coverers.
+IP_MATCH_FIELDS = ['dstip', 'srcip']
+
+class _PrefixTrie(object):
+    """
+    Binary trie over IPv4 prefixes. Values are stored at the node of their
+    prefix, and a lookup returns every value whose prefix contains the
+    queried network.
+    """
+    def __init__(self):
+        # node: [child-0, child-1, values stored at this prefix]
+        self.root = [None, None, []]
+
+    def insert(self, net, value):
+        node = self.root
+        addr = int(net.network)
+        for i in range(net.prefixlen):
+            bit = (addr >> (31 - i)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, []]
+            node = node[bit]
+        node[2].append(value)
+
+    def containing(self, net):
+        node = self.root
+        addr = int(net.network)
+        found = list(node[2])
+        for i in range(net.prefixlen):
+            node = node[(addr >> (31 - i)) & 1]
+            if node is None:
+                break
+            found.extend(node[2])
+        return found
+
+
+class ShadowIndex(object):
+    """
+    Index of the matches of already kept (higher priority) rules, answering
+    whether any of them covers a new match. The answer is always the same as
+    checking match.covers against every kept match in turn.
+    """
+    def __init__(self):
+        self.matches = []    # every kept match, for the exhaustive fallback
+        self.universal = False
+        self.unindexed = []  # kept matches we can't key on
+        # field signature -> (exact fields, ip field, {exact values: bucket})
+        self.groups = {}
+
+    def _keys(self, m):
+        """ Return (signature, exact fields, ip field, exact values) for a
+        match, or None if the match can't be keyed. """
+        from ipaddr import IPv4Network
+        try:
+            fmap = m.map
+        except AttributeError:
+            return None
+        sig = frozenset(fmap.keys())
+        ip_field = None
+        for f in IP_MATCH_FIELDS:
+            if f in sig:
+                if not isinstance(fmap[f], IPv4Network):
+                    return None
+                if ip_field is None:
+                    ip_field = f
+        exact = tuple(sorted(f for f in sig if f not in IP_MATCH_FIELDS))
+        vals = tuple(fmap[f] for f in exact)
+        try:
+            hash(vals)
+        except TypeError:
+            return None
+        return (sig, exact, ip_field, vals)
+
+    def add(self, m):
+        from pyretic.core.language import identity, drop
+        self.matches.append(m)
+        if self.universal or m == drop:
+            return
+        if m == identity:
+            self.universal = True
+            return
+        keys = self._keys(m)
+        if keys is None:
+            self.unindexed.append(m)
+            return
+        (sig, exact, ip_field, vals) = keys
+        (_, _, buckets) = self.groups.setdefault(sig, (exact, ip_field, {}))
+        if ip_field is None:
+            buckets.setdefault(vals, []).append(m)
+        else:
+            if not vals in buckets:
+                buckets[vals] = _PrefixTrie()
+            buckets[vals].insert(m.map[ip_field], m)
+
+    def candidates(self, m):
+        """ Return the kept matches which may cover m. """
+        keys = self._keys(m)
+        if keys is None:
+            return self.matches
+        fmap = m.map
+        sig = keys[0]
+        found = list(self.unindexed)
+        for (gsig, (exact, ip_field, buckets)) in self.groups.iteritems():
+            if not gsig <= sig:
+                continue
+            bucket = buckets.get(tuple(fmap[f] for f in exact))
+            if bucket is None:
+                continue
+            if ip_field is None:
+                found.extend(bucket)
+            else:
+                found.extend(bucket.containing(fmap[ip_field]))
+        return found
+
+    def covers(self, m):
+        if self.universal:
+            return True
+        for k in self.candidates(m):
+            if k.covers(m):
+                return True
+        return False
+
+#### End of shadow elimination index ####
+
+#### Parallel composition partition ####
+# Two matches with different values on a shared exact-match field never
+# intersect, so rules only need crossing with the rules of the same value on
+# that field, plus those which don't match on it at all.
+
+def _exact_fields(rules):
+    fields = set()
+    for r in rules:
+        try:
+            fields.update(f for f in r.match.map.keys()
+                          if not f in IP_MATCH_FIELDS)
+        except AttributeError:
+            pass
+    return fields
+
+class RulePartition(object):
+    """
+    Rules of a classifier partitioned on each of the given exact-match
+    fields. Candidates are always returned in the original rule order.
+    """
+    def __init__(self, rules, fields):
+        self.rules = list(enumerate(rules))
+        self.parts = {}  # field -> ({value: [(index, rule)]}, wildcards)
+        for f in fields:
+            buckets = {}
+            wildcards = []
+            for (i, r) in self.rules:
+                try:
+                    buckets.setdefault(r.match.map[f], []).append((i, r))
+                except (AttributeError, KeyError, TypeError):
+                    wildcards.append((i, r))
+            self.parts[f] = (buckets, wildcards)
+
+    def candidates(self, m):
+        """ Return the rules whose match may intersect with m. """
+        best = None
+        fmap = getattr(m, 'map', {})
+        for (f, (buckets, wildcards)) in self.parts.iteritems():
+            if not f in fmap:
+                continue
+            try:
+                bucket = buckets.get(fmap[f], [])
+            except TypeError:
+                continue
+            size = len(bucket) + len(wildcards)
+            if best is None or size < best[0]:
+                best = (size, bucket, wildcards)
+        if best is None:
+            return [r for (i, r) in self.rules]
+        return [r for (i, r) in heapq.merge(best[1], best[2])]
+
+#### End of parallel composition partition ####
+
+#### Decision tree evaluation ####
+# Packets are evaluated against a compiled classifier by descending a tree
+# keyed on exact-match header fields, then trying the few rules left at the
+# leaf in priority order. A rule which doesn't match on the field of a node,
+# or whose value on it we can't key on, is kept under every branch.
+DECISION_TREE_FIELDS = ['switch', 'port', 'dstmac', 'srcmac', 'ethtype',
+                        'protocol', 'srcport', 'dstport', 'tos']
+DECISION_TREE_DEPTH = 4
+DECISION_TREE_LEAF_SIZE = 4
+
+_WILDCARD = object()
+_MISSING = object()  # key of rules matching packets without the field
+
+class DecisionTree(object):
+    """
+    The rules of a classifier arranged in a decision tree, finding the first
+    rule matching a packet without trying each rule in turn. Evaluation gives
+    the same packets as Classifier.eval, or None when the matched rule sends
+    packets to the controller (which is where compilation puts queries), the
+    packet being left to the policy interpreter.
+    """
+    def __init__(self, rules, depth=DECISION_TREE_DEPTH,
+                 leaf_size=DECISION_TREE_LEAF_SIZE):
+        from pyretic.core.language import (identity, drop, modify, Query,
+                                           Controller)
+        # (rule, match or None for all packets, actions, to controller)
+        self.entries = []
+        for r in rules:
+            if r.match == drop:
+                continue
+            m = None if r.match == identity else r.match
+            acts = []
+            query = False
+            for act in r.actions:
+                if act is Controller or isinstance(act, Query):
+                    query = True
+                elif type(act) is modify:
+                    act = act.internal_modify
+                acts.append(act)
+            self.entries.append((r, m, acts, query))
+        self.leaf_size = leaf_size
+        self.root = self._build(self.entries, depth)
+
+    @staticmethod
+    def _key(entry, field):
+        try:
+            v = entry[1].map[field]
+        except (AttributeError, KeyError):
+            return _WILDCARD
+        if v is None:
+            return _MISSING
+        try:
+            hash(v)
+        except TypeError:
+            return _WILDCARD
+        return v
+
+    def _build(self, entries, depth):
+        """ Return a leaf (a list of entries) or a node (field, {value:
+        subtree}, subtree for other values). """
+        if depth == 0 or len(entries) <= self.leaf_size:
+            return entries
+        best = None
+        for f in DECISION_TREE_FIELDS:
+            keys = [self._key(e, f) for e in entries]
+            keyed = [k for k in keys if not k is _WILDCARD]
+            if len(set(keyed)) < 2:
+                continue
+            if best is None or len(keyed) > best[0]:
+                best = (len(keyed), f, keys)
+        if best is None:
+            return entries
+        (_, field, keys) = best
+        branches = {}
+        wildcards = []
+        for (e, k) in zip(entries, keys):
+            if k is _WILDCARD:
+                wildcards.append(e)
+                for b in branches.itervalues():
+                    b.append(e)
+            elif k in branches:
+                branches[k].append(e)
+            else:
+                branches[k] = wildcards + [e]
+        return (field,
+                dict((k, self._build(b, depth - 1))
+                     for (k, b) in branches.iteritems()),
+                self._build(wildcards, depth - 1))
+
+    def lookup(self, pkt):
+        """ Return the entry of the first rule matching pkt, if any. """
+        node = self.root
+        while isinstance(node, tuple):
+            (field, branches, default) = node
+            try:
+                v = pkt[field]
+            except Exception:
+                v = _MISSING
+            try:
+                node = branches.get(v, default)
+            except TypeError:
+                node = self.entries
+                break
+        for entry in node:
+            if entry[1] is None or entry[1].eval(pkt):
+                return entry
+        return None
+
+    def eval(self, pkt):
+        entry = self.lookup(pkt)
+        if entry is None or entry[3]:
+            return None
+        out = set()
+        for act in entry[2]:
+            out |= act.eval(pkt)
+        return out
+
+#### End of decision tree evaluation ####
+
 class Classifier(object):
     """
     A classifier contains a list of rules, where the order of the list implies
@@ -342,8 +641,11 @@ class Classifier(object):
         c3 = Classifier()
         assert(not (c1 is None and c2 is None))
         # then cross all pairs of rules in the first and second classifiers
+        # which can intersect
+        fields = _exact_fields(c1.rules) & _exact_fields(c2.rules)
+        c2_part = RulePartition(c2.rules, fields)
         for r1 in c1.rules:
-            for r2 in c2.rules:
+            for r2 in c2_part.candidates(r1.match):
                 crossed_r = _cross(r1,r2)
                 if crossed_r:
                     c3.append(crossed_r)
@@ -446,10 +748,9 @@ class Classifier(object):
     def remove_shadowed_cover_single(self):
         # Eliminate every rule completely covered by some higher priority rule
         opt_c = Classifier()
+        index = ShadowIndex()
         for r in self.rules:
-            if not reduce(lambda acc, new_r: acc or
-                          new_r.match.covers(r.match),
-                          opt_c.rules,
-                          False):
+            if not index.covers(r.match):
                 opt_c.rules.append(r)
+                index.add(r.match)
         return opt_c
@@ -0,0 +1,157 @@
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+import collections
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+class Timer(object):
+    """ A call scheduled on an EventLoop, repeated every interval if one is
+    given, until cancelled. """
+    def __init__(self, when, interval, f, args):
+        self.when = when
+        self.interval = interval
+        self.f = f
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class EventLoop(object):
+    """
+    Runs callbacks one at a time on a thread of its own, in the order they
+    were scheduled, along with timers. This is the single-threaded model of
+    asyncio's event loops, for Python 2: code running on a loop doesn't need
+    locks against other code running on it.
+
+    If maxsize is given, a callback scheduled while maxsize callbacks are
+    waiting is dropped, and counted in dropped.
+    """
+    def __init__(self, name, maxsize=None, log=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.log = log or logging.getLogger('%s.EventLoop' % __name__)
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.ready = collections.deque() # (f, args)
+        self.timers = [] # heap of (when, seq, Timer)
+        self.seq = itertools.count()
+        self.dropped = 0
+        self.thread = None
+        self.stopped = False
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name=self.name)
+                self.thread.daemon = True
+                self.thread.start()
+        return self
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            self.cond.notify()
+
+    def in_loop(self):
+        return threading.current_thread() is self.thread
+
+    def call_soon(self, f, *args):
+        """ Schedule f(*args), returning whether it was (or dropped). """
+        with self.lock:
+            if self.maxsize is not None and len(self.ready) >= self.maxsize:
+                self.dropped += 1
+                return False
+            self.ready.append((f, args))
+            self.cond.notify()
+        return True
+
+    def call_later(self, delay, f, *args):
+        return self.schedule(Timer(time.time() + delay, None, f, args))
+
+    def call_every(self, interval, f, *args):
+        """ Schedule f(*args) every interval seconds, the first time interval
+        seconds from now. """
+        return self.schedule(Timer(time.time() + interval, interval, f, args))
+
+    def schedule(self, timer):
+        with self.lock:
+            heapq.heappush(self.timers, (timer.when, next(self.seq), timer))
+            self.cond.notify()
+        return timer
+
+    def next_callback(self):
+        """ Wait for the next callback to run, or return None once the loop
+        is stopped. """
+        with self.lock:
+            while not self.stopped:
+                now = time.time()
+                while self.timers and self.timers[0][2].cancelled:
+                    heapq.heappop(self.timers)
+                if self.timers and self.timers[0][0] <= now:
+                    (_, _, timer) = heapq.heappop(self.timers)
+                    if timer.interval is not None:
+                        timer.when = max(timer.when + timer.interval, now)
+                        heapq.heappush(self.timers,
+                                       (timer.when, next(self.seq), timer))
+                    return (timer.f, timer.args)
+                if self.ready:
+                    return self.ready.popleft()
+                if self.timers:
+                    self.cond.wait(self.timers[0][0] - now)
+                else:
+                    self.cond.wait()
+        return None
+
+    def run(self):
+        while True:
+            callback = self.next_callback()
+            if callback is None:
+                return
+            (f, args) = callback
+            try:
+                f(*args)
+            except Exception:
+                self.log.exception('callback %s on event loop %s failed' %
+                                   (getattr(f, '__name__', f), self.name))
+
+    def __len__(self):
+        return len(self.ready)
+
+_event_loop = None
+
+def get_event_loop():
+    """ The runtime's event loop, or None if it runs without one. """
+    return _event_loop
+
+def set_event_loop(loop):
+    global _event_loop
+    _event_loop = loop
@@ -0,0 +1,564 @@
+
+################################################################################
+# The Pyretic Project                                                          #
+# author: Mina Tahmasbi (arashloo@cs.princeton.edu)                            #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+"""
+Native policy compilation through forwarding decision diagrams (FDDs).
+
+An FDD tests one header field per node, in a fixed order of the fields, and
+maps each value of the field to a sub-diagram, other values going to a
+default sub-diagram. IP fields are tested on prefixes: a packet goes to the
+branch of the longest prefix containing its address. The leaves are sets of
+actions: modifications (frozensets of (field, value) pairs, the empty one
+being identity), or queries and the controller.
+
+Since each field is tested at most once on any path, parallel and sequential
+composition are computed directly on the diagrams, and the final classifier
+has one rule per path.
+"""
+
+import time
+from ipaddr import IPv4Network
+from pyretic.core import util
+from pyretic.core.classifier import Rule, Classifier, _PrefixTrie
+
+# Fields with few values, tested by most policies, come first: this keeps the
+# diagrams, and the classifiers flattened from them, small.
+FIELD_ORDER = ['ethtype', 'protocol', 'vlan_id', 'vlan_pcp', 'vlan_offset',
+               'vlan_nbits', 'vlan_total_stages', 'switch', 'port', 'srcmac',
+               'dstmac', 'srcip', 'dstip', 'tos', 'srcport', 'dstport']
+IP_FIELDS = ['srcip', 'dstip']
+
+def _static_rank(f):
+    try:
+        return (FIELD_ORDER.index(f), f)
+    except ValueError:
+        return (len(FIELD_ORDER), f)
+
+def field_order(pol):
+    """
+    Order the fields by their first test in the policy, read from left to
+    right, so that the fields of policies sequenced first (e.g., access
+    control in front of forwarding) are tested first. The other fields
+    follow in FIELD_ORDER.
+    """
+    from pyretic.core.language import (match, _match, CombinatorPolicy,
+                                       DerivedPolicy)
+    order = []
+    seen = set()
+    visited = set()
+    stack = [pol]
+    while stack:
+        p = stack.pop()
+        if id(p) in visited:
+            continue
+        visited.add(id(p))
+        if isinstance(p, match):
+            fmap = p.map if isinstance(p, _match) else p.internal_match.map
+            for f in sorted(fmap.keys(), key=_static_rank):
+                if not f in seen:
+                    seen.add(f)
+                    order.append(f)
+        elif isinstance(p, CombinatorPolicy):
+            stack.extend(reversed(p.policies))
+        elif isinstance(p, DerivedPolicy):
+            stack.append(p.policy)
+    order.extend(sorted((f for f in FIELD_ORDER if not f in seen),
+                        key=_static_rank))
+    return order
+
+class Leaf(object):
+    __slots__ = ['actions']
+
+    def __init__(self, actions):
+        self.actions = actions
+
+    def __repr__(self):
+        return '{%s}' % ', '.join(map(str, self.actions))
+
+
+class Node(object):
+    __slots__ = ['field', 'branches', 'default', 'ip', '_trie']
+
+    def __init__(self, field, branches, default):
+        self.field = field
+        self.branches = branches
+        self.default = default
+        self.ip = field in IP_FIELDS
+        self._trie = None
+
+    def lpm_key(self, net):
+        """ The longest prefix among the branches containing net. """
+        if self._trie is None:
+            self._trie = _PrefixTrie()
+            for k in self.branches:
+                if k is not None:
+                    self._trie.insert(k, k)
+        found = self._trie.containing(net)
+        return found[-1] if found else None
+
+    def lookup(self, v):
+        """ The sub-diagram for packets whose field has value v. """
+        if not self.ip or v is None:
+            return self.branches.get(v, self.default)
+        k = self.lpm_key(v)
+        return self.default if k is None else self.branches[k]
+
+    def __repr__(self):
+        return '(%s: %s | %s)' % (self.field,
+                                  ', '.join('%s -> %s' % (k, c) for (k, c)
+                                            in self.branches.iteritems()),
+                                  self.default)
+
+
+class FDDCompiler(object):
+    """
+    Builds FDDs for policies. Nodes and leaves are hash-consed in the tables
+    of the compiler, so that equal diagrams are the same object, diagrams are
+    kept reduced (no branch goes where the node would send its packets
+    anyway), and operations on diagrams are memoized on their identity.
+    """
+    def __init__(self, order=FIELD_ORDER):
+        self.ranks = dict((f, i) for (i, f) in enumerate(order))
+        self.leaves = {}
+        self.nodes = {}
+        self.memo = {}
+        self.translated = {}  # id(policy) -> (policy, fdd)
+        self.id = self.leaf(frozenset([frozenset()]))
+        self.drop = self.leaf(frozenset())
+
+    ### Hash-consing
+
+    def leaf(self, actions):
+        try:
+            return self.leaves[actions]
+        except KeyError:
+            l = self.leaves[actions] = Leaf(actions)
+            return l
+
+    def node(self, field, branches, default):
+        if field in IP_FIELDS:
+            branches = self._reduce_prefixes(branches, default)
+        else:
+            branches = dict((k, c) for (k, c) in branches.iteritems()
+                            if not c is default)
+        if not branches:
+            return default
+        key = (field, frozenset((k, id(c)) for (k, c) in branches.iteritems()),
+               id(default))
+        try:
+            return self.nodes[key]
+        except KeyError:
+            n = self.nodes[key] = Node(field, branches, default)
+            return n
+
+    def _reduce_prefixes(self, branches, default):
+        """ Drop the prefixes going where the next shorter prefix (or the
+        default) containing them goes. """
+        res = {}
+        if None in branches and not branches[None] is default:
+            res[None] = branches[None]
+        trie = _PrefixTrie()
+        for k in sorted((k for k in branches if k is not None),
+                        key=lambda k: k.prefixlen):
+            parents = trie.containing(k)
+            parent = res[parents[-1]] if parents else default
+            if not branches[k] is parent:
+                res[k] = branches[k]
+                trie.insert(k, k)
+        return res
+
+    ### Helpers on the top node of diagrams
+
+    def _rank(self, f):
+        try:
+            return (self.ranks[f], f)
+        except KeyError:
+            return (len(self.ranks), f)
+
+    def _top_field(self, *ds):
+        fields = [d.field for d in ds if isinstance(d, Node)]
+        if not fields:
+            return None
+        return min(fields, key=self._rank)
+
+    def _keys(self, d, f):
+        if isinstance(d, Node) and d.field == f:
+            return set(d.branches)
+        return set()
+
+    def _lookup(self, d, f, k):
+        if isinstance(d, Node) and d.field == f:
+            return d.lookup(k)
+        return d
+
+    def _default(self, d, f):
+        if isinstance(d, Node) and d.field == f:
+            return d.default
+        return d
+
+    def _selector(self, f, keys):
+        """ Return a function giving the index of the key a value goes to
+        among keys, or None for the default. """
+        index = dict((k, i) for (i, k) in enumerate(keys))
+        if not f in IP_FIELDS:
+            return index.get
+        trie = _PrefixTrie()
+        for k in keys:
+            if k is not None:
+                trie.insert(k, k)
+        def select(v):
+            if v is None or v in index:
+                return index.get(v)
+            found = trie.containing(v)
+            return index[found[-1]] if found else None
+        return select
+
+    ### Operations
+
+    def union(self, d1, d2):
+        """ Parallel composition. """
+        if d1 is d2 or d2 is self.drop:
+            return d1
+        if d1 is self.drop:
+            return d2
+        key = ('+',) + tuple(sorted([id(d1), id(d2)]))
+        try:
+            return self.memo[key][0]
+        except KeyError:
+            pass
+        if isinstance(d1, Leaf) and isinstance(d2, Leaf):
+            res = self.leaf(d1.actions | d2.actions)
+        else:
+            f = self._top_field(d1, d2)
+            branches = {}
+            for k in self._keys(d1, f) | self._keys(d2, f):
+                branches[k] = self.union(self._lookup(d1, f, k),
+                                         self._lookup(d2, f, k))
+            res = self.node(f, branches, self.union(self._default(d1, f),
+                                                    self._default(d2, f)))
+        self.memo[key] = (res, d1, d2)
+        return res
+
+    def union_all(self, ds):
+        """ Parallel composition of a list of diagrams, pairwise so that
+        intermediate diagrams stay small. """
+        ds = list(ds)
+        if not ds:
+            return self.drop
+        while len(ds) > 1:
+            ds = [self.union(ds[i], ds[i+1]) if i + 1 < len(ds) else ds[i]
+                  for i in range(0, len(ds), 2)]
+        return ds[0]
+
+    def neg(self, d):
+        """ Negation of a filter. """
+        if d is self.id:
+            return self.drop
+        if d is self.drop:
+            return self.id
+        if isinstance(d, Leaf):
+            raise TypeError('Negation of a policy which is not a filter')
+        key = ('~', id(d))
+        try:
+            return self.memo[key][0]
+        except KeyError:
+            pass
+        res = self.node(d.field,
+                        dict((k, self.neg(c)) for (k, c) in d.branches.iteritems()),
+                        self.neg(d.default))
+        self.memo[key] = (res, d)
+        return res
+
+    def _mod_value(self, f, v):
+        if f in IP_FIELDS and v is not None and not isinstance(v, IPv4Network):
+            return util.string_to_network(str(v))
+        return v
+
+    def after(self, d, mod):
+        """ The diagram applying modification mod, then d. """
+        key = ('mod', id(d), mod)
+        try:
+            return self.memo[key][0]
+        except KeyError:
+            pass
+        fmap = dict(mod)
+        if isinstance(d, Leaf):
+            acts = set()
+            for a in d.actions:
+                if isinstance(a, frozenset):
+                    new_fmap = fmap.copy()
+                    new_fmap.update(a)
+                    acts.add(frozenset(new_fmap.iteritems()))
+                else:
+                    acts.add(a)
+            res = self.leaf(frozenset(acts))
+        elif d.field in fmap:
+            res = self.after(d.lookup(self._mod_value(d.field, fmap[d.field])),
+                             mod)
+        else:
+            res = self.node(d.field,
+                            dict((k, self.after(c, mod))
+                                 for (k, c) in d.branches.iteritems()),
+                            self.after(d.default, mod))
+        self.memo[key] = (res, d)
+        return res
+
+    def seq(self, d1, d2):
+        """ Sequential composition. """
+        if d1 is self.drop or d2 is self.id:
+            return d1
+        key = ('>>', id(d1), id(d2))
+        try:
+            return self.memo[key][0]
+        except KeyError:
+            pass
+        if isinstance(d1, Leaf):
+            ds = []
+            for a in d1.actions:
+                if isinstance(a, frozenset):
+                    ds.append(self.after(d2, a))
+                else:
+                    # as in the classifier, packets at queries stay there
+                    ds.append(self.leaf(frozenset([a])))
+            res = self.union_all(ds)
+        else:
+            keys = tuple(d1.branches)
+            res = self.cond(d1.field, keys,
+                            tuple(self.seq(d1.branches[k], d2) for k in keys),
+                            self.seq(d1.default, d2))
+        self.memo[key] = (res, d1, d2)
+        return res
+
+    def cond(self, f, keys, rs, rd):
+        """ The diagram sending packets whose field f goes to keys[i] to
+        rs[i], and other packets to rd. """
+        if all(r is rd for r in rs):
+            return rd
+        g = self._top_field(*(rs + (rd,)))
+        if g is None or self._rank(g) > self._rank(f):
+            return self.node(f, dict(zip(keys, rs)), rd)
+        key = ('?', f, keys, tuple(id(r) for r in rs), id(rd))
+        try:
+            return self.memo[key][0]
+        except KeyError:
+            pass
+        if g == f:
+            select = self._selector(f, keys)
+            branches = {}
+            for k in set(keys).union(*[self._keys(r, f) for r in rs + (rd,)]):
+                i = select(k)
+                branches[k] = self._lookup(rd if i is None else rs[i], f, k)
+            res = self.node(f, branches, self._default(rd, f))
+        else:
+            branches = {}
+            for k in set().union(*[self._keys(r, g) for r in rs + (rd,)]):
+                branches[k] = self.cond(f, keys,
+                                        tuple(self._lookup(r, g, k) for r in rs),
+                                        self._lookup(rd, g, k))
+            res = self.node(g, branches,
+                            self.cond(f, keys,
+                                      tuple(self._default(r, g) for r in rs),
+                                      self._default(rd, g)))
+        self.memo[key] = (res, rs, rd)
+        return res
+
+    ### Translation from policies
+
+    def match_fdd(self, fmap):
+        d = self.id
+        for f in sorted(fmap.keys(), key=self._rank, reverse=True):
+            d = self.node(f, {fmap[f] : d}, self.drop)
+        return d
+
+    def _actions(self, acts):
+        from pyretic.core.language import (identity, drop, modify, _modify,
+                                           DerivedPolicy)
+        res = set()
+        for a in acts:
+            while isinstance(a, DerivedPolicy):
+                a = a.policy
+            if a is identity:
+                res.add(frozenset())
+            elif a is drop:
+                pass
+            elif isinstance(a, modify):
+                fmap = a.map if isinstance(a, _modify) else a.internal_modify.map
+                res.add(frozenset(fmap.iteritems()))
+            else:
+                res.add(a)
+        return frozenset(res)
+
+    def prepend(self, fmap, fields, a, d):
+        """ The diagram sending packets matching fmap (on the given fields,
+        in order) to a, and others to d. """
+        if not fields:
+            return a
+        f = fields[0]
+        v = fmap[f]
+        if isinstance(d, Node) and self._rank(d.field) < self._rank(f):
+            return self.node(d.field,
+                             dict((k, self.prepend(fmap, fields, a, c))
+                                  for (k, c) in d.branches.iteritems()),
+                             self.prepend(fmap, fields, a, d.default))
+        if not (isinstance(d, Node) and d.field == f):
+            return self.node(f, {v : self.prepend(fmap, fields[1:], a, d)}, d)
+        branches = dict(d.branches)
+        branches[v] = self.prepend(fmap, fields[1:], a, d.lookup(v))
+        if d.ip and v is not None:
+            # longer prefixes than v also go to the new rule
+            for (k, c) in d.branches.iteritems():
+                if k is not None and k != v and k in v:
+                    branches[k] = self.prepend(fmap, fields[1:], a, c)
+        return self.node(f, branches, d.default)
+
+    def from_classifier(self, c):
+        """ The diagram of a classifier, for policies the FDD compiler has
+        no translation of. """
+        from pyretic.core.language import identity, drop, match, _match
+        d = self.drop
+        for r in reversed(list(c.rules)):
+            a = self.leaf(self._actions(r.actions))
+            if r.match is drop:
+                continue
+            elif r.match == identity:
+                d = a
+            elif isinstance(r.match, match):
+                m = r.match
+                fmap = m.map if isinstance(m, _match) else m.internal_match.map
+                d = self.prepend(fmap, sorted(fmap.keys(), key=self._rank),
+                                 a, d)
+            else:
+                p = self.translate(r.match)
+                d = self.union(self.seq(p, a), self.seq(self.neg(p), d))
+        return d
+
+    def translate(self, pol):
+        try:
+            return self.translated[id(pol)][1]
+        except KeyError:
+            pass
+        d = self._translate(pol)
+        self.translated[id(pol)] = (pol, d)
+        return d
+
+    def _translate(self, pol):
+        from pyretic.core.language import (identity, drop, match, _match,
+                                           modify, negate, parallel,
+                                           sequential, DerivedPolicy)
+        if pol is identity:
+            return self.id
+        elif pol is drop:
+            return self.drop
+        elif isinstance(pol, match):
+            fmap = pol.map if isinstance(pol, _match) else pol.internal_match.map
+            return self.match_fdd(fmap)
+        elif isinstance(pol, modify):
+            return self.leaf(self._actions([pol]))
+        elif isinstance(pol, negate):
+            return self.neg(self.translate(pol.policies[0]))
+        elif isinstance(pol, parallel):
+            return self.union_all(self.translate(p) for p in pol.policies)
+        elif isinstance(pol, sequential):
+            if not pol.policies:
+                return self.id
+            d = self.translate(pol.policies[0])
+            for p in pol.policies[1:]:
+                d = self.seq(d, self.translate(p))
+            return d
+        elif isinstance(pol, DerivedPolicy):
+            return self.translate(pol.policy)
+        else:
+            return self.from_classifier(pol.compile())
+
+    ### Flattening
+
+    def to_classifier(self, d):
+        """ Flatten a diagram to a classifier, with one rule per path, leaving
+        out the rules of sub-diagrams which packets reach anyway by falling
+        through to later rules. """
+        from pyretic.core.language import match, modify, identity
+        rules = []
+        leaf_actions = {}
+        def actions(l):
+            try:
+                return set(leaf_actions[id(l)])
+            except KeyError:
+                acts = set()
+                for a in l.actions:
+                    if not isinstance(a, frozenset):
+                        acts.add(a)
+                    elif a:
+                        acts.add(modify(**dict(a)))
+                    else:
+                        acts.add(identity)
+                leaf_actions[id(l)] = acts
+                return set(acts)
+        def walk(d, fmap, fallback):
+            # fallback: the diagram which packets not matched by the rules of
+            # d reach through the rules after them, if any
+            if d is fallback:
+                return
+            if isinstance(d, Leaf):
+                m = match(**fmap) if fmap else identity
+                rules.append(Rule(m, actions(d)))
+                return
+            keys = d.branches.keys()
+            if d.ip:
+                # longest prefixes first, falling through to shorter ones
+                keys.sort(key=lambda k: -1 if k is None else -k.prefixlen)
+                trie = _PrefixTrie()
+                for k in keys:
+                    if k is not None:
+                        trie.insert(k, k)
+            for k in keys:
+                child_fallback = d.default
+                if d.ip and k is not None:
+                    parents = trie.containing(k)[:-1]
+                    if parents:
+                        child_fallback = d.branches[parents[-1]]
+                fmap[d.field] = k
+                walk(d.branches[k], fmap, child_fallback)
+            del fmap[d.field]
+            walk(d.default, fmap, fallback)
+        walk(d, {}, None)
+        return Classifier(rules)
+
+
+class fdd_backend(object):
+    """
+    Backend compiling policies natively through FDDs, without the NetKAT
+    compiler server, and without the rule cross products of the classifier
+    algebra in pyretic/core/classifier.py.
+    """
+    @classmethod
+    def generate_classifier(cls, pol):
+        """ Return the classifier of a policy, and the compilation time. """
+        t_s = time.time()
+        comp = FDDCompiler(field_order(pol))
+        c = comp.to_classifier(comp.translate(pol))
+        return (c, time.time() - t_s)
@@ -40,16 +40,22 @@ import logging
 
 from pyretic.core import util
 from pyretic.core.network import *
-from pyretic.core.classifier import Rule, Classifier
+from pyretic.core.classifier import Rule, Classifier, ShadowIndex
 from pyretic.core.util import frozendict, singleton, SingletonMetaclass
 from pyretic.core.netkat import netkat_backend, NETKAT_PORT
+from pyretic.core.fdd import fdd_backend
 from pyretic.evaluations import stat
 
 from multiprocessing import Lock, Condition
 import copy
+import threading
+import weakref
 
 NO_CACHE=False
 NETKAT_CLASSIFIER_CACHE=True
+COMPILE_CACHE=True
+COMPILE_CACHE_SIZE=10000
+MATCH_MEMO_SIZE=100000
 
 basic_headers = ["srcmac", "dstmac", "srcip", "dstip", "tos", "srcport", "dstport",
                  "ethtype", "protocol"]
@@ -85,6 +91,7 @@ class Policy(object):
 
     def invalidate_classifier(self):
         self._classifier = None
+        self.__dict__.pop('_struct_key', None)
         self.comp_time = 0
 
     def has_active_classifier(self):
@@ -178,12 +185,35 @@ class Policy(object):
         nb = netkat_backend
         if ((not NETKAT_CLASSIFIER_CACHE) or (not self._classifier) or
             force_compile):
-            (self._classifier, comp_t) = nb.generate_classifier(self,
-                                                                switch_cnt,
-                                                                multistage,
-                                                                print_json=print_json,
-                                                                return_json=return_json,
-                                                                server_port=server_port)
+            generate = lambda: nb.generate_classifier(self,
+                                                      switch_cnt,
+                                                      multistage,
+                                                      print_json=print_json,
+                                                      return_json=return_json,
+                                                      server_port=server_port)
+            if force_compile:
+                (self._classifier, comp_t) = generate()
+            else:
+                (self._classifier, comp_t) = cached_compile(
+                    self, generate, 'netkat', switch_cnt, multistage,
+                    return_json)
+        return (self._classifier, comp_t)
+
+    def fdd_compile(self, force_compile=False):
+        """
+        Compile a policy using the native FDD compiler.
+
+        :param force_compile: disregard cached results and recompile policy
+        anyway
+        :type force_compile: boolean
+        :rtype: (Classifier, float)
+        """
+        comp_t = 0
+        if force_compile:
+            (self._classifier, comp_t) = fdd_backend.generate_classifier(self)
+        elif not self._classifier:
+            (self._classifier, comp_t) = cached_compile(
+                self, lambda: fdd_backend.generate_classifier(self), 'fdd')
         return (self._classifier, comp_t)
 
 
@@ -360,6 +390,64 @@ class ControllerClass(Singleton):
         return "Controller"
 
 Controller = ControllerClass() # singleton instance used everywhere
+
+# Matches and modifies on virtual fields translate them to VLAN headers, which
+# depend on the bits allocated to every virtual field. Whatever is cached from
+# a translation is tagged with the allocation version it was made for.
+_virtual_fields_version = 0
+
+def virtual_fields_changed():
+    """ Called when virtual fields are declared or cleared: drop the cached
+    translations made for the previous allocation. """
+    global _virtual_fields_version
+    _virtual_fields_version += 1
+    with _intern_lock:
+        _match._interned.clear()
+    clear_compile_cache()
+
+def cached_translation(pol, name, translate):
+    """ Return pol's cached translate(), made again for a new allocation of
+    virtual fields. """
+    try:
+        (version, res) = pol.__dict__[name]
+        if version == _virtual_fields_version:
+            return res
+    except KeyError:
+        pass
+    version = _virtual_fields_version
+    res = translate()
+    pol.__dict__[name] = (version, res)
+    return res
+
+class lazy_classifier(object):
+    """
+    Descriptor for the _classifier of leaf policies (match, modify), which is
+    only generated on first use, most of these policies never being compiled.
+    """
+    def __get__(self, pol, cls=None):
+        if pol is None:
+            return self
+        return cached_translation(pol, '_lazy_classifier',
+                                  pol.generate_classifier)
+
+    def __set__(self, pol, c):
+        pol.__dict__['_lazy_classifier'] = (_virtual_fields_version, c)
+
+# Bounded memos of match intersection and covering. As matches are interned,
+# they are keyed on the identities of the operands. Entries only hold weak
+# references, so the memos don't keep dead (sub)policies alive; an entry whose
+# operands were collected is stale and simply recomputed.
+_intersect_memo = util.LRUCache(MATCH_MEMO_SIZE)
+_covers_memo = util.LRUCache(MATCH_MEMO_SIZE)
+stat.Stat.register_cache('match intersect', _intersect_memo)
+stat.Stat.register_cache('match covers', _covers_memo)
+
+# Policies may be compiled by several threads at once (see NetKATWorkers). The
+# memos and the compile cache lock themselves, and the interning tables are
+# only added to under this lock, so that they keep one object per key. Racing
+# threads each compute the classifiers and translations cached on policies,
+# and all of them store the same value.
+_intern_lock = threading.Lock()
     
 class match(Filter):
     """
@@ -370,21 +458,71 @@ class match(Filter):
     :param **kwargs: field matches in keyword-argument format
     """
    
-    def __init__(self, *args, **kwargs):
+    # Structurally equal matches are interned: constructing a match whose map
+    # equals that of a live match, made for the same allocation of virtual
+    # fields, returns the existing object.
+    _interned = weakref.WeakValueDictionary()
+    _classifier = lazy_classifier()
+
+    @staticmethod
+    def _get_processed_map(*args, **kwargs):
+        map_dict = dict(*args, **kwargs)
+        for field in ['srcip', 'dstip']:
+            try:
+                val = map_dict[field]
+                map_dict.update({field: util.string_to_network(val)})
+            except KeyError:
+                pass
+        return map_dict
+
+    @classmethod
+    def _intern_key(cls, fmap):
+        # Values are keyed with their type (1 == True), and IP networks by
+        # their string (equality ignores the host bits).
+        key = []
+        for (f, v) in fmap.iteritems():
+            if isinstance(v, IPv4Network):
+                v = str(v)
+            key.append((f, v.__class__, v))
+        try:
+            key = (cls, _virtual_fields_version, frozenset(key))
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def __new__(cls, *args, **kwargs):
+        if not args and not kwargs:
+            # also the path taken by copy and pickle
+            return super(match, cls).__new__(cls)
+        fmap = util.frozendict(cls._get_processed_map(*args, **kwargs))
+        key = cls._intern_key(fmap)
+        if key is not None:
+            obj = cls._interned.get(key)
+            if obj is not None:
+                return obj
+        obj = super(match, cls).__new__(cls)
+        obj._processed_map = fmap
+        obj._intern_key = key
+        return obj
 
-        def _get_processed_map(*args, **kwargs):
-            map_dict = dict(*args, **kwargs)
-            for field in ['srcip', 'dstip']:
-                try:
-                    val = map_dict[field]
-                    map_dict.update({field: util.string_to_network(val)})
-                except KeyError:
-                    pass
-            return map_dict
-
-        self.map = util.frozendict(_get_processed_map(*args, **kwargs))
-        self._classifier = self.generate_classifier()
+    def __init__(self, *args, **kwargs):
+        if 'map' in self.__dict__:
+            return # interned, already initialized
+        try:
+            self.map = self.__dict__.pop('_processed_map')
+        except KeyError:
+            self.map = util.frozendict(self._get_processed_map(*args, **kwargs))
         super(match,self).__init__()
+        if type(self) is match:
+            # subclasses intern once they are fully initialized
+            self._intern()
+
+    def _intern(self):
+        key = self.__dict__.pop('_intern_key', None)
+        if key is not None:
+            with _intern_lock:
+                self.__class__._interned.setdefault(key, self)
 
     def eval(self, pkt):
         """
@@ -394,18 +532,34 @@ class match(Filter):
         :type pkt: Packet
         :rtype: set Packet
         """
-        return _match(**self.map).eval(pkt)
+        return self.internal_match.eval(pkt)
+
+    @property
+    def internal_match(self):
+        return cached_translation(self, '_internal_match',
+                                  lambda: _match(**self.map))
 
     def generate_classifier(self):
-        c = _match(**self.map).generate_classifier()
-        self.internal_match = _match(**self.map)
-        return c
+        return self.internal_match.generate_classifier()
 
     def __eq__(self, other):
         return ( (isinstance(other, match) and self.map == other.map)
                  or (len(self.map) == 0 and other == identity) )
 
     def intersect(self, pol):
+        key = (id(self), id(pol))
+        entry = _intersect_memo.get(key)
+        if entry is not None:
+            (self_ref, pol_ref, res_ref) = entry
+            res = res_ref()
+            if self_ref() is self and pol_ref() is pol and res is not None:
+                return res
+        res = self._intersect(pol)
+        _intersect_memo.put(key, (weakref.ref(self), weakref.ref(pol),
+                                  weakref.ref(res)))
+        return res
+
+    def _intersect(self, pol):
         def _intersect_ip(ipfx, opfx):
             most_specific = None
             if ipfx in opfx:
@@ -459,7 +613,18 @@ class match(Filter):
     def __hash__(self):
         return hash(self.map)
 
-    def covers(self,other):
+    def covers(self, other):
+        key = (id(self), id(other))
+        entry = _covers_memo.get(key)
+        if entry is not None:
+            (self_ref, other_ref, res) = entry
+            if self_ref() is self and other_ref() is other:
+                return res
+        res = self._covers(other)
+        _covers_memo.put(key, (weakref.ref(self), weakref.ref(other), res))
+        return res
+
+    def _covers(self,other):
         # Return identity if self matches every packet that other matches (and maybe more).
         # eg. if other is specific on any field that self lacks.
         def map_check(a, b):
@@ -494,10 +659,15 @@ class match(Filter):
         return "match: %s" % ' '.join(map(str,self.internal_match.map.items()))
 
 class _match(match):
+    _interned = weakref.WeakValueDictionary()
+
     def __init__(self, *args, **kwargs):
+        if 'map' in self.__dict__:
+            return # interned, already initialized
         super(_match,self).__init__(*args, **kwargs)
 
         self.map = self.translate_virtual_fields()
+        self._intern()
 
     def generate_classifier(self):
         r1 = Rule(self,{identity},[self])
@@ -580,6 +750,8 @@ class modify(Policy):
     :param *args: field assignments in argument format
     :param **kwargs: field assignments in keyword-argument format
     """
+    _classifier = lazy_classifier()
+
     ### init : List (String * FieldVal) -> List KeywordArg -> unit
     def __init__(self, *args, **kwargs):
         #TODO(Josh, Cole): why this check is here?
@@ -591,7 +763,6 @@ class modify(Policy):
                        acc and (f in compilable_headers),
                    self.map.keys(),
                    True)
-        self._classifier = self.generate_classifier()
         super(modify,self).__init__()
 
     def eval(self, pkt):
@@ -602,12 +773,15 @@ class modify(Policy):
         :type pkt: Packet
         :rtype: set Packet
         """
-        return _modify(**self.map).eval(pkt)
+        return self.internal_modify.eval(pkt)
+
+    @property
+    def internal_modify(self):
+        return cached_translation(self, '_internal_modify',
+                                  lambda: _modify(**self.map))
 
     def generate_classifier(self):
-        c = _modify(**self.map).generate_classifier()
-        self.internal_modify = _modify(**self.map)
-        return c
+        return self.internal_modify.generate_classifier()
 
 
     def __repr__(self):
@@ -1336,6 +1510,116 @@ class CountBucket(MatchingAggregateBucket):
             else:
                 self.matches[k].to_be_deleted = True
 
+################################################################################
+# Compilation cache                                                            #
+################################################################################
+
+# Compiled classifiers are shared between structurally equal policies, so that
+# sub-policies rebuilt by DynamicPolicy updates aren't recompiled. Policies are
+# keyed by an interned StructuralKey: matches and modifies by their maps,
+# combinators by their type and the keys of their children, and other policies
+# (queries, user classes) by their identity. A derived policy has the key of
+# the policy it compiles to.
+class StructuralKey(object):
+    __slots__ = ['key', 'pin', '__weakref__']
+    _interned = weakref.WeakValueDictionary()
+
+    def __init__(self, key, pin=None):
+        self.key = key
+        self.pin = pin # keeps policies keyed by identity alive
+
+    @classmethod
+    def get(cls, key, pin=None):
+        sk = cls._interned.get(key)
+        if sk is None:
+            with _intern_lock:
+                sk = cls._interned.setdefault(key, cls(key, pin))
+        return sk
+
+    def __repr__(self):
+        return "StructuralKey(%r)" % (self.key,)
+
+def _compiles_to_policy(pol):
+    return type(pol).compile.im_func is DerivedPolicy.compile.im_func
+
+def _modify_key(pol):
+    key = []
+    for (f, v) in pol.map.iteritems():
+        if isinstance(v, IPv4Network):
+            v = str(v)
+        key.append((f, v.__class__, v))
+    try:
+        key = (pol.__class__, frozenset(key))
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+def _structural_key(pol):
+    """ Return (key, static), where static is False if the key may change as
+    the policy contains a DynamicPolicy. Only static keys are memoized. """
+    try:
+        return (pol.__dict__['_struct_key'], True)
+    except KeyError:
+        pass
+    if isinstance(pol, DerivedPolicy) and _compiles_to_policy(pol):
+        (sk, static) = _structural_key(pol.policy)
+        return (sk, static and not isinstance(pol, DynamicPolicy))
+    static = True
+    key = None
+    if isinstance(pol, CombinatorPolicy):
+        children = []
+        for p in pol.policies:
+            (sk, s) = _structural_key(p)
+            children.append(sk)
+            static = static and s
+        key = (pol.__class__, tuple(children))
+    elif isinstance(pol, match):
+        key = pol.__class__._intern_key(pol.map)
+    elif isinstance(pol, modify):
+        key = _modify_key(pol)
+    if key is None:
+        sk = StructuralKey.get(('id', id(pol)), pol)
+    else:
+        sk = StructuralKey.get(key)
+    if static:
+        pol.__dict__['_struct_key'] = sk
+    return (sk, static)
+
+def structural_key(pol):
+    return _structural_key(pol)[0]
+
+_compile_cache = util.LRUCache(COMPILE_CACHE_SIZE)
+stat.Stat.register_cache('compile', _compile_cache)
+
+def cached_compile(pol, generate, *kind):
+    """ Return generate(), reusing the result for any policy structurally equal
+    to pol. kind distinguishes the compilers sharing the cache. """
+    if not COMPILE_CACHE:
+        return generate()
+    key = (structural_key(pol),) + kind
+    res = _compile_cache.get(key)
+    if res is None:
+        res = generate()
+        _compile_cache.put(key, res)
+    return res
+
+def clear_compile_cache():
+    _compile_cache.clear()
+
+def cached_prefix_classifier(pol):
+    """ Return the cached classifier of the combinator of pol's type over all
+    but its last policy, if any. Combinators compile by a left fold over their
+    policies, so a policy grown by appending (as DynamicPolicies often
+    rebuild them) is compiled from the previous one in a single step. """
+    if not COMPILE_CACHE or len(pol.policies) < 3:
+        return None
+    sk = structural_key(pol)
+    prefix = StructuralKey._interned.get((sk.key[0], sk.key[1][:-1]))
+    if prefix is None:
+        return None
+    return _compile_cache.get((prefix,))
+
 ################################################################################
 # Combinator Policies                                                          #
 ################################################################################
@@ -1362,7 +1646,7 @@ class CombinatorPolicy(Policy):
         if NO_CACHE: 
             self._classifier = self.generate_classifier()
         if not self._classifier:
-            self._classifier = self.generate_classifier()
+            self._classifier = cached_compile(self, self.generate_classifier)
         return self._classifier
 
     def __repr__(self):
@@ -1442,6 +1726,9 @@ class parallel(CombinatorPolicy):
     def generate_classifier(self):
         if len(self.policies) == 0:  # EMPTY PARALLEL IS A DROP
             return drop.compile()
+        prefix = cached_prefix_classifier(self)
+        if prefix is not None:
+            return prefix + self.policies[-1].compile()
         classifiers = map(lambda p: p.compile(), self.policies)
         return reduce(lambda acc, c: acc + c, classifiers)
 
@@ -1532,6 +1819,9 @@ class sequential(CombinatorPolicy):
 
     def generate_classifier(self):
         assert(len(self.policies) > 0)
+        prefix = cached_prefix_classifier(self)
+        if prefix is not None:
+            return prefix >> self.policies[-1].compile()
         classifiers = map(lambda p: p.compile(),self.policies)
         for c in classifiers:
             assert(c is not None)
@@ -1663,6 +1953,41 @@ class if_(DerivedPolicy):
         else:
             return self.f_branch.eval(pkt)
 
+    def generate_classifier(self):
+        # With a match predicate, the classifier is the true branch restricted
+        # to the match, prepended to the rules of the false branch it doesn't
+        # shadow. Unlike compiling self.policy, this doesn't cross the whole
+        # false branch, which is what chains of if_ keep growing.
+        if not isinstance(self.pred, match):
+            return super(if_, self).generate_classifier()
+        return cached_compile(self, self.generate_prepended_classifier)
+
+    def generate_prepended_classifier(self):
+        # the compiled predicate, with its virtual fields translated
+        pred_rule = self.pred.compile().rules[0]
+        pred = pred_rule.match
+        t_classifier = self.t_branch.compile()
+        f_classifier = self.f_branch.compile()
+        c = Classifier()
+        index = ShadowIndex()
+        for r in t_classifier.rules:
+            m = pred.intersect(r.match)
+            if m != drop and not index.covers(m):
+                c.rules.append(Rule(m, r.actions, [pred_rule, r],
+                                    "sequential"))
+                index.add(m)
+        # only rules as specific as the predicate on its exact fields can be
+        # covered by (the restricted true branch) rules
+        exact = [(f, v) for (f, v) in pred.map.iteritems()
+                 if not isinstance(v, IPv4Network)]
+        for r in f_classifier.rules:
+            fmap = getattr(r.match, 'map', {})
+            if (all(fmap.get(f) == v for (f, v) in exact) and
+                index.covers(r.match)):
+                continue
+            c.rules.append(r)
+        return c
+
     def __repr__(self):
         return "if\n%s\nthen\n%s\nelse\n%s" % (util.repr_plus([self.pred]),
                                                util.repr_plus([self.t_branch]),
@@ -287,3 +287,35 @@ def on_recompile_path_list(pol_id,policy):
 
     else:
         raise NotImplementedError
+
+def policy_snapshot(policy):
+    """
+    Return a policy which compiles like policy does now, and which later
+    updates of its dynamic sub-policies leave unchanged. Dynamic policies are
+    replaced by (a snapshot of) their current policy, and only the nodes above
+    them are rebuilt: the rest of the tree is shared with policy, together with
+    its compiled classifiers.
+    """
+    if isinstance(policy, if_):
+        (pred, t_branch, f_branch) = map(policy_snapshot, [policy.pred,
+                                                           policy.t_branch,
+                                                           policy.f_branch])
+        if (pred is policy.pred and t_branch is policy.t_branch and
+            f_branch is policy.f_branch):
+            return policy
+        return if_(pred, t_branch, f_branch)
+    elif isinstance(policy, CombinatorPolicy):
+        children = map(policy_snapshot, policy.policies)
+        if all(c is p for (c, p) in zip(children, policy.policies)):
+            return policy
+        return type(policy)(children)
+    elif (isinstance(policy, DerivedPolicy) and
+          type(policy).compile.im_func is DerivedPolicy.compile.im_func and
+          type(policy).generate_classifier.im_func is
+          DerivedPolicy.generate_classifier.im_func):
+        child = policy_snapshot(policy.policy)
+        if child is policy.policy and not isinstance(policy, DynamicPolicy):
+            return policy
+        return child
+    else:
+        return policy
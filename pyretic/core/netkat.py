@@ -28,11 +28,22 @@
 # permissions and limitations under the License.                               #
 ################################################################################
 
+import os
+import re
 import sys
+import time
+import hashlib
+import itertools
+import socket
 import logging
+import Queue
 import httplib
+import threading
+from contextlib import contextmanager
 from ipaddr import IPv4Network
+from pyretic.core import util
 from pyretic.core.network import *
+from pyretic.evaluations import stat
 import copy
 
 NETKAT_PORT = 9000
@@ -42,10 +53,234 @@ TEMP_INPUT = "/tmp/temp.in.json"
 TEMP_HEADERS = "/tmp/temp.headers.txt"
 TEMP_OUTPUT = "/tmp/temp.out.json"
 NETKAT_DEBUG_BUILD = False
+NETKAT_DEBUG_DUMP = False # write each compile's input and output to TEMP_*
+NETKAT_RETRIES = 5
+NETKAT_RETRY_BACKOFF = 0.1 # seconds before the first retry, then doubled
+NETKAT_CACHE = True
+NETKAT_CACHE_SIZE = 1000
+NETKAT_CACHE_DIR = None # also keep compiler outputs there, across restarts
+NETKAT_BLOCK_SIZE = 64 * 1024 # bytes of JSON sent or parsed at a time
+NETKAT_WORKERS = 6 # compilations sent to the compile servers at once
 VLAN_LENGTH=15 # length of vlan field in bits
 VLAN_NONE_VALUE=0xfff
 VLAN_PCP_NONE_VALUE=0x7
 
+class NetKATConnectionPool(object):
+    """
+    Keep-alive HTTP connections to the NetKAT compiler servers, kept per
+    server port. A connection is used by one compilation at a time, so
+    concurrent compilations to a port each open one, and connections are
+    dropped in processes forked from the one that opened them.
+    """
+    def __init__(self, host="localhost", retries=NETKAT_RETRIES,
+                 backoff=NETKAT_RETRY_BACKOFF):
+        self.host = host
+        self.retries = retries
+        self.backoff = backoff
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.idle = {} # port -> [HTTPConnection]
+
+    def get(self, port):
+        """ An idle connection to port, if any, else a new one; and whether
+        it was idle (so the server may have closed it meanwhile). """
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.idle = {}
+            conns = self.idle.get(port)
+            if conns:
+                return (conns.pop(), True)
+        return (httplib.HTTPConnection(self.host, port), False)
+
+    def put(self, port, conn):
+        with self.lock:
+            if self.pid == os.getpid():
+                self.idle.setdefault(port, []).append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.itervalues():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+
+    @contextmanager
+    def request(self, port, path, body, headers):
+        """ POST body to path on the server at port, retrying with
+        exponential backoff if the server can't be reached, and yield the
+        response, to be read within the block. body is a string, or an
+        iterable over its blocks (iterated again on retries), whose length
+        the headers must then give. """
+        (conn, resp) = self.send(port, path, body, headers)
+        try:
+            yield resp
+        except:
+            conn.close()
+            raise
+        if resp.isclosed() and not resp.will_close:
+            self.put(port, conn)
+        else:
+            conn.close()
+
+    def post(self, port, path, body, headers):
+        """ As request, returning the response and its body. """
+        with self.request(port, path, body, headers) as resp:
+            return (resp, resp.read())
+
+    def send(self, port, path, body, headers):
+        delay = self.backoff
+        attempt = 0
+        while True:
+            (conn, was_idle) = self.get(port)
+            try:
+                conn.putrequest("POST", path)
+                if isinstance(body, str):
+                    conn.putheader("Content-Length", str(len(body)))
+                for (h, v) in headers.iteritems():
+                    conn.putheader(h, v)
+                conn.endheaders()
+                for block in ([body] if isinstance(body, str) else body):
+                    conn.send(block)
+                return (conn, conn.getresponse())
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                if was_idle:
+                    continue # closed by the server while idle
+                if attempt == self.retries:
+                    raise RuntimeError("NetKAT compile server on port %d "
+                                       "failed: %s" % (port, str(e)))
+                netkat_backend.log().warning(
+                    "NetKAT compile server on port %d failed (%s), retrying"
+                    " in %.2fs" % (port, str(e), delay))
+                time.sleep(delay)
+                delay *= 2
+                attempt += 1
+
+class NetKATCache(object):
+    """
+    Compile server outputs keyed by the digest of the policy JSON they were
+    compiled from (see PolicyJSON), the switch count and whether the
+    compilation is multistage. Outputs are kept in memory, least
+    recently used first out, and in the directory, if set, where they
+    survive restarts; empty the directory when the compiler changes.
+    """
+    def __init__(self, maxsize=NETKAT_CACHE_SIZE, directory=NETKAT_CACHE_DIR):
+        self.memory = util.LRUCache(maxsize)
+        self.directory = directory
+        self.disk_hits = 0
+
+    @staticmethod
+    def key(digest, switch_cnt, multistage):
+        return hashlib.sha1('%s\n%s\n%s' % (switch_cnt, multistage,
+                                             digest)).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key):
+        out = self.memory.get(key)
+        if out is None and self.directory:
+            try:
+                with open(self.path(key)) as f:
+                    out = f.read()
+            except IOError:
+                return None
+            self.disk_hits += 1
+            self.memory.put(key, out)
+        return out
+
+    def put(self, key, out):
+        self.memory.put(key, out)
+        if self.directory:
+            if not os.path.isdir(self.directory):
+                try:
+                    os.makedirs(self.directory)
+                except OSError:
+                    pass # made by another compilation meanwhile
+            # write and rename, so that readers never see partial outputs
+            tmp = '%s.%d.%d' % (self.path(key), os.getpid(),
+                                threading.current_thread().ident)
+            write_to_file(out, tmp)
+            os.rename(tmp, self.path(key))
+
+    def clear(self):
+        """ Empty the memory (but not the directory). """
+        self.memory.clear()
+
+    def reset_stats(self):
+        self.memory.reset_stats()
+        self.disk_hits = 0
+
+    def stats(self):
+        res = self.memory.stats()
+        res['disk hits'] = self.disk_hits
+        return res
+
+class NetKATWorkers(object):
+    """
+    A persistent pool of threads compiling on the NetKAT compile servers
+    concurrently, so that while some wait for the compiler, others send
+    their policies or build classifiers from its outputs. Each worker
+    takes the next job as soon as it is done with its last one, and talks
+    to ports[i % len(ports)], its own connection to one of the servers.
+    """
+    def __init__(self, workers=NETKAT_WORKERS, ports=None):
+        self.workers = workers
+        self.ports = ports or [NETKAT_PORT]
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.pid = None
+
+    def start(self):
+        """ Start the workers, again in processes forked from the one that
+        started them. """
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.jobs = Queue.Queue()
+            for i in range(self.workers):
+                t = threading.Thread(target=self.work, args=(self.jobs, i))
+                t.daemon = True
+                t.start()
+
+    def work(self, jobs, worker):
+        while True:
+            (fn, item, results, i, done) = jobs.get()
+            port = self.local.port = self.ports[worker % len(self.ports)]
+            try:
+                results[i] = (True, fn(item, port))
+            except Exception:
+                results[i] = (False, sys.exc_info())
+            done.release()
+
+    def map(self, fn, items):
+        """ Return [fn(item, port) for item in items], port being that of
+        the worker running each call. Calls from workers are run right
+        away, in the calling worker. If calls raise, the first failed
+        item is logged and its exception raised again, once all the calls
+        are done. """
+        port = getattr(self.local, 'port', None)
+        if port is not None or self.workers <= 1 or len(items) <= 1:
+            port = port or self.ports[0]
+            return [fn(item, port) for item in items]
+        self.start()
+        results = [None] * len(items)
+        done = threading.Semaphore(0)
+        for (i, item) in enumerate(items):
+            self.jobs.put((fn, item, results, i, done))
+        for item in items:
+            done.acquire()
+        for (item, (ok, res)) in zip(items, results):
+            if not ok:
+                netkat_backend.log().error("Compiling %s failed: %s" %
+                                           (item, res[1]))
+                raise res[0], res[1], res[2]
+        return [res for (ok, res) in results]
+
 class netkat_backend(object):
     """
     Backend component to communicate with the NetKAT compiler server through
@@ -54,6 +289,10 @@ class netkat_backend(object):
     response. (Note that the Pyretic policy compilation routines are in
     pyretic/core/classifier.py.)
     """
+    pool = NetKATConnectionPool()
+    cache = NetKATCache()
+    workers = NetKATWorkers()
+
     @classmethod
     def log(cls):
         try:
@@ -122,50 +361,121 @@ class netkat_backend(object):
 
             return (output, time)
 
-        def httplib_channel_compilation(pol):
-            json_input = compile_to_netkat(pol)
-            write_to_file(json_input, TEMP_INPUT)
+        def httplib_channel_compilation(policy_json):
+            """ Stream the policy to the compile server, and build the
+            classifier from the server's rule tables as they arrive (unless
+            returning JSON). Returns the server's output, if it is needed
+            whole, the classifier and the compile time. """
+            if NETKAT_DEBUG_DUMP:
+                write_to_file(str(policy_json), TEMP_INPUT)
             if print_json:
                 cls.log().error("This is the JSON input:")
-                cls.log().error(str(json_input))
+                cls.log().error(str(policy_json))
             headers = {"Content-Type": "application/x-www-form-urlencoded",
-                       "Accept": "*/*"}
-            ctime = '0'
-            try:
-                # TODO: make the connection persist across compilations
-                conn = httplib.HTTPConnection("localhost", server_port)
-                conn.request("POST", NETKAT_DOM, json_input, headers)
-                resp = conn.getresponse()
+                       "Accept": "*/*",
+                       "Content-Length": str(policy_json.length)}
+            keep = NETKAT_CACHE or return_json or NETKAT_DEBUG_DUMP or print_json
+            output = []
+            def read_output(resp):
+                while True:
+                    block = resp.read(NETKAT_BLOCK_SIZE)
+                    if not block:
+                        return
+                    if keep:
+                        output.append(block)
+                    yield block
+            classifier = None
+            with cls.pool.request(server_port, NETKAT_DOM, policy_json,
+                                  headers) as resp:
                 ctime = resp.getheader(NETKAT_TIME_HDR, "-1")
-                netkat_out = resp.read()
+                if resp.status != httplib.OK:
+                    raise RuntimeError("NetKAT compile server on port %d "
+                                       "returned %d %s: %s" % (
+                                           server_port, resp.status,
+                                           resp.reason, resp.read()))
+                if return_json:
+                    output.append(resp.read())
+                else:
+                    classifier = switch_tables_to_classifier(
+                        iter_switch_tables(read_output(resp)), qdict,
+                        multistage, vlan_offset_nbits)
+            netkat_out = ''.join(output) if keep else None
+            if NETKAT_DEBUG_DUMP:
                 write_to_file(ctime, TEMP_HEADERS)
                 write_to_file(netkat_out, TEMP_OUTPUT)
-                if print_json:
-                    cls.log().error("This is the JSON output:")
-                    cls.log().error(netkat_out)
-                conn.close()
-            except Exception as e:
-                cls.log().error(("Compiling with the netkat compilation" +
-                                 " server failed. (%s, port %d") % (
-                                     str(e), server_port))
-                sys.exit(0)
-            return (netkat_out, ctime)
+            if print_json:
+                cls.log().error("This is the JSON output:")
+                cls.log().error(netkat_out)
+            return (netkat_out, classifier, ctime)
 
         pol = use_explicit_switches(pol)
-        qdict = {str(id(b)) : b for b in get_buckets_list(pol)}
+        policy_json = PolicyJSON(pol)
+        qdict = {policy_json.names[str(id(b))] : b
+                 for b in get_buckets_list(pol)
+                 if str(id(b)) in policy_json.names}
         vlan_offset_nbits = vlan_preprocess(pol)
-        # return curl_channel_compilation(pol)
-        (cls_json, ctime) = httplib_channel_compilation(pol)
-        if not return_json:
-            classifier = json_to_classifier(cls_json, qdict, multistage, vlan_offset_nbits)
-            return (classifier, ctime)
+        key = NetKATCache.key(policy_json.digest, switch_cnt, multistage)
+        cls_json = cls.cache.get(key) if NETKAT_CACHE else None
+        if cls_json is None:
+            # return curl_channel_compilation(pol)
+            (cls_json, classifier, ctime) = httplib_channel_compilation(
+                policy_json)
+            if NETKAT_CACHE:
+                cls.cache.put(key, cls_json)
         else:
+            classifier = None
+            ctime = '0' # no time spent in the compiler
+        if return_json:
             return (cls_json, ctime)
+        if classifier is None:
+            classifier = json_to_classifier(cls_json, qdict, multistage,
+                                            vlan_offset_nbits)
+        return (classifier, ctime)
+
+stat.Stat.register_cache('netkat', netkat_backend.cache)
 
 ##################### Helper functions #################
 
 import json
 
+class PolicyJSON(object):
+    """
+    The NetKAT JSON of a policy, generated block by block whenever it is
+    iterated over instead of being kept whole. Buckets and pipes are named
+    in names, from their ids to q0, q1... in order of appearance, so that
+    equal policies over other buckets give the same JSON, with the same
+    digest.
+    """
+    def __init__(self, pol):
+        self.pol = pol
+        self.names = {}
+        self.length = 0
+        sha = hashlib.sha1()
+        for block in self:
+            sha.update(block)
+            self.length += len(block)
+        self.digest = sha.hexdigest()
+
+    def __iter__(self):
+        return blocks(iter_netkat(self.pol, self.names))
+
+    def __str__(self):
+        return ''.join(self)
+
+def blocks(pieces, size=NETKAT_BLOCK_SIZE):
+    """ Join pieces of text into blocks of at least size characters. """
+    buf = []
+    n = 0
+    for piece in pieces:
+        buf.append(piece)
+        n += len(piece)
+        if n >= size:
+            yield ''.join(buf)
+            buf = []
+            n = 0
+    if buf:
+        yield ''.join(buf)
+
 def write_to_file(val, fname):
     f = open(fname, 'w')
     f.write(val)
@@ -463,6 +773,73 @@ def to_pol(p):
   else:
       raise TypeError("unknown policy %s %s" % (type(p), repr(p)))
 
+def iter_netkat(p, names):
+    """ Generate the JSON of to_pol(p) in pieces, streaming combinators
+    rather than building them, and naming buckets and pipes in names (see
+    PolicyJSON). """
+    from pyretic.core.language import (match, modify, identity, drop, negate,
+                                       union, parallel, intersection,
+                                       ingress_network, egress_network,
+                                       sequential, fwd, if_, FwdBucket,
+                                       DynamicPolicy, DerivedPolicy,
+                                       Controller, _modify, CountBucket)
+    from pyretic.lib.path import QuerySwitch
+    from pyretic.lib.netflow import NetflowBucket
+    def combine(kind, pols):
+        yield '{"type": "%s", "pols": [' % kind
+        for (i, pol) in enumerate(pols):
+            if i > 0:
+                yield ', '
+            for piece in pol:
+                yield piece
+        yield ']}'
+    def location(kind):
+        name = names.setdefault(str(id(p)), 'q%d' % len(names))
+        return json.dumps({"type" : "mod", "header" : "location",
+                           "value": {"type" : kind, "name" : name}})
+    recurse = lambda pol: iter_netkat(pol, names)
+
+    if (isinstance(p, match) or isinstance(p, negate) or
+        isinstance(p, union)):
+        yield json.dumps(mk_filter(to_pred(p)))
+    elif p is identity:
+        yield json.dumps(mk_filter({ "type": "true" }))
+    elif p is drop:
+        yield json.dumps(mk_filter({ "type": "false" }))
+    elif isinstance(p, modify):
+        yield json.dumps(mod_to_pred(_modify(**p.map).map))
+    elif isinstance(p, parallel):
+        for piece in combine("union", map(recurse, p.policies)):
+            yield piece
+    elif isinstance(p, intersection):
+        yield json.dumps(mk_filter(to_pred(p)))
+    elif isinstance(p, sequential):
+        for piece in combine("seq", map(recurse, p.policies)):
+            yield piece
+    elif isinstance(p, fwd):
+        yield json.dumps(mk_mod(mk_header("location", physical(p.outport))))
+    elif isinstance(p, if_):
+        c = to_pred(p.pred)
+        t = combine("seq", [[json.dumps(mk_filter(c))], recurse(p.t_branch)])
+        f = combine("seq", [[json.dumps(mk_filter({ "type": "neg",
+                                                    "pred": c }))],
+                            recurse(p.f_branch)])
+        for piece in combine("union", [t, f]):
+            yield piece
+    elif isinstance(p, FwdBucket) or p is Controller:
+        yield location("pipe")
+    elif isinstance(p, CountBucket) or isinstance(p, NetflowBucket):
+        yield location("query")
+    elif (isinstance(p, ingress_network) or isinstance(p, egress_network) or
+          isinstance(p, DynamicPolicy) or isinstance(p, DerivedPolicy)):
+        for piece in recurse(p.policy):
+            yield piece
+    elif isinstance(p, QuerySwitch):
+        for piece in recurse(cls_to_pol(p.netkat_compile()[0])):
+            yield piece
+    else:
+        yield json.dumps(to_pol(p))
+
 def cls_to_pol(c):
     from pyretic.core.language import parallel
     p = None
@@ -639,11 +1016,50 @@ def adjust_vlan_fields(mat, acts):
         new_acts.append(new_act)
     return set(new_acts)
         
+SWITCH_TABLE_SEPARATOR = re.compile(r'[\s\[\],]*')
+
+def iter_switch_tables(chunks):
+    """ Parse the compile server's output, a JSON list of rule tables, one
+    per switch, from successive chunks of its text, yielding each table as
+    soon as all of it has arrived. A table is only decoded again once its
+    text has doubled since the last try, which keeps parsing linear. """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pending = []
+    size = 0
+    need = 0
+    for chunk in itertools.chain(chunks, [None]):
+        if chunk is not None:
+            pending.append(chunk)
+            size += len(chunk)
+            if len(buf) + size < need:
+                continue
+        buf = ''.join([buf] + pending)
+        pending = []
+        size = 0
+        pos = 0
+        while True:
+            pos = SWITCH_TABLE_SEPARATOR.match(buf, pos).end()
+            if pos == len(buf):
+                break
+            try:
+                (table, pos) = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if chunk is None:
+                    raise
+                break
+            yield table
+        buf = buf[pos:]
+        need = 2 * len(buf)
+
 def json_to_classifier(fname, qdict, multistage, vlan_offset_nbits):
+    return switch_tables_to_classifier(json.loads(fname), qdict, multistage,
+                                       vlan_offset_nbits)
+
+def switch_tables_to_classifier(tables, qdict, multistage, vlan_offset_nbits):
     from pyretic.core.classifier import Rule, Classifier
-    data = json.loads(fname)
     rules = []
-    for sw_tbl in data:
+    for sw_tbl in tables:
         switch_id = sw_tbl['switch_id']
         for rule in sw_tbl['tbl']:
             prio = rule['priority']
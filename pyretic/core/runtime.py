@@ -36,11 +36,17 @@ from pyretic.core.packet import *
 from pyretic.core.classifier import get_rule_exact_match
 from pyretic.core.classifier import get_rule_derivation_tree
 from pyretic.core.classifier import get_rule_derivation_leaves
+from pyretic.core.classifier import DecisionTree
+from pyretic.core.event_loop import EventLoop, set_event_loop
 
 from multiprocessing import Process, Manager, RLock, Lock, Value, Queue, Condition
 import logging, sys, time
+import struct
 from datetime import datetime
 import copy
+import collections
+import itertools
+import threading
 
 TABLE_MISS_PRIORITY = 0
 TABLE_START_PRIORITY = 60000
@@ -48,9 +54,948 @@ STATS_REQUERY_THRESHOLD_SEC = 4
 NUM_PATH_TAGS = 32000
 DEFAULT_NX_TABLE_ID=1
 MAX_STAGES = 13 # max. for extensively multi-staged pipelines
+BARRIER_TIMEOUT_SEC = 5
+CONSISTENT_VLAN_TAGS = (4094, 4093) # version tags of consistent updates
+CONSISTENT_GC_DELAY_SEC = 1 # time for packets in flight to drain
+CONSISTENT_INSTALL_ATTEMPTS = 3 # of a new version, before aborting an update
+INSTALL_RATE_MIN_OPS = 100 # smallest batches whose install rate is recorded
+PACKET_IN_QUEUE_SIZE = 10000 # packet-ins waiting on the event loop
+PACKET_IN_HOLD_SEC = 0.5 # time for a reactive rule to reach its switch
+MICROFLOW_CACHE_SIZE = 10000 # packet evaluations cached by the runtime
 
 from pyretic.evaluations.stat import Stat
 
+class RuleStore(object):
+    """
+    The rules installed in one switch table, keyed by (switch, match,
+    priority), which identify a rule within the table. Rules whose match
+    isn't hashable are kept aside and searched linearly.
+    """
+    def __init__(self, rules=[]):
+        self.rules = collections.OrderedDict()
+        self.unkeyed = []
+        for rule in rules:
+            self.add(rule)
+
+    @staticmethod
+    def key(rule):
+        try:
+            k = (rule.mat.get('switch'), util.frozendict(rule.mat),
+                 rule.priority)
+            hash(k)
+        except TypeError:
+            return None
+        return k
+
+    def add(self, rule):
+        k = self.key(rule)
+        if k is None:
+            self.unkeyed.append(rule)
+        else:
+            self.rules.setdefault(k, rule)
+
+    def remove(self, rule):
+        k = self.key(rule)
+        if k is None:
+            self.unkeyed.remove(rule)
+        elif self.rules.get(k) is rule:
+            del self.rules[k]
+
+    def find(self, target):
+        """ Return the rule with the same match and priority as target, or
+        None. """
+        k = self.key(target)
+        if k is not None:
+            return self.rules.get(k)
+        for rule in self.unkeyed:
+            if target.mat == rule.mat and target.priority == rule.priority:
+                return rule
+        return None
+
+    def __iter__(self):
+        return itertools.chain(self.rules.itervalues(), self.unkeyed)
+
+    def __len__(self):
+        return len(self.rules) + len(self.unkeyed)
+
+class PriorityAllocator(object):
+    """
+    Assigns the priorities of the rules of one switch table, such that rules
+    keep their priority across classifier updates whenever their relative
+    order allows it. New rules are spread across the gap between their
+    neighbours. When a gap is too narrow, it is widened over neighbouring
+    rules, which are then re-spread along with the new ones (a rebalance).
+
+    Rules are identified by a hashable key, typically their match.
+    """
+    def __init__(self, low=TABLE_MISS_PRIORITY + 1, high=TABLE_START_PRIORITY):
+        self.low = low
+        self.high = high
+        self.priorities = {} # key -> priority
+        self.rebalances = 0
+
+    def _kept(self, old):
+        """ Return the indices of a longest subsequence of old priorities
+        which is strictly decreasing, skipping None. """
+        tails = []  # tails[l]: index ending the best subsequence of length l+1
+        prev = {}
+        for (i, p) in enumerate(old):
+            if p is None:
+                continue
+            (lo, hi) = (0, len(tails))
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if old[tails[mid]] > p:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            prev[i] = tails[lo - 1] if lo > 0 else None
+            if lo == len(tails):
+                tails.append(i)
+            else:
+                tails[lo] = i
+        kept = []
+        i = tails[-1] if tails else None
+        while i is not None:
+            kept.append(i)
+            i = prev[i]
+        kept.reverse()
+        return kept
+
+    def allocate(self, keys):
+        """
+        Return the priorities of rules with the given keys, listed from
+        highest to lowest priority. A key of None stands for a rule that
+        can't be identified across updates.
+        """
+        n = len(keys)
+        old = []
+        seen = set()
+        for k in keys:
+            if k is None or k in seen:
+                old.append(None)
+            else:
+                seen.add(k)
+                old.append(self.priorities.get(k))
+        if n > self.high - self.low + 1:
+            # more rules than priorities, nothing to keep
+            prios = [self.high - i for i in range(n)]
+        else:
+            kept = self._kept(old)
+            kept_set = set(kept)
+            prios = [p if i in kept_set else None for (i, p) in enumerate(old)]
+            bounds = [-1] + kept + [n]
+            def bound(i):
+                if i < 0:
+                    return self.high + 1
+                if i >= n:
+                    return self.low - 1
+                return prios[i]
+            j = 0
+            left = True
+            while j < len(bounds) - 1:
+                (a, b) = (bounds[j], bounds[j + 1])
+                if b - a == 1:
+                    j += 1
+                    continue
+                if bound(a) - bound(b) < b - a:
+                    self.rebalances += 1
+                while bound(a) - bound(b) < b - a:
+                    # widen the gap over a neighbouring rule, alternating sides
+                    can_left = j > 0
+                    can_right = j + 2 < len(bounds)
+                    if can_left and (left or not can_right):
+                        del bounds[j]
+                        j -= 1
+                    else:
+                        del bounds[j + 1]
+                    left = not left
+                    (a, b) = (bounds[j], bounds[j + 1])
+                (upper, lower) = (bound(a), bound(b))
+                for i in range(a + 1, b):
+                    prios[i] = upper - ((upper - lower) * (i - a)) // (b - a)
+                j += 1
+        self.priorities = {}
+        for (k, p) in zip(keys, prios):
+            if k is not None:
+                self.priorities.setdefault(k, p)
+        return prios
+
+class InstallFuture(object):
+    """
+    The completion of a flow table update across a set of switches. It is done
+    once each switch has confirmed the update with a barrier reply, or given
+    up on it (by leaving, or not replying in time). ok tells whether every
+    switch confirmed the update. Other units of work than switches (such as
+    the tables of UpdateQueue) are tracked the same way.
+    """
+    def __init__(self, switches):
+        self.pending = set(switches)
+        self.ok = True
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.callbacks = []
+        if not self.pending:
+            self.event.set()
+
+    def switch_done(self, switch, ok):
+        with self.lock:
+            if not switch in self.pending:
+                return
+            self.pending.remove(switch)
+            self.ok = self.ok and ok
+            if self.pending:
+                return
+            self.event.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def done(self):
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        """ Wait until the update is done, returning whether it is. """
+        self.event.wait(timeout)
+        return self.event.is_set()
+
+class InstallBatch(object):
+    """
+    The flow table operations waiting to be sent to one switch. Updates
+    queued while a batch waits are coalesced into it: an install or modify
+    supersedes the pending install or modify of the same rule, and a delete
+    cancels the pending install of a rule (unless the rule asks for a flow
+    removed notification, which its delete is then expected to produce).
+    A clear supersedes all pending operations on its table, and a reconcile
+    all pending operations as well as those queued after it.
+
+    Operations are ('install', rule), ('modify', rule), ('delete', rule),
+    ('clear', table_id) or ('reconcile', None), where rules are tuples as
+    built by ListedRule.
+    """
+    def __init__(self):
+        self.ops = [] # superseded operations are set to None
+        self.index = {} # (table_id, match, priority) -> position of last op
+        self.futures = []
+        self.reconcile = False
+
+    @staticmethod
+    def key(rule):
+        try:
+            k = (rule[5], util.frozendict(rule[0]), rule[1])
+            hash(k)
+        except TypeError:
+            return None
+        return k
+
+    def add(self, op):
+        (kind, arg) = op
+        if self.reconcile:
+            return
+        if kind == 'reconcile':
+            self.ops = [op]
+            self.index = {}
+            self.reconcile = True
+            return
+        if kind == 'clear':
+            for (i, old) in enumerate(self.ops):
+                if old is not None and self.table_id(old) == arg:
+                    self.ops[i] = None
+            self.index = {k : i for (k, i) in self.index.iteritems()
+                          if k[0] != arg}
+            self.ops.append(op)
+            return
+        k = self.key(arg)
+        i = self.index.get(k) if k is not None else None
+        prev = self.ops[i] if i is not None else None
+        if prev is not None:
+            (prev_kind, prev_rule) = prev
+            if kind == 'delete':
+                if prev_kind == 'install' and not prev_rule[4]:
+                    self.ops[i] = None
+                    del self.index[k]
+                    return
+                if prev_kind == 'modify':
+                    self.ops[i] = None
+            elif prev_kind in ['install', 'modify']:
+                self.ops[i] = None
+                if prev_kind == 'install':
+                    op = ('install', arg) # not on the switch yet
+        if k is not None:
+            self.index[k] = len(self.ops)
+        self.ops.append(op)
+
+    @staticmethod
+    def table_id(op):
+        (kind, arg) = op
+        return arg if kind == 'clear' else arg[5]
+
+    def __iter__(self):
+        return (op for op in self.ops if op is not None)
+
+FLOW_IGNORED_FIELDS = ['switch', 'vlan_total_stages', 'vlan_offset',
+                       'vlan_nbits']
+FLOW_ACTION_FIELDS = ['srcmac', 'dstmac', 'srcip', 'dstip', 'srcport',
+                      'dstport']
+
+def flow_value(field, value):
+    if field in ['srcmac', 'dstmac'] and isinstance(value, basestring):
+        return repr(MAC(value))
+    return str(value)
+
+def rule_flow_entry(rule):
+    """ Return the key and contents of the flow table entry which a rule
+    tuple, as built by ListedRule, becomes on a switch (see the OF client's
+    build_of_match and build_of_actions). """
+    (mat, priority, actions, cookie, notify, table_id) = rule
+    key = (table_id,
+           frozenset((k, flow_value(k, v)) for (k, v) in mat.iteritems()
+                     if not k in FLOW_IGNORED_FIELDS),
+           priority)
+    of_actions = []
+    for a in actions:
+        if not isinstance(a, dict):
+            continue
+        for f in FLOW_ACTION_FIELDS:
+            if f in a:
+                of_actions.append((f, flow_value(f, a[f])))
+        if 'vlan_id' in a:
+            if a['vlan_id'] is None:
+                of_actions.append(('strip_vlan_id', '0'))
+            else:
+                of_actions.append(('vlan_id', str(a['vlan_id'])))
+        if a.get('vlan_pcp') is not None:
+            of_actions.append(('vlan_pcp', str(a['vlan_pcp'])))
+        outport = a['port']
+        if mat.get('port') is not None and outport == mat['port']:
+            outport = OFPP_IN_PORT
+        of_actions.append(('output', str(outport)))
+    return (key, (tuple(of_actions), cookie))
+
+def stat_match(flow_stat):
+    """ The match of a flow stat, with IP prefixes in the form the runtime
+    uses. """
+    mat = dict(flow_stat['match'])
+    for field in ['srcip', 'dstip']:
+        if field in mat:
+            prefixlen = flow_stat.get(field + '_prefixlen', 32)
+            mat[field] = str(mat[field])
+            if prefixlen < 32:
+                mat[field] += '/%d' % prefixlen
+    return mat
+
+def stat_flow_entry(flow_stat):
+    """ Return the key and contents of a flow table entry reported in a flow
+    stats reply, comparable to those returned by rule_flow_entry. """
+    key = (flow_stat['table_id'],
+           frozenset((k, flow_value(k, v))
+                     for (k, v) in stat_match(flow_stat).iteritems()),
+           flow_stat['priority'])
+    of_actions = tuple((k, flow_value(k, v))
+                       for a in flow_stat.get('actions', [])
+                       for (k, v) in a.iteritems())
+    return (key, (of_actions, flow_stat['cookie']))
+
+class InstallScheduler(object):
+    """
+    Sends flow table updates to switches, through a long-lived worker thread
+    per switch. Each worker sends the batch of operations pending for its
+    switch followed by a barrier, as one install_batch message, and waits for
+    the barrier reply before sending the next batch, so updates submitted
+    meanwhile are coalesced. The rate at which each switch applied its last
+    large batch is kept in install_rates.
+
+    If the OF client never replies to barriers, workers stop waiting for
+    replies after the first timeout, and futures complete with ok False.
+
+    With reconcile set, the scheduler keeps a shadow of the flow table of
+    each switch, as the submitted operations leave it. The first batch for
+    a switch which (re)joined is replaced by a reconciliation: the switch's
+    flow table is read with a flow stats request, and only the entries
+    missing from it, extra or different are installed or deleted.
+    """
+    def __init__(self, runtime, barrier_timeout=BARRIER_TIMEOUT_SEC,
+                 reconcile=False):
+        self.runtime = runtime
+        self.barrier_timeout = barrier_timeout
+        self.reconciling = reconcile
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.pending = {} # switch -> InstallBatch
+        self.workers = {} # switch -> thread
+        self.barriers = {} # (switch, xid) -> threading.Event
+        self.xids = itertools.count(1)
+        self.replies_seen = False
+        self.replies_missing = False
+        self.batches_sent = 0
+        self.ops_sent = 0
+        self.shadows = {} # switch -> {InstallBatch.key : rule}
+        self.unsynced = set() # switches to reconcile on their next batch
+        self.parted = set()
+        self.stats_replies = {} # switch -> [threading.Event, flow stats]
+        self.reconcile_stats = {} # switch -> stats of its last reconcile
+        self.install_rates = {} # switch -> operations per second
+
+    def submit(self, switch_ops):
+        """ Queue operations for each switch in the dictionary switch_ops, and
+        return an InstallFuture for their completion. Operations on switches
+        which left only update their shadows. """
+        switch_ops = {s : ops for (s, ops) in switch_ops.iteritems() if ops}
+        with self.lock:
+            if self.reconciling:
+                for (s, ops) in switch_ops.iteritems():
+                    self.update_shadow(s, ops)
+            switch_ops = {s : ops for (s, ops) in switch_ops.iteritems()
+                          if not s in self.parted}
+            future = InstallFuture(switch_ops.keys())
+            for (s, ops) in switch_ops.iteritems():
+                batch = self.pending.get(s)
+                if batch is None:
+                    batch = self.pending[s] = InstallBatch()
+                if s in self.unsynced:
+                    self.unsynced.discard(s)
+                    ops = [('reconcile', None)]
+                for op in ops:
+                    batch.add(op)
+                batch.futures.append(future)
+                if not s in self.workers:
+                    worker = threading.Thread(target=self.run, args=(s,))
+                    worker.daemon = True
+                    self.workers[s] = worker
+                    worker.start()
+            self.cond.notify_all()
+        return future
+
+    def update_shadow(self, switch, ops):
+        shadow = self.shadows.setdefault(switch, {})
+        for (kind, arg) in ops:
+            if kind == 'clear':
+                for k in [k for k in shadow if k[0] == arg]:
+                    del shadow[k]
+                for rule in self.runtime.default_rules(switch, arg):
+                    shadow[InstallBatch.key(rule)] = rule
+                continue
+            k = InstallBatch.key(arg)
+            if k is None:
+                continue
+            if kind == 'delete':
+                shadow.pop(k, None)
+            else:
+                shadow[k] = arg
+
+    def switch_join(self, switch):
+        """ Reconcile the flow table of a switch which (re)joined with its
+        shadow, on the next batch submitted for it. """
+        with self.lock:
+            self.parted.discard(switch)
+            if self.reconciling:
+                self.unsynced.add(switch)
+
+    def switch_part(self, switch):
+        """ Stop the worker of a switch which left, abandoning its pending
+        operations. Its shadow is kept, for reconciling when it joins
+        again. """
+        with self.lock:
+            self.parted.add(switch)
+            self.unsynced.discard(switch)
+            batch = self.pending.pop(switch, None)
+            self.workers.pop(switch, None)
+            for ((s, xid), event) in self.barriers.items():
+                if s == switch:
+                    event.set()
+            waiting = self.stats_replies.get(switch)
+            if waiting is not None:
+                waiting[0].set()
+            self.cond.notify_all()
+        if batch is not None:
+            for future in batch.futures:
+                future.switch_done(switch, False)
+
+    def barrier_reply(self, switch, xid):
+        with self.lock:
+            self.replies_seen = True
+            event = self.barriers.get((switch, xid))
+        if event is not None:
+            event.set()
+
+    def flow_stats_reply(self, switch, flow_stats):
+        with self.lock:
+            waiting = self.stats_replies.get(switch)
+            if waiting is not None:
+                waiting[1] = flow_stats
+                waiting[0].set()
+
+    def run(self, switch):
+        worker = threading.current_thread()
+        while True:
+            with self.lock:
+                while (self.workers.get(switch) is worker and
+                       not switch in self.pending):
+                    self.cond.wait()
+                if self.workers.get(switch) is not worker:
+                    return
+                batch = self.pending.pop(switch)
+                xid = next(self.xids)
+                event = self.barriers[(switch, xid)] = threading.Event()
+            try:
+                if batch.reconcile:
+                    batch = self.reconcile(switch, batch.futures)
+                start = time.time()
+                self.send(switch, batch, xid)
+                ok = self.wait_barrier(switch, event)
+                if ok:
+                    self.record_rate(switch, len(list(batch)),
+                                     time.time() - start)
+            except Exception:
+                self.runtime.log.exception(
+                    'failed to install rules on switch %s' % switch)
+                ok = False
+            with self.lock:
+                del self.barriers[(switch, xid)]
+                ok = ok and self.workers.get(switch) is worker
+            for future in batch.futures:
+                future.switch_done(switch, ok)
+
+    def send(self, switch, batch, xid):
+        runtime = self.runtime
+        with runtime.backend.install_batch(switch):
+            for (kind, arg) in batch:
+                if kind == 'clear':
+                    runtime.send_barrier(switch)
+                    runtime.send_clear(switch, arg)
+                    runtime.send_barrier(switch)
+                    runtime.install_defaults(switch, arg)
+                elif kind == 'delete':
+                    runtime.delete_rule((arg[0], arg[1]))
+                elif kind == 'install':
+                    runtime.install_rule(arg)
+                else:
+                    runtime.modify_rule(arg)
+                self.ops_sent += 1
+            runtime.send_barrier(switch, xid)
+        self.batches_sent += 1
+        runtime.log.debug('sent %d operations to switch %s' %
+                          (len(list(batch)), switch))
+
+    def record_rate(self, switch, num_ops, duration):
+        """ Record the rate at which switch applied a batch of num_ops
+        operations, from sending it to the barrier reply. Batches too small
+        to tell are ignored. """
+        if num_ops < INSTALL_RATE_MIN_OPS or duration <= 0:
+            return
+        rate = num_ops / duration
+        with self.lock:
+            self.install_rates[switch] = rate
+        self.runtime.log.info('switch %s applied %d operations at %.0f/s' %
+                              (switch, num_ops, rate))
+
+    def reconcile(self, switch, futures):
+        """ Return the batch of operations bringing the flow table of switch
+        in line with its shadow. """
+        start = time.time()
+        waiting = [threading.Event(), None]
+        with self.lock:
+            shadow = dict(self.shadows.get(switch, {}))
+            self.stats_replies[switch] = waiting
+        try:
+            self.runtime.request_flow_stats(switch)
+            waiting[0].wait(self.barrier_timeout)
+        finally:
+            with self.lock:
+                self.stats_replies.pop(switch, None)
+        batch = InstallBatch()
+        batch.futures = futures
+        flow_stats = waiting[1]
+        if flow_stats is None:
+            self.runtime.log.warning('no flow stats from switch %s, '
+                                     'reinstalling its flow table' % switch)
+            for t in sorted(set(k[0] for k in shadow)):
+                batch.add(('clear', t))
+            for rule in shadow.itervalues():
+                batch.add(('install', rule))
+            return batch
+        expected = {}
+        for rule in shadow.itervalues():
+            (k, entry) = rule_flow_entry(rule)
+            expected[k] = (entry, rule)
+        found = set()
+        (extra, different) = (0, 0)
+        for flow_stat in flow_stats:
+            (k, entry) = stat_flow_entry(flow_stat)
+            found.add(k)
+            if not k in expected:
+                mat = dict(stat_match(flow_stat), switch=switch)
+                if 'vlan_id' in mat:
+                    mat['vlan_total_stages'] = 1
+                batch.add(('delete', (mat, flow_stat['priority'], [],
+                                      flow_stat['cookie'], False,
+                                      flow_stat['table_id'])))
+                extra += 1
+            elif expected[k][0] != entry:
+                batch.add(('install', expected[k][1]))
+                different += 1
+        missing = 0
+        for (k, (entry, rule)) in expected.iteritems():
+            if not k in found:
+                batch.add(('install', rule))
+                missing += 1
+        stats = {'duration' : time.time() - start, 'missing' : missing,
+                 'extra' : extra, 'different' : different}
+        with self.lock:
+            self.reconcile_stats[switch] = stats
+        self.runtime.log.info('reconciled switch %s in %f s: %d missing, '
+                              '%d extra and %d different entries' %
+                              (switch, stats['duration'], missing, extra,
+                               different))
+        return batch
+
+    def wait_barrier(self, switch, event):
+        if self.replies_missing and not self.replies_seen:
+            return False
+        if event.wait(self.barrier_timeout):
+            return True
+        if not self.replies_seen:
+            self.replies_missing = True
+            self.runtime.log.warning('no barrier replies from the OF client, '
+                                     'not waiting for them anymore')
+        else:
+            self.runtime.log.warning('barrier reply from switch %s timed out'
+                                     % switch)
+        return False
+
+class UpdateQueue(object):
+    """
+    Runs updates one at a time on a worker thread. An update is a function
+    returning whether it succeeded; one submitted while an earlier update
+    with the same key is still waiting replaces it, and the futures of both
+    complete when it has run.
+    """
+    def __init__(self, log):
+        self.log = log
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.pending = collections.OrderedDict() # key -> (update, futures)
+        self.worker = None
+
+    def submit(self, key, update):
+        future = InstallFuture([key])
+        with self.lock:
+            (_, futures) = self.pending.pop(key, (None, []))
+            self.pending[key] = (update, futures + [future])
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.run)
+                self.worker.daemon = True
+                self.worker.start()
+            self.cond.notify()
+        return future
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.cond.wait()
+                (key, (update, futures)) = self.pending.popitem(last=False)
+            try:
+                ok = update()
+            except Exception:
+                self.log.exception('update of %s failed' % str(key))
+                ok = False
+            for future in futures:
+                future.switch_done(key, ok)
+
+def microflow_transforms(pkt, output):
+    """ The header changes turning pkt into each of the output packets, as
+    arguments of Packet.modifymany. """
+    transforms = []
+    for out in output:
+        changes = {k : v for (k, v) in out.header.iteritems()
+                   if pkt.header.get(k) != v}
+        changes.update((k, None) for k in pkt.header if not k in out.header)
+        transforms.append(changes)
+    return transforms
+
+def same_actions(acts1, acts2):
+    """ Whether two rules' action lists or sets are equal (modify actions
+    compare equal by their maps but don't hash alike). """
+    (acts1, acts2) = (list(acts1), list(acts2))
+    return (all(a in acts2 for a in acts1) and
+            all(a in acts1 for a in acts2))
+
+def wildcard_region(entries, entry, pkt):
+    """ The match of a wildcard rule for pkt, given the DecisionTree entries
+    of a compiled policy and entry, the first of them matching pkt: the
+    packets at pkt's switch in entry's match, narrowed on pkt's header
+    values until it overlaps no earlier entry with other actions, so that
+    the policy handles all of them as it handles pkt. None if an earlier
+    entry can't be excluded this way, or the match isn't one a switch can
+    install. """
+    region = match(switch=pkt['switch'])
+    if entry[1] is not None:
+        region = region.intersect(entry[1])
+    for e in entries:
+        if e is entry:
+            break
+        if e[1] is None or (not e[3] and same_actions(e[0].actions,
+                                                      entry[0].actions)):
+            continue
+        if region.intersect(e[1]) == drop:
+            continue
+        narrowed = None
+        for (f, v) in sorted(e[1].map.items()):
+            pv = pkt.header.get(f)
+            if v is None or pv is None:
+                continue
+            if f in ['srcip', 'dstip']:
+                if not util.string_to_IP(pv) in v:
+                    narrowed = '%s/%d' % (pv, v.prefixlen)
+                    break
+            elif pv != v:
+                narrowed = pv
+                break
+        if narrowed is None:
+            return None
+        region = region.intersect(match(**{f : narrowed}))
+    if not set(region.map.keys()) <= set(basic_headers + location_headers):
+        return None
+    return region
+
+def packet_flow_key(packet):
+    """ The switch, port and header fields of a concrete packet which a
+    reactive0 rule matches (see match_on_all_fields), read from its raw bytes
+    without parsing it; None for packets too short to tell. """
+    raw = packet['raw']
+    off = 12
+    while raw[off:off+2] == '\x81\x00': # VLAN tags
+        off += 4
+    ethtype = raw[off:off+2]
+    off += 2
+    if len(raw) < off:
+        return None
+    fields = raw[:off]
+    if ethtype == '\x08\x00' and len(raw) >= off + 20:
+        ihl = (ord(raw[off]) & 0xf) * 4
+        fields += raw[off+1] + raw[off+9] + raw[off+12:off+20]
+        if raw[off+9] in '\x06\x11': # TCP, UDP ports
+            fields += raw[off+ihl:off+ihl+4]
+    elif ethtype == '\x08\x06':
+        fields += raw[off+6:off+8] + raw[off+14:off+18] + raw[off+24:off+28]
+    return (packet['switch'], packet['port'], fields)
+
+def is_discovery_packet(packet):
+    return packet['raw'][12:14] == struct.pack('!H', LLDP_TYPE)
+
+def version_tag(new_rules, version, interior_ports):
+    """Specialize rules (ListedRules, see Runtime.install_classifier) to
+    packets tagged with a version, carried in the VLAN tag. Packets are tagged
+    when they are forwarded to another switch, by rules matching untagged
+    packets (which enter the network at this switch); rules matching tagged
+    packets handle packets which entered elsewhere, and untag them on their
+    way out of the network or to the controller. The rules of the two
+    versions live in separate priority bands, the first version in the upper
+    one.
+
+    :param version: 0 or 1, indexing CONSISTENT_VLAN_TAGS
+    :param interior_ports: switch to the set of its ports linked to
+    other switches
+    """
+    tag = CONSISTENT_VLAN_TAGS[version]
+    band = (TABLE_START_PRIORITY - TABLE_MISS_PRIORITY) // 2
+    tagged_rules = []
+    for r in new_rules:
+        acts = [a for a in r.actions if isinstance(a, dict)]
+        if ('vlan_id' in r.mat or 'vlan_pcp' in r.mat or
+            any('vlan_id' in a or 'vlan_pcp' in a for a in acts)):
+            raise TypeError('Consistent updates tag packets with '
+                            'VLANs, which the policy may not use',
+                            str(r))
+        if r.priority <= TABLE_START_PRIORITY - band:
+            raise TypeError('Too many rules for consistent updates',
+                            str(r))
+        ports = interior_ports.get(r.mat['switch'], set())
+        inport = r.mat.get('port')
+        for inside in [False, True]:
+            if inside and inport is not None and not inport in ports:
+                continue
+            mat = dict(r.mat, vlan_id=tag if inside else 0xffff,
+                       vlan_total_stages=1)
+            new_acts = []
+            for a in r.actions:
+                if isinstance(a, dict):
+                    outport = a['port']
+                    if (outport in ports or
+                        (outport == OFPP_IN_PORT and inside)):
+                        a = dict(a, vlan_id=tag, vlan_pcp=0,
+                                 vlan_total_stages=1)
+                    else:
+                        a = dict(a, vlan_id=None)
+                new_acts.append(a)
+            tagged = copy.copy(r)
+            tagged.mat = mat
+            tagged.priority = r.priority - version * band
+            tagged.actions = new_acts
+            tagged.notify = False
+            tagged_rules.append(tagged)
+    return tagged_rules
+
+def consistent_update_phases(run, to_add, to_delete, flip,
+                             attempts=CONSISTENT_INSTALL_ATTEMPTS,
+                             gc_delay=CONSISTENT_GC_DELAY_SEC):
+    """Run the phases of a consistent update, given the version tagged rules
+    (see version_tag) to add and delete. run(kind, rules, descending) sends
+    the installs or deletes of rules, in order of priority, to all switches
+    and returns whether all of them acknowledged them.
+
+    1. The new version's rules for tagged packets are installed, up to
+       attempts times until acknowledged. If they never are, they are
+       deleted again, and the update aborted.
+    2. flip() is called and the rules for untagged packets, which stamp the
+       version onto packets, are replaced: the new ones installed highest
+       priority first, the old ones deleted lowest priority first.
+    3. After gc_delay seconds, for packets stamped with the old version to
+       drain, the old version's rules for tagged packets are deleted.
+
+    Return whether phases 2 and 3 were acknowledged, and the duration of
+    each phase, or None if the update was aborted.
+    """
+    def untagged(rule):
+        return rule[0]['vlan_id'] == 0xffff
+    start = time.time()
+    tagged_add = filter(lambda r: not untagged(r), to_add)
+    for attempt in range(attempts):
+        if run('install', tagged_add, True):
+            break
+    else:
+        run('delete', tagged_add, False)
+        return (False, None)
+    installed = time.time()
+    flip()
+    ok = run('install', filter(untagged, to_add), True)
+    ok = run('delete', filter(untagged, to_delete), False) and ok
+    flipped = time.time()
+    time.sleep(gc_delay)
+    ok = run('delete', filter(lambda r: not untagged(r), to_delete),
+             False) and ok
+    collected = time.time()
+    return (ok, (installed - start, flipped - installed,
+                 collected - flipped - gc_delay))
+
+class PacketAdmission(object):
+    """
+    Decides which packet-ins the runtime evaluates. With a rate, each switch
+    gets a token bucket, refilled at rate packet-ins per second up to burst
+    (rate by default), and its packet-ins are dropped while it is empty.
+    Discovery packets are always admitted.
+
+    With coalesce set, only the first packet-in of a flow is evaluated. The
+    packet-ins of the flow arriving while it is handled are held, and passed
+    to forward with its decision once it is released; those arriving less
+    than hold seconds later (while the reactive rule it installs reaches the
+    switch) are passed to forward straight away.
+
+    Admitted packet-ins are counted per switch in admitted, those forwarded
+    with the decision of another in forwarded, and drops per switch and
+    reason in dropped.
+    """
+    def __init__(self, rate=None, burst=None, coalesce=False,
+                 hold=PACKET_IN_HOLD_SEC, forward=None):
+        self.rate = rate
+        self.burst = rate if burst is None else burst
+        self.coalesce = coalesce
+        self.hold = hold
+        self.forward = forward
+        self.lock = threading.Lock()
+        self.buckets = {} # switch -> [tokens, last refill time]
+        self.in_flight = {} # flow key -> [(packet, cookie)] held
+        self.decided = {} # flow key -> (expiry time, decision)
+        self.admitted = collections.Counter() # switch -> packet-ins
+        self.forwarded = collections.Counter() # switch -> packet-ins
+        self.dropped = collections.defaultdict(collections.Counter)
+
+    def flow_key(self, packet, cookie):
+        key = packet_flow_key(packet)
+        return None if key is None else (key, cookie)
+
+    def admit(self, packet, cookie=None):
+        """ Whether the packet-in is to be handled. Packet-ins of a coalesced
+        flow are held or forwarded instead. """
+        switch = packet['switch']
+        if is_discovery_packet(packet):
+            with self.lock:
+                self.admitted[switch] += 1
+            return True
+        now = time.time()
+        key = self.flow_key(packet, cookie) if self.coalesce else None
+        with self.lock:
+            decided = None
+            if key is not None:
+                held = self.in_flight.get(key)
+                if held is not None:
+                    held.append((packet, cookie))
+                    self.forwarded[switch] += 1
+                    return False
+                decided = self.decided.get(key)
+                if decided is not None and decided[0] <= now:
+                    decided = None
+                    del self.decided[key]
+            if decided is None:
+                if self.rate is not None:
+                    bucket = self.buckets.get(switch)
+                    if bucket is None:
+                        bucket = self.buckets[switch] = [self.burst, now]
+                    bucket[0] = min(self.burst,
+                                    bucket[0] + (now - bucket[1]) * self.rate)
+                    bucket[1] = now
+                    if bucket[0] < 1:
+                        self.dropped[switch]['rate limited'] += 1
+                        return False
+                    bucket[0] -= 1
+                if key is not None:
+                    self.in_flight[key] = []
+                self.admitted[switch] += 1
+                return True
+            self.forwarded[switch] += 1
+        self.forward(packet, cookie, decided[1])
+        return False
+
+    def drop(self, packet, reason, cookie=None):
+        """ Count a packet-in admitted, but dropped later on, together with
+        the packet-ins held for its flow. """
+        with self.lock:
+            self.admitted[packet['switch']] -= 1
+            self.dropped[packet['switch']][reason] += 1
+            if self.coalesce:
+                held = self.in_flight.pop(self.flow_key(packet, cookie), [])
+                for (p, c) in held:
+                    self.forwarded[p['switch']] -= 1
+                    self.dropped[p['switch']][reason] += 1
+
+    def release(self, packet, decision, cookie=None):
+        """ Forward the packet-ins held for the flow of the handled packet,
+        and those arriving in the next hold seconds, with its decision: the
+        header changes of its output packets (see microflow_transforms), or
+        None to have them interpreted. """
+        if not self.coalesce:
+            return
+        key = self.flow_key(packet, cookie)
+        now = time.time()
+        with self.lock:
+            held = self.in_flight.pop(key, [])
+            if decision is not None:
+                self.decided[key] = (now + self.hold, decision)
+            if len(self.decided) > 2 * PACKET_IN_QUEUE_SIZE:
+                self.decided = {k : d for (k, d) in self.decided.iteritems()
+                                if d[0] > now}
+        for (p, c) in held:
+            self.forward(p, c, decision)
+
 class Runtime(object):
     """
     The Runtime system.  Includes packet handling, compilation to OF switches,
@@ -62,7 +1007,11 @@ class Runtime(object):
     :type main: pyretic program (.py)
     :param kwargs: arguments to main
     :type kwargs: dict from strings to values
-    :param mode: one of interpreted/i, reactive0/r0, proactive0/p0
+    :param mode: one of interpreted/i, reactive0/r0, reactive1/r1 (wildcard
+      rules found from the compiled policy), proactive0/p0,
+      proactive1/p1 (incremental updates), proactive2/p2 (incremental
+      updates keeping rule priorities stable) or proactive3/p3 (per-packet
+      consistent two-phase updates)
     :type mode: string
     :param verbosity: one of low, normal, high, please-make-it-stop
     :type verbosity: string
@@ -70,23 +1019,52 @@ class Runtime(object):
     :type use_nx: boolean
     :param pipeline: for multi-stage switches, a pipeline configuration
     :type pipeline: pipeline_config
+    :param use_fdd_compiler: compile policies natively through forwarding
+      decision diagrams (FDDs) rather than the classifier algebra (implies
+      use_pyretic)
+    :type use_fdd_compiler: boolean
+    :param eval_engine: how packets are evaluated at the controller: by
+      walking the policy (interpreter) or against a decision tree built from
+      the compiled policy (compiled)
+    :type eval_engine: string
+    :param event_loop: handle OpenFlow events and timers on an event loop,
+      packet-ins on a second one with a bounded queue, and recompile in the
+      background, instead of on the backend's thread
+    :type event_loop: boolean
+    :param packet_in_rate: packet-ins per second admitted from each switch,
+      the others being dropped; no limit by default
+    :type packet_in_rate: float
     """
     
     
     def __init__(self, backend, main, path_main, kwargs, mode='interpreted',
                  verbosity='normal',use_nx=False, pipeline="default_pipeline",
                  opt_flags=None, use_pyretic=False, use_fdd=False, offline=False,
-                 write_log='rt_log.txt', restart_frenetic=False):
+                 write_log='rt_log.txt', restart_frenetic=False,
+                 eval_engine='interpreter', use_fdd_compiler=False,
+                 event_loop=False, packet_in_rate=None):
         self.verbosity = self.verbosity_numeric(verbosity)
         self.use_nx = use_nx
         self.pipeline = pipeline
         self.log = logging.getLogger('%s.Runtime' % __name__)
         self.setup_write_logging(write_log)
+        self.event_loop = None
+        self.packet_loop = None
+        self.pending_network_update = False
+        self.background_network_update = False
+        if event_loop and not offline:
+            # set before main runs, for the timers of the policies it builds
+            self.event_loop = EventLoop('runtime', log=self.log).start()
+            self.packet_loop = EventLoop('packet-in',
+                                         maxsize=PACKET_IN_QUEUE_SIZE,
+                                         log=self.log).start()
+            set_event_loop(self.event_loop)
         self.network = ConcreteNetwork(self)
         self.prev_network = self.network.copy()
         self.forwarding = main(**kwargs)
         self.get_subpol_stats = True # TODO: make cmdline option to pyretic.py
-        self.use_pyretic_compiler = use_pyretic
+        self.use_pyretic_compiler = use_pyretic or use_fdd_compiler
+        self.use_fdd_compiler = use_fdd_compiler
 
         """ Set runtime flags for specific optimizations. """
         self.set_optimization_opts(path_main, opt_flags)
@@ -104,6 +1082,7 @@ class Runtime(object):
         initialized, which denotes the final network policy that is installed on
         devices.
         """
+        self.policy_version = 0 # bumped by every policy change
         self.set_policy_map(path_main)
 
         """ If subpolicy stats are required, compute them. """
@@ -111,12 +1090,25 @@ class Runtime(object):
             self.get_subpolicy_compile_stats(path_main, restart_frenetic)
 
         self.mode = mode
+        self.eval_engine = eval_engine
+        self.compiled_evals = {} # id(policy) -> (policy, classifier, tree)
+        # (table, packet headers) -> header changes of its output packets
+        self.microflow_cache = util.LRUCache(MICROFLOW_CACHE_SIZE)
+        Stat.register_cache('microflow', self.microflow_cache)
         if not offline:
             self.backend = backend
             self.backend.runtime = self
+            self.backend.event_loop = self.event_loop
+            self.admission = PacketAdmission(
+                rate=packet_in_rate,
+                coalesce=(mode in ['reactive0', 'reactive1']),
+                forward=self.forward_packet_in)
             self.policy_lock = RLock()
             self.network_lock = Lock()
-            self.switch_lock = Lock()
+            self.install_scheduler = InstallScheduler(self,
+                                                      reconcile=not use_nx)
+            self.update_queue = UpdateQueue(self.log)
+            self.consistent_versions = {} # table_id -> installed version tag
             self.vlan_to_extended_values_db = {}
             self.extended_values_to_vlan_db = {}
             self.extended_values_lock = RLock()
@@ -134,7 +1126,8 @@ class Runtime(object):
             self.manager = Manager()
             self.old_rules_lock = Lock()
             # self.old_rules = self.manager.list() # not multiprocess state anymore!
-            self.old_rules = []
+            self.old_rules = {} # table_id -> RuleStore
+            self.priority_allocators = {} # (table_id, switch) -> allocator
             self.update_rules_lock = Lock()
             self.update_buckets_lock = Lock()
             self.classifier_version_no = 0
@@ -299,7 +1292,7 @@ class Runtime(object):
         if sketch:
             for s in sketch:
                 if self.use_pyretic_compiler:
-                    s[0].compile()
+                    self.pyretic_compile(s[0])
                 else:
                     self.write_log.info("starting to compile %s" % s[0].name)
                     if restart_frenetic:
@@ -329,6 +1322,24 @@ class Runtime(object):
 # PACKET INTERPRETER 
 ######################
 
+    def admit_packet_in(self, concrete_pkt, cookie):
+        """
+        Pass a packet-in admitted by the admission stage on to the packet
+        interpreter: on the packet-in event loop if there is one, or on its
+        control event loop for discovery packets, so that they don't wait
+        behind data packets.
+        """
+        if not self.admission.admit(concrete_pkt, cookie):
+            return
+        if self.packet_loop is None:
+            self.handle_packet_in(concrete_pkt, cookie)
+        elif is_discovery_packet(concrete_pkt):
+            self.event_loop.call_soon(self.handle_packet_in, concrete_pkt,
+                                      cookie)
+        elif not self.packet_loop.call_soon(self.handle_packet_in,
+                                            concrete_pkt, cookie):
+            self.admission.drop(concrete_pkt, 'queue full', cookie)
+
     def handle_packet_in(self, concrete_pkt, cookie):
         """
         The packet interpreter.
@@ -336,6 +1347,27 @@ class Runtime(object):
         :param concrete_packet: the packet to be interpreted.
         :type limit: payload of an OpenFlow packet_in message.
         """
+        try:
+            decision = self.interpret_packet_in(concrete_pkt, cookie)
+        except:
+            self.admission.drop(concrete_pkt, 'failed', cookie)
+            raise
+        self.admission.release(concrete_pkt, decision, cookie)
+
+    def forward_packet_in(self, concrete_pkt, cookie, decision):
+        """
+        Send a packet-in coalesced with another out as the policy handled
+        that one: through the header changes of its decision, or by
+        interpreting it if it reached queries (no decision).
+        """
+        if decision is None:
+            self.interpret_packet_in(concrete_pkt, cookie)
+            return
+        pyretic_pkt = self.concrete2pyretic(concrete_pkt)
+        for t in decision:
+            self.send_packet(self.pyretic2concrete(pyretic_pkt.modifymany(t)))
+
+    def interpret_packet_in(self, concrete_pkt, cookie):
         start_time = time.time()
         self.num_packet_ins += 1
         # TODO: revert to debug logging
@@ -346,15 +1378,36 @@ class Runtime(object):
             # Set policy to be used for evaluation, depending on whether
             # multiple tables are enabled, and the table packet is coming from.
             eff_policy = self.policy
+            table = None
             if self.use_nx:
                 (version, table) = self.get_version_table_from_cookie(cookie)
                 eff_policy = self.get_effective_policy_from_table(table)
 
-            # find the queries, if any in the policy, that will be evaluated
-            queries,pkts = queries_in_eval((set(),{pyretic_pkt}),eff_policy)
+            # look the packet's flow up in the microflow cache
+            flow = (table,
+                    pyretic_pkt.header.remove(['raw', 'header_len',
+                                               'payload_len']))
+            transforms = self.microflow_cache.get(flow)
+            output = None
+            queries = set()
+            if transforms is not None:
+                output = {pyretic_pkt.modifymany(t) for t in transforms}
+
+            # evaluate against the compiled policy, if enabled
+            elif self.eval_engine == 'compiled':
+                output = self.compiled_eval(eff_policy, pyretic_pkt)
+
+            if output is None:
+                # find the queries, if any in the policy, that will be evaluated
+                queries,pkts = queries_in_eval((set(),{pyretic_pkt}),eff_policy)
+
+                # evaluate the policy
+                output = eff_policy.eval(pyretic_pkt)
 
-            # evaluate the policy
-            output = eff_policy.eval(pyretic_pkt)
+            # packets reaching queries must be evaluated for their buckets
+            if transforms is None and not queries:
+                transforms = microflow_transforms(pyretic_pkt, output)
+                self.microflow_cache.put(flow, transforms)
 
             # apply the queries whose buckets have received new packets
             self.in_bucket_apply = True
@@ -385,6 +1438,48 @@ class Runtime(object):
         # Note: lack of forwarding to bucket implies no bucket-trigger update could have occured
         if self.mode == 'reactive0' and not queries:
             self.reactive0_install(pyretic_pkt,output)
+        elif self.mode == 'reactive1' and not queries:
+            self.reactive1_install(eff_policy,pyretic_pkt,output)
+
+        # the decision, for the packet-ins of the flow coalesced with this one
+        return None if queries else transforms
+
+    def compiled_eval(self, policy, pkt):
+        """
+        Evaluate the packet against a decision tree built from the compiled
+        policy (see compiled_tree).
+
+        :param policy: the policy to evaluate
+        :type policy: Policy
+        :param pkt: the packet to evaluate
+        :type pkt: Packet
+        :rtype: set Packet, or None if the packet reaches a query, or the
+          policy doesn't compile, and must be interpreted instead.
+        """
+        tree = self.compiled_tree(policy)
+        if tree is None:
+            return None
+        return tree.eval(pkt)
+
+    def compiled_tree(self, policy):
+        """
+        The decision tree of the compiled policy, or None if the policy
+        doesn't compile. The tree is rebuilt whenever the policy's classifier
+        changes, i.e., after it is invalidated on a policy or network change.
+        """
+        entry = self.compiled_evals.get(id(policy))
+        if entry is not None and entry[0] is policy and entry[1] is None:
+            return None # didn't compile, retried on the next change
+        try:
+            classifier = self.pyretic_compile(policy)
+        except Exception:
+            self.log.exception("Policy doesn't compile, interpreting instead")
+            classifier = None
+        if entry is None or entry[0] is not policy or entry[1] is not classifier:
+            tree = DecisionTree(classifier.rules) if classifier else None
+            entry = (policy, classifier, tree)
+            self.compiled_evals[id(policy)] = entry
+        return entry[2]
 
 
 #############
@@ -397,12 +1492,15 @@ class Runtime(object):
         some sub-policy in self.policy changes.
         """
         with self.policy_lock:
+            self.policy_version += 1
 
             # tag stale classifiers as invalid
 
             recompile_list = on_recompile_path_list(id(sub_pol),
                                                     self.policy)
             map(lambda p: p.invalidate_classifier(), recompile_list)
+            self.compiled_evals.clear()
+            self.microflow_cache.clear()
 
             # if change was driven by a network update, flag
             if self.in_network_update:
@@ -472,10 +1570,18 @@ class Runtime(object):
         # Force recompilation overriding cached policies, if the network has
         # changed. This is to ensure that a local classifier is regenerated for
         # each switch in the (new) network topology.
-        force_compile = self.in_network_update
+        force_compile = (self.in_network_update or
+                         self.background_network_update)
         return pol.netkat_compile(self.sw_cnt(),
                                   force_compile=force_compile)[0]
 
+    def pyretic_compile(self, pol):
+        """ Compile a policy with the native compiler: through FDDs if
+        enabled, and the classifier algebra otherwise. """
+        if self.use_fdd_compiler:
+            return pol.fdd_compile()[0]
+        return pol.compile()
+
     def vlan_preprocessed_policy(self, p):
         from pyretic.core.language_tools import default_mapper, ast_map
         from pyretic.core.language import _match, _modify
@@ -504,10 +1610,12 @@ class Runtime(object):
 
     @Stat.classifier_stat
     @Stat.elapsed_time
-    def whole_policy_compile(self):
-        cp = self.vlan_preprocessed_policy(self.policy)
+    def whole_policy_compile(self, policy=None):
+        if policy is None:
+            policy = self.policy
+        cp = self.vlan_preprocessed_policy(policy)
         if self.use_pyretic_compiler:
-            p = cp.compile()
+            p = self.pyretic_compile(cp)
         elif self.path_policy:
             p = self.netkat_classifier_compile(cp)
         else:
@@ -527,10 +1635,10 @@ class Runtime(object):
             if table > 0 and not self.use_pyretic_compiler:
                 (c, t) = pol.netkat_compile(self.sw_cnt(), multistage=True)
             else:
-                c = pol.compile()
+                c = self.pyretic_compile(pol)
         elif self.pipeline == 'path_query_pipeline' or self.pipeline == 'mt':
             if self.use_pyretic_compiler:
-                c = pol.compile()
+                c = self.pyretic_compile(pol)
             else:
                 (c, t) = pol.netkat_compile(self.sw_cnt(), multistage=True)
         else:
@@ -541,46 +1649,101 @@ class Runtime(object):
 
     def update_switch_classifiers(self):
         """
-        Updates switch classifiers
+        Updates switch classifiers. With an event loop, the update runs in
+        the background, and updates requested before it starts are
+        coalesced into it.
         """
-        classifier = None
-        
-        if self.mode == 'reactive0':
-            self.clear_all()
+        if self.event_loop is None:
+            return self.compile_switch_classifiers()
+        if self.in_network_update:
+            self.pending_network_update = True
+        return self.update_queue.submit('recompile', self.background_recompile)
+
+    def background_recompile(self):
+        # Compile a snapshot of the policy without holding the policy lock, so
+        # packet-ins are still interpreted against the current policy, and
+        # only swap the classifiers in under the lock.
+        with self.policy_lock:
+            # recompile as the network update which requested it would have
+            self.background_network_update = self.pending_network_update
+            self.pending_network_update = False
+            version = self.policy_version
+            policy = policy_snapshot(self.policy)
+            policy_map = dict((table, policy_snapshot(self.policy_map[table]))
+                              for table in self.stale_tables())
+        try:
+            classifiers = self.generate_switch_classifiers(policy, policy_map)
+            with self.policy_lock:
+                if self.policy_version == version:
+                    # nothing changed meanwhile: the policy compiled to these
+                    self.adopt_classifier(self.policy, policy)
+                    for (table, pol) in policy_map.iteritems():
+                        self.adopt_classifier(self.policy_map[table], pol)
+                self.install_switch_classifiers(classifiers)
+        finally:
+            self.background_network_update = False
+        return True
 
-        elif self.mode == 'proactive0' or self.mode == 'proactive1':
-            if not self.use_nx:
-                classifier = self.whole_policy_compile()
-                self.log.debug(
-                    '|%s|\n\t%s\n\t%s\n\t%s\n' % (str(datetime.now()),
-                                                  "generate classifier",
-                                                  "policy=\n"+repr(self.policy),
-                                                  "classifier=\n"+repr(classifier)))
+    def adopt_classifier(self, pol, snapshot):
+        """ Give pol the classifier compiled for its snapshot. """
+        if snapshot is not pol and isinstance(pol, (CombinatorPolicy,
+                                                    DerivedPolicy)):
+            classifier = snapshot.__dict__.get('_classifier')
+            if classifier:
+                pol._classifier = classifier
+
+    def stale_tables(self):
+        """ The tables whose classifiers must be recompiled. """
+        return [table for (table, pol) in self.policy_map.iteritems()
+                if ((not pol.has_active_classifier()) or
+                    self.in_network_update or
+                    self.background_network_update)]
+
+    def compile_switch_classifiers(self):
+        policy_map = dict((table, self.policy_map[table])
+                          for table in self.stale_tables())
+        self.install_switch_classifiers(
+            self.generate_switch_classifiers(self.policy, policy_map))
+
+    def generate_switch_classifiers(self, policy, policy_map):
+        """ Compile the classifier of policy, or with multiple tables, those
+        of the tables in policy_map, as a list of (table, classifier). """
+        if not self.mode in ['proactive0', 'proactive1', 'proactive2',
+                             'proactive3']:
+            return []
+        if not self.use_nx:
+            classifier = self.whole_policy_compile(policy)
+            self.log.debug(
+                '|%s|\n\t%s\n\t%s\n\t%s\n' % (str(datetime.now()),
+                                              "generate classifier",
+                                              "policy=\n"+repr(policy),
+                                              "classifier=\n"+repr(classifier)))
+            return [(DEFAULT_NX_TABLE_ID, classifier)]
+        classifiers = []
+        classifier_string = ''
+        for (table, pol) in sorted(policy_map.iteritems()):
+            classifier = self.mt_specific_policy_compile(pol, table)
+            classifiers.append((table, classifier))
+            classifier_string += "%s\n%s\n" % (
+                "Table %d classifier:" % table,
+                repr(classifier))
+        self.log.debug(
+            '|%s|\n\t%s\n\t%s\n\t%s\n' % (str(datetime.now()),
+                                          "generate classifier",
+                                          "policy=\n"+repr(policy),
+                                          classifier_string))
+        return classifiers
+
+    def install_switch_classifiers(self, classifiers):
+        if self.mode in ['reactive0', 'reactive1']:
+            self.clear_all()
+        elif not self.use_nx:
+            for (table, classifier) in classifiers:
                 self.install_classifier(classifier)
-            else:
-                classifier_map = {}
-                table_list = []
-                classifier_string = ''
-                classifier_lens = ''
-                for (table, pol) in self.policy_map.iteritems():
-                    if ((not pol.has_active_classifier()) or
-                        self.in_network_update):
-                        table_list.append(table)
-                        classifier_map[table] = self.mt_specific_policy_compile(pol,
-                                                                                table)
-                        classifier_string += "%s\n%s\n" % (
-                            "Table %d classifier:" % table,
-                            repr(classifier_map[table]))
-                        classifier_lens += "Table %d: %d rules\n" % (
-                            table, len(classifier_map[table].rules))
-                self.log.debug(
-                    '|%s|\n\t%s\n\t%s\n\t%s\n' % (str(datetime.now()),
-                                                  "generate classifier",
-                                                  "policy=\n"+repr(self.policy),
-                                                  classifier_string))
-                for table in table_list:
-                    self.log.debug("Installing table %d" % table)
-                    self.install_classifier(classifier_map[table], table)
+        else:
+            for (table, classifier) in classifiers:
+                self.log.debug("Installing table %d" % table)
+                self.install_classifier(classifier, table)
 
     def update_dynamic_sub_pols(self):
         """
@@ -810,6 +1973,112 @@ class Runtime(object):
 
         return (concrete_pred,0,action_list,self.default_cookie,False,default_table)
 
+    def reactive1_install(self,policy,in_pkt,out_pkts):
+        """
+        Reactively installs wildcard switch table entries, covering every
+        packet the policy handles as it handled in_pkt, or an exact-match
+        entry as reactive0_install does if there are none.
+
+        :param policy: the policy on which in_pkt was evaluated
+        :type policy: Policy
+        :param in_pkt: the input on which the policy was evaluated
+        :type in_pkt: Packet
+        :param out_pkts: the output of the evaluation
+        :type out_pkts: set Packet
+        """
+        rule_tuples = self.wildcard_rule_tuples(policy,in_pkt)
+        if rule_tuples is None:
+            self.reactive0_install(in_pkt,out_pkts)
+            return
+        for rule_tuple in rule_tuples:
+            self.install_rule(rule_tuple)
+            self.log.debug(
+                '|%s|\n\t%s\n\t%s\n\t%s\n' % (str(datetime.now()),
+                                              " | install wildcard rule",
+                                              rule_tuple[0],
+                                              'actions='+repr(rule_tuple[2])))
+
+    def wildcard_rule_tuples(self, policy, pkt):
+        """
+        Produces rule tuples matching the widest region of packets around a
+        given packet to which the compiled policy applies the same actions
+        (see wildcard_region).
+
+        Unless the region matches on the inport, packets arriving on one of
+        the ports it forwards to need rules of their own, sending them out
+        of their inport (see OF_inportize). These take the upper half of
+        the priorities, and rules matching any inport the lower half, each
+        ordered as the classifier's rules. Rules of regions with different
+        actions never overlap, so this is all the order that matters.
+
+        :param policy: the policy on which pkt was evaluated
+        :type policy: Policy
+        :param pkt: the input packet
+        :type pkt: Packet
+        :returns: the wildcard rules, or None if the policy doesn't compile,
+          or the packet's region can't be installed
+        :rtype: list (dict of strings to values, int, list int)
+        """
+        tree = self.compiled_tree(policy)
+        if tree is None:
+            return None
+        entry = tree.lookup(pkt)
+        if entry is None or entry[3]:
+            return None
+        region = wildcard_region(tree.entries, entry, pkt)
+        if region is None:
+            return None
+
+        action_list = []
+        for act in entry[0].actions:
+            if act == identity:
+                actions = {}
+            elif isinstance(act, modify):
+                actions = dict(act.map)
+            else:
+                return None
+            if not set(actions.keys()) <= set(native_headers + ['port']):
+                return None
+            actions.setdefault('port', OFPP_IN_PORT)
+            action_list.append(actions)
+
+        # DEAL W/ BUG IN OVS ACCEPTING ARP RULES THAT AREN'T ACTUALLY EXECUTED
+        if pkt['ethtype'] == ARP_TYPE:
+            for action_set in action_list:
+                if len(action_set) > 1:
+                    return None
+
+        # OpenFlow only matches layer-3/4 fields along with their protocol
+        concrete_pred = dict(region.map)
+        l3 = set(['srcip', 'dstip', 'tos', 'protocol', 'srcport', 'dstport'])
+        if l3 & set(concrete_pred.keys()):
+            concrete_pred.setdefault('ethtype', pkt['ethtype'])
+        if (set(['srcport', 'dstport']) & set(concrete_pred.keys()) and
+            not pkt.header.get('protocol') is None):
+            concrete_pred.setdefault('protocol', pkt['protocol'])
+        for field in ['srcip', 'dstip']:
+            if field in concrete_pred:
+                concrete_pred[field] = util.network_to_string(
+                    concrete_pred[field])
+
+        position = next(i for (i, e) in enumerate(tree.entries) if e is entry)
+        inport_priority = max(TABLE_START_PRIORITY - position,
+                              TABLE_START_PRIORITY // 2 + 1)
+        any_priority = max(TABLE_START_PRIORITY // 2 - position,
+                           TABLE_MISS_PRIORITY + 1)
+        rule_tuple = lambda pred, priority: (pred, priority,
+                                             copy.deepcopy(action_list),
+                                             self.default_cookie, False, 0)
+        if 'port' in concrete_pred:
+            return [rule_tuple(concrete_pred, inport_priority)]
+        rule_tuples = []
+        outports = set(a['port'] for a in action_list) - set([OFPP_IN_PORT])
+        for outport in sorted(outports):
+            rule_tuples.append(rule_tuple(dict(concrete_pred, port=outport),
+                                          inport_priority))
+        rule_tuples.append(rule_tuple(concrete_pred, any_priority))
+        return rule_tuples
+
 #########################
 # PROACTIVE COMPILATION 
 #########################
@@ -826,29 +2095,29 @@ class Runtime(object):
         version  = cookie & 0x7ff
         return (version, table_id)
 
+    def default_rules(self, s, table_id):
+        """ The backup rules installed on switch s by default. """
+        cookie = self.get_cookie(self.default_cookie, table_id)
+        # Fallback "send to controller" rule under table miss
+        return [({'switch' : s},
+                 TABLE_MISS_PRIORITY,
+                 [{'port' : OFPP_CONTROLLER}],
+                 cookie, False, table_id),
+                # Send all LLDP packets to controller for topology maintenance
+                ({'switch' : s, 'ethtype': LLDP_TYPE},
+                 TABLE_START_PRIORITY + 2,
+                 [{'port' : OFPP_CONTROLLER}],
+                 cookie, False, table_id),
+                # Drop all IPv6 packets by default.
+                ({'switch':s, 'ethtype':IPV6_TYPE},
+                 TABLE_START_PRIORITY + 1,
+                 [],
+                 cookie, False, table_id)]
+
     def install_defaults(self, s, table_id):
         """ Install backup rules on switch s by default. """
-        # Fallback "send to controller" rule under table miss
-        self.install_rule(({'switch' : s},
-                           TABLE_MISS_PRIORITY,
-                           [{'port' : OFPP_CONTROLLER}],
-                           self.get_cookie(self.default_cookie, table_id),
-                           False,
-                           table_id))
-        # Send all LLDP packets to controller for topology maintenance
-        self.install_rule(({'switch' : s, 'ethtype': LLDP_TYPE},
-                           TABLE_START_PRIORITY + 2,
-                           [{'port' : OFPP_CONTROLLER}],
-                           self.get_cookie(self.default_cookie, table_id),
-                           False,
-                           table_id))
-        # Drop all IPv6 packets by default.
-        self.install_rule(({'switch':s, 'ethtype':IPV6_TYPE},
-                           TABLE_START_PRIORITY + 1,
-                           [],
-                           self.get_cookie(self.default_cookie, table_id),
-                           False,
-                           table_id))
+        for rule in self.default_rules(s, table_id):
+            self.install_rule(rule)
 
     @Stat.collects(['switch count', 'rule count'])
     def install_classifier(self, classifier, table_id=DEFAULT_NX_TABLE_ID):
@@ -857,6 +2126,8 @@ class Runtime(object):
 
         :param classifier: the input classifer
         :type classifier: Classifier
+        :returns: the completion of the installation on the switches
+        :rtype: InstallFuture
         """
         if classifier is None:
             return
@@ -1421,7 +2692,7 @@ class Runtime(object):
 
             return Classifier(specialized_rules)
 
-        def prioritize(classifier):
+        def prioritize(classifier, table_id):
             """
             Add priorities to classifier rules based on their ordering.
             
@@ -1430,6 +2701,8 @@ class Runtime(object):
             :returns: the output classifier
             :rtype: Classifier
             """
+            if self.mode == 'proactive2':
+                return stable_prioritize(classifier, table_id)
             priority = {}
             tuple_rules = list()
             for rule in classifier.rules:
@@ -1446,6 +2719,35 @@ class Runtime(object):
                 tuple_rules.append(r)
             return tuple_rules
 
+        def stable_prioritize(classifier, table_id):
+            """
+            Add priorities to classifier rules based on their ordering,
+            keeping the priorities rules had in the previous classifier
+            where possible, so that updates don't reinstall unchanged rules.
+            """
+            switch_rules = {}
+            for rule in classifier.rules:
+                switch_rules.setdefault(rule.match['switch'], []).append(rule)
+            priority = {}
+            for (s, rules) in switch_rules.iteritems():
+                allocator = self.priority_allocators.setdefault(
+                    (table_id, s), PriorityAllocator())
+                keys = []
+                for rule in rules:
+                    try:
+                        k = util.frozendict(rule.match)
+                        hash(k)
+                    except TypeError:
+                        k = None
+                    keys.append(k)
+                priority.update(zip(map(id, rules), allocator.allocate(keys)))
+            return [ListedRule(mat=rule.match,
+                               priority=priority[id(rule)],
+                               actions=rule.actions,
+                               parents=rule.parents,
+                               op=rule.op)
+                    for rule in classifier.rules]
+
         ### UPDATE LOGIC
 
         def nuclear_install(new_rules, curr_classifier_no, table_id):
@@ -1482,14 +2784,6 @@ class Runtime(object):
 
         ### INCREMENTAL UPDATE LOGIC
 
-        def find_same_rule(target, rule_list):
-            if rule_list is None:
-                return None
-            for rule in rule_list:
-                if target.mat == rule.mat and target.priority == rule.priority:
-                    return rule
-            return None
-
         def get_new_rules(classifier, curr_classifier_no, table_id):
             def add_cookie(rules, cookie_val):
                 new_rules = []
@@ -1525,31 +2819,27 @@ class Runtime(object):
                 classifier = set_next_table_port(classifier)
             classifier = check_OF_rules(classifier)
             classifier = OF_inportize(classifier)
-            new_rules = prioritize(classifier)
+            new_rules = prioritize(classifier, table_id)
             cookie = self.get_cookie(curr_classifier_no, table_id)
             new_rules = add_cookie(new_rules, cookie)
             new_rules = add_table_id(new_rules, table_id)
             return new_rules
 
-        def get_nuclear_diff(new_rules):
+        def get_nuclear_diff(new_rules, table_id):
             """Compute diff lists for a nuclear install, i.e., when all rules
             are removed and the full new classifier is installed afresh.
             """
             with self.old_rules_lock:
-                import copy
-                to_delete = copy.copy(self.old_rules)
+                to_delete = list(self.old_rules.get(table_id, []))
                 to_add = new_rules
                 to_modify = list()
                 to_stay = list()
-                self.old_rules = new_rules
+                self.old_rules[table_id] = RuleStore(new_rules)
             return (to_add, to_delete, to_modify, to_stay)
 
-        def get_incremental_diff(new_rules):
+        def get_incremental_diff(new_rules, table_id):
             """Compute diff lists, i.e., (+), (-) and (0) rules from the earlier
-            (versioned) classifier."""
-            """ TODO: this function needs to be updated with multiple
-            tables. There must now be one old_rules structure corresponding
-            to each table_id. """
+            (versioned) classifier of the table."""
             def different_actions(old_acts, new_acts):
                 def buckets_removed(acts):
                     return filter(lambda a: not isinstance(a, MatchingAggregateBucket),
@@ -1558,14 +2848,15 @@ class Runtime(object):
 
             with self.old_rules_lock:
                 # calculate diff
-                old_rules = self.old_rules
+                old_rules = self.old_rules.setdefault(table_id, RuleStore())
+                new_store = RuleStore(new_rules)
                 to_add = list()
                 to_delete = list()
                 to_modify = list()
                 to_modify_old = list() # old counterparts of modified rules
                 to_stay = list()
                 for old in old_rules:
-                    new = find_same_rule(old, new_rules)
+                    new = new_store.find(old)
                     if new is None:
                         to_delete.append(old)
                     else:
@@ -1595,29 +2886,28 @@ class Runtime(object):
                             to_stay.append(old)
 
                 for new in new_rules:
-                    old = find_same_rule(new, old_rules)
-                    if old is None:
+                    if old_rules.find(new) is None:
                         to_add.append(new)
 
                 # update old_rules to reflect changes in the classifier
                 for rule in to_delete:
-                    self.old_rules.remove(rule)
+                    old_rules.remove(rule)
                 for rule in to_add:
-                    self.old_rules.append(rule)
+                    old_rules.add(rule)
                 # see note above where to_modify* lists are populated.
-                for rule in to_modify:
-                    to_add.remove(rule)
-                for rule in to_modify_old:
-                    to_delete.remove(rule)
+                modified = set(map(id, to_modify))
+                to_add = [r for r in to_add if not id(r) in modified]
+                modified_old = set(map(id, to_modify_old))
+                to_delete = [r for r in to_delete if not id(r) in modified_old]
 
             return (to_add, to_delete, to_modify, to_stay)
 
-        def get_diff_lists(new_rules):
-            assert self.mode in ['proactive0', 'proactive1']
+        def get_diff_lists(new_rules, table_id):
+            assert self.mode in ['proactive0', 'proactive1', 'proactive2']
             if self.mode == 'proactive0':
-                return get_nuclear_diff(new_rules)
-            elif self.mode == 'proactive1':
-                return get_incremental_diff(new_rules)
+                return get_nuclear_diff(new_rules, table_id)
+            else:
+                return get_incremental_diff(new_rules, table_id)
 
         def convert_to_tuple(diff_lists):
             new_diff_lists = []
@@ -1628,28 +2918,28 @@ class Runtime(object):
                 new_diff_lists.append(new_lst)
             return new_diff_lists
 
-        def install_diff_lists(diff_lists, classifier_version_no, table_id):
-            """Install the difference between the input classifier and the
-            current switch tables. The function takes the set of rules (added,
-            deleted, modified, untouched), and does necessary flow
-            installs/deletes/modifies.
-            
+        def get_switch_ops(diff_lists, classifier_version_no, table_id):
+            """Turn the difference between the input classifier and the current
+            switch tables into the flow table operations to send to each
+            switch. The function takes the set of rules (added, deleted,
+            modified, untouched).
+
             :param diff_lists: list of rules to add, delete, modify, stay.
             :type diff_lists: 4 tuple of rule lists
             :param classifier_version_no: version of the classifier after
             controller bootup
             :type classifier_version_no: int
+            :returns: operations for InstallScheduler.submit
+            :rtype: dictionary from switch to operation lists
             """
             (to_add, to_delete, to_modify, to_stay) = diff_lists
-            switches = self.network.switch_list()
+            switch_ops = {s : [] for s in self.network.switch_list()}
+            parted = self.install_scheduler.parted
 
             # If the controller just came up, clear out the switches.
             if classifier_version_no == 1 or self.mode == 'proactive0':
-                for s in switches:
-                    self.send_barrier(s)
-                    self.send_clear(s, table_id)
-                    self.send_barrier(s)
-                    self.install_defaults(s, table_id)
+                for ops in switch_ops.values():
+                    ops.append(('clear', table_id))
 
             # There's no need to delete rules if nuclear install:
             if self.mode == 'proactive0':
@@ -1657,28 +2947,90 @@ class Runtime(object):
                 to_modify = list()
                 to_stay   = list()
 
-            if to_delete:
-                for rule in to_delete:
-                    (match_dict,priority,_,_) = rule
-                    if match_dict['switch'] in switches:
-                        self.delete_rule((match_dict, priority))
-            if to_add:
-                for rule in to_add:
-                    self.install_rule(rule)
-            if to_modify:
-                for rule in to_modify:
-                    self.modify_rule(rule)
-            for s in switches:
-                self.send_barrier(s)
-            self.log.debug('\n-----\n\n\ninstalled new set of rules\n\n\n----')
-
-
-        ### PROCESS THAT DOES INSTALL
+            for (kind, rules) in [('delete', to_delete), ('install', to_add),
+                                  ('modify', to_modify)]:
+                for rule in rules:
+                    s = rule[0]['switch']
+                    if s in switch_ops or s in parted:
+                        switch_ops.setdefault(s, []).append((kind, rule))
+            return switch_ops
+
+        ### CONSISTENT UPDATE LOGIC
+
+        @Stat.collects(['update phase times'])
+        def consistent_update(new_rules, table_id, interior_ports):
+            """Install a classifier such that each packet is processed
+            entirely by the old or entirely by the new one. The new version's
+            rules for tagged packets are installed first; once all switches
+            have acknowledged them, the rules for untagged packets, which
+            stamp the version onto packets entering the network, are replaced.
+            The old version's rules are deleted once packets it stamped have
+            drained.
+
+            The untagged rules are installed highest priority first and the
+            old ones deleted lowest priority first, so that (as long as the
+            switch applies them in order) a packet matches either the old or
+            the new rule it would have matched alone.
+            """
+            old_version = self.consistent_versions.get(table_id)
+            version = 0 if old_version is None else 1 - old_version
+            tagged_rules = version_tag(new_rules, version, interior_ports)
+            with self.old_rules_lock:
+                old_store = self.old_rules.get(table_id)
+            diff_lists = get_nuclear_diff(tagged_rules, table_id)
+            bookkeep_count_buckets(diff_lists, table_id)
+            bookkeep_netflow_buckets(diff_lists, table_id)
+            diff_lists = remove_matching_aggregate_buckets(diff_lists)
+            (to_add, to_delete, _, _) = convert_to_tuple(diff_lists)
 
-        def f(diff_lists,curr_version_no,table_id):
-            self.send_reset_install_time()
-            with self.switch_lock:
-                install_diff_lists(diff_lists,curr_version_no,table_id)
+            switches = self.network.switch_list()
+            parted = self.install_scheduler.parted
+            def ops(kind, rules, descending):
+                switch_ops = {s : [] for s in switches}
+                for rule in sorted(rules, key=lambda r: r[1],
+                                   reverse=descending):
+                    s = rule[0]['switch']
+                    if s in switch_ops or s in parted:
+                        switch_ops.setdefault(s, []).append((kind, rule))
+                return switch_ops
+            def run(switch_ops):
+                future = self.install_scheduler.submit(switch_ops)
+                future.wait()
+                return future.ok
+
+            start = time.time()
+            if old_version is None:
+                switch_ops = ops('install', to_add, True)
+                for s in switches:
+                    switch_ops[s].insert(0, ('clear', table_id))
+                ok = run(switch_ops)
+                self.consistent_versions[table_id] = version
+                self.log.info('Installed version %d of table %d in %f s' %
+                              (version, table_id, time.time() - start))
+                return ok
+
+            def flip():
+                self.consistent_versions[table_id] = version
+            (ok, phases) = consistent_update_phases(
+                lambda kind, rules, descending:
+                    run(ops(kind, rules, descending)),
+                to_add, to_delete, flip)
+            if phases is None:
+                # the old version is still the one installed
+                with self.old_rules_lock:
+                    if old_store is None:
+                        self.old_rules.pop(table_id, None)
+                    else:
+                        self.old_rules[table_id] = old_store
+                self.log.error('Aborted the update of table %d to version %d:'
+                               ' its rules were not acknowledged by all '
+                               'switches' % (table_id, version))
+                return False
+            Stat.collect_stat('update phase times', phases)
+            self.log.info('Updated table %d to version %d: install %f s, '
+                          'flip %f s, garbage collection %f s' %
+                          ((table_id, version) + phases))
+            return ok
 
         curr_version_no = None
         with self.classifier_version_lock:
@@ -1713,7 +3065,15 @@ class Runtime(object):
         Stat.collect_stat('switch count', stat_switch_cnt)
         Stat.collect_stat('rule count', len(new_rules))
 
-        diff_lists = get_diff_lists(new_rules)
+        if self.mode == 'proactive3':
+            interior_ports = {s : set(loc.port_no for loc in
+                                      self.network.topology.interior_locations(s))
+                              for s in self.network.switch_list()}
+            self.send_reset_install_time()
+            return self.update_queue.submit(table_id, lambda:
+                consistent_update(new_rules, table_id, interior_ports))
+
+        diff_lists = get_diff_lists(new_rules, table_id)
         bookkeep_count_buckets(diff_lists, table_id)
         bookkeep_netflow_buckets(diff_lists, table_id)
         diff_lists = remove_matching_aggregate_buckets(diff_lists)
@@ -1730,9 +3090,9 @@ class Runtime(object):
         # installation routine below.
         diff_lists = convert_to_tuple(diff_lists)
 
-        p = Process(target=f, args=(diff_lists,curr_version_no,table_id))
-        p.daemon = True
-        p.start()
+        self.send_reset_install_time()
+        return self.install_scheduler.submit(
+            get_switch_ops(diff_lists, curr_version_no, table_id))
 
 ###################
 # QUERYING SUPPORT
@@ -1915,23 +3275,15 @@ class Runtime(object):
     def delete_rule(self,(concrete_pred,priority)):
         self.backend.send_delete(concrete_pred,priority)
 
-    def send_barrier(self,switch):
-        self.backend.send_barrier(switch)
+    def send_barrier(self,switch,xid=None):
+        self.backend.send_barrier(switch,xid)
 
     def send_clear(self,switch,table_id):
         self.backend.send_clear(switch,table_id)
 
     def clear_all(self, table_id=0):
-        def f():
-            switches = self.network.switch_list()
-            for s in switches:
-                self.send_barrier(s)
-                self.send_clear(s, table_id)
-                self.send_barrier(s)
-                self.install_defaults(s, table_id)
-        p = Process(target=f)
-        p.daemon = True
-        p.start()
+        return self.install_scheduler.submit(
+            {s : [('clear', table_id)] for s in self.network.switch_list()})
 
     def request_flow_stats(self,switch):
         self.backend.send_flow_stats_request(switch)
@@ -1945,9 +3297,11 @@ class Runtime(object):
 #######################
 
     def handle_switch_join(self,switch_id):
+        self.install_scheduler.switch_join(switch_id)
         self.network.handle_switch_join(switch_id)
 
     def handle_switch_part(self,switch_id):
+        self.install_scheduler.switch_part(switch_id)
         self.network.handle_switch_part(switch_id)
 
     def handle_port_join(self,switch_id,port_id,conf_up,stat_up,port_type):
@@ -1990,12 +3344,16 @@ class Runtime(object):
         output += '\n\t cookie: \t' + str(flow_stat['cookie'])
         return output
 
+    def handle_barrier_reply(self, switch, xid):
+        self.install_scheduler.barrier_reply(switch, xid)
+
     def handle_flow_stats_reply(self, switch, flow_stats):
         self.log.info('received a flow stats reply from switch ' + str(switch))
         flow_stats = [ { f : self.ofp_convert(f,v)
                          for (f,v) in flow_stat.items() }
                        for flow_stat in flow_stats       ]
         flow_stats = sorted(flow_stats, key=lambda d: -d['priority'])
+        self.install_scheduler.flow_stats_reply(switch, flow_stats)
         self.log.debug(
             '|%s|\n\t%s\n' % (str(datetime.now()),
                 '\n'.join(['flow table for switch='+repr(switch)] + 
@@ -2509,6 +3867,7 @@ class abstract_virtual_field(object):
             cls.stages[stage] = [self]
         cls.allocate_stage_bits()
         cls.reset_virtual_none()
+        virtual_fields_changed()
 
     @classmethod
     def clear(cls):
@@ -2518,6 +3877,7 @@ class abstract_virtual_field(object):
         cls.stages = {}
         cls.stage_offset_nbits = {}
         cls.virtual_none.policy = identity
+        virtual_fields_changed()
 
     @classmethod
     def get_class(cls, name):
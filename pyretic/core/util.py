@@ -32,6 +32,8 @@
 ################################################################################
 
 from functools import wraps
+import heapq
+import threading
 
 from multiprocessing import Lock
 from logging import StreamHandler
@@ -61,6 +63,61 @@ def cached(f):
     wrapper.cache = {}
     return wrapper
 
+class LRUCache(object):
+    """ A bounded mapping which, once it holds more than maxsize entries,
+    evicts the least recently used quarter of them. Counts hits and misses of
+    lookups. Safe to share between threads. """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = {}  # key -> [value, last use]
+        self.tick = 0
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                entry = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.tick += 1
+            entry[1] = self.tick
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, val):
+        with self.lock:
+            self.tick += 1
+            self.data[key] = [val, self.tick]
+            if len(self.data) > self.maxsize:
+                self.evict()
+
+    def evict(self):
+        with self.lock:
+            if len(self.data) <= self.maxsize:
+                return
+            num_evicted = len(self.data) - (self.maxsize - self.maxsize // 4)
+            for (k, e) in heapq.nsmallest(num_evicted, self.data.iteritems(),
+                                          key=lambda (k, e): e[1]):
+                del self.data[k]
+
+    def clear(self):
+        with self.lock:
+            self.data = {}
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {'hits' : self.hits, 'misses' : self.misses,
+                'size' : len(self.data)}
+
+    def __len__(self):
+        return len(self.data)
+
 class frozendict(object):
     __slots__ = ["_dict", "_cached_hash"]
 
@@ -0,0 +1,439 @@
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+""" Micro-benchmarks for classifier operations on generated classifiers.
+
+Usage:
+    python pyretic/evaluations/eval_classifier.py -b shadow -n 1000 10000 50000
+    python pyretic/evaluations/eval_classifier.py -b parallel -n 100 1000
+    python pyretic/evaluations/eval_classifier.py -b memo -n 1000
+    python pyretic/evaluations/eval_classifier.py -b ast -n 10000 100000
+    python pyretic/evaluations/eval_classifier.py -b eval -n 100 1000
+    python pyretic/evaluations/eval_classifier.py -b compile -n 100 300
+    python pyretic/evaluations/eval_classifier.py -b priority -n 1000 20000
+    python pyretic/evaluations/eval_classifier.py -b reactive -n 100 1000
+"""
+
+import argparse
+import random
+import time
+
+from pyretic.core.language import *
+from pyretic.core.packet import Packet
+from pyretic.core.classifier import Rule, Classifier, DecisionTree
+from pyretic.core.language_tools import queries_in_eval
+from pyretic.core.runtime import PriorityAllocator, TABLE_START_PRIORITY
+from pyretic.core.runtime import wildcard_region, same_actions
+
+
+def gen_match(rnd, num_switches=16, num_ports=8):
+    """ Generate a random match, in the shape of the matches produced by
+    forwarding, access control and routing policies. """
+    d = {}
+    d['switch'] = rnd.randint(1, num_switches)
+    if rnd.random() < 0.5:
+        d['port'] = rnd.randint(1, num_ports)
+    if rnd.random() < 0.3:
+        d['dstmac'] = EthAddr('00:00:00:00:%02x:%02x' %
+                              (rnd.randint(0, 255), rnd.randint(0, 255)))
+    d['ethtype'] = IP_TYPE
+    plen = rnd.choice([24, 32, 32, 32])
+    d['dstip'] = '10.%d.%d.%d/%d' % (rnd.randint(0, 255), rnd.randint(0, 255),
+                                     rnd.randint(0, 255), plen)
+    if rnd.random() < 0.3:
+        d['srcip'] = '10.%d.0.0/16' % rnd.randint(0, 255)
+    return match(**d)
+
+def gen_classifier(num_rules, seed=0):
+    """ Generate a total classifier with num_rules rules, about a tenth of
+    which are shadowed by an earlier rule. """
+    rnd = random.Random(seed)
+    rules = []
+    for i in range(num_rules - 1):
+        if rules and rnd.random() < 0.1:
+            m = rnd.choice(rules).match.intersect(match(protocol=TCP_TYPE))
+        else:
+            m = gen_match(rnd)
+        rules.append(Rule(m, {modify(port=rnd.randint(1, 8))}))
+    rules.append(Rule(identity, set()))
+    return Classifier(rules)
+
+def naive_remove_shadowed_cover_single(c):
+    """ The exhaustive shadow check, kept as a baseline. """
+    opt_c = Classifier()
+    for r in c.rules:
+        if not reduce(lambda acc, new_r: acc or
+                      new_r.match.covers(r.match),
+                      opt_c.rules,
+                      False):
+            opt_c.rules.append(r)
+    return opt_c
+
+def naive_parallel(c1, c2):
+    """ Cross every pair of rules, kept as a baseline. """
+    c3 = Classifier()
+    for r1 in c1.rules:
+        for r2 in c2.rules:
+            intersection = r1.match.intersect(r2.match)
+            if intersection != drop:
+                c3.append(Rule(intersection, r1.actions | r2.actions,
+                               [r1, r2], "parallel"))
+    if len(c3) == 0:
+        c3.append(Rule(identity, set(), [c1, c2], "empty_parallel"))
+    else:
+        c3 = c3.optimize()
+    return c3
+
+def gen_mac_classifier(num_rules, seed=0, num_switches=16):
+    """ Generate a total classifier shaped like a learned-MAC forwarding
+    table: per-switch rules on dstmac, falling through to flooding. """
+    rnd = random.Random(seed)
+    rules = []
+    for i in range(num_rules - 1):
+        m = match(switch=rnd.randint(1, num_switches),
+                  dstmac=EthAddr('00:00:00:00:%02x:%02x' %
+                                 (rnd.randint(0, 255), rnd.randint(0, 255))))
+        rules.append(Rule(m, {modify(port=rnd.randint(1, 8))}))
+    rules.append(Rule(identity, {Controller}))
+    return Classifier(rules)
+
+def language_policies():
+    """ Policies of the size of those in tests/test_language.py. """
+    ip1 = IPAddr('10.0.0.1')
+    p = IPAddr('10.0.0.11')
+    mac1 = EthAddr('00:00:00:00:00:01')
+    mac2 = EthAddr('00:00:00:00:00:02')
+    macB = EthAddr('FF:FF:FF:FF:FF:FF')
+    mod = if_(match(srcip=ip1), modify(srcip=p),
+              if_(match(dstip=p), modify(dstip=ip1)))
+    route = (((match(dstmac=mac1) | match(dstmac=macB)) >> fwd(1)) +
+             ((match(dstmac=mac2) | match(dstmac=macB)) >> fwd(2)))
+    return [mod >> route,
+            if_(match(port=2), fwd(1), match(port=4) >> fwd(2)),
+            match(port=1) >> match(switch=2) >> fwd(3),
+            xfwd(1) + xfwd(2) + xfwd(3)]
+
+def stanford_classifier():
+    """ The Stanford backbone forwarding classifier (run from the top of the
+    repository). """
+    import imp
+    sf = imp.load_source('stanford_forwarding',
+                         'pyretic/evaluations/Tests/common_modules/'
+                         'stanford_forwarding.py')
+    return sf.StanfordForwarding().compile()
+
+def fabric_policy(num_nodes, num_switches=16, num_ports=8):
+    """ A policy AST of about num_nodes nodes, built like
+    vmap.shortest_path_fabric_policy: one match >> fwd per hop on the path
+    between each pair of virtual ports, added up one by one. """
+    rnd = random.Random(0)
+    pol = drop
+    for i in range(num_nodes // 4):
+        dst = EthAddr('00:00:00:00:%02x:%02x' % (i // 256 % 256, i % 256))
+        pol += (match(switch=rnd.randint(1, num_switches),
+                      port=rnd.randint(1, num_ports), dstmac=dst) >>
+                fwd(rnd.randint(1, num_ports)))
+    return pol
+
+def live_objects(cls=object):
+    import gc
+    gc.collect()
+    return sum(1 for o in gc.get_objects() if isinstance(o, cls))
+
+def live_matches():
+    return live_objects(match)
+
+def timed(f, *args):
+    t_s = time.time()
+    res = f(*args)
+    return (res, time.time() - t_s)
+
+def bench_shadow(sizes, naive_limit):
+    print "%-10s %-10s %-12s %-12s" % ('rules', 'kept', 'indexed(s)', 'naive(s)')
+    for n in sizes:
+        c = gen_classifier(n)
+        (opt, t_idx) = timed(Classifier.remove_shadowed_cover_single, c)
+        t_naive = '-'
+        if n <= naive_limit:
+            (naive, t) = timed(naive_remove_shadowed_cover_single, c)
+            assert naive == opt
+            t_naive = '%.3f' % t
+        print "%-10d %-10d %-12.3f %-12s" % (n, len(opt), t_idx, t_naive)
+
+def bench_parallel(sizes, naive_limit):
+    print "%-10s %-10s %-12s %-12s" % ('rules', 'out', 'partition(s)', 'naive(s)')
+    for n in sizes:
+        c1 = gen_mac_classifier(n, seed=1)
+        c2 = gen_mac_classifier(n, seed=2)
+        (c3, t_part) = timed(Classifier.__add__, c1, c2)
+        t_naive = '-'
+        if n <= naive_limit:
+            (naive, t) = timed(naive_parallel, c1, c2)
+            assert naive == c3
+            t_naive = '%.3f' % t
+        print "%-10d %-10d %-12.3f %-12s" % (n, len(c3), t_part, t_naive)
+
+def bench_memo(sizes, naive_limit):
+    import pyretic.core.language as lang
+    memos = [lang._intersect_memo, lang._covers_memo]
+    memo_size = lang.MATCH_MEMO_SIZE
+    stanford = stanford_classifier()
+    workloads = [('language', lambda: [p.compile() for p in language_policies()]),
+                 ('stanford', lambda: stanford + stanford)]
+    for n in sizes:
+        c1 = gen_classifier(n, seed=1)
+        c2 = gen_mac_classifier(n, seed=2)
+        workloads.append(('generated %d' % n,
+                          lambda c1=c1, c2=c2: (c1 + c2) + c1))
+    print "%-16s %-8s %-10s %-10s %-14s" % ('workload', 'memo', 'time(s)',
+                                            'live', 'intersect hits')
+    for (name, run) in workloads:
+        for (label, size) in [('off', 0), ('cold', memo_size), ('warm', memo_size)]:
+            for memo in memos:
+                memo.maxsize = size
+                memo.reset_stats()
+                if label != 'warm':
+                    memo.clear()
+            (res, t) = timed(run)
+            stats = memos[0].stats()
+            print "%-16s %-8s %-10.3f %-10d %d/%d" % (
+                name, label, t, live_matches(), stats['hits'],
+                stats['hits'] + stats['misses'])
+            del res
+
+def bench_ast(sizes, naive_limit):
+    print "%-10s %-10s %-12s %-12s" % ('nodes', 'time(s)', 'objects',
+                                       'classifiers')
+    for n in sizes:
+        (objs, clss) = (live_objects(), live_objects(Classifier))
+        (pol, t) = timed(fabric_policy, n)
+        print "%-10d %-10.3f %-12d %-12d" % (
+            n, t, live_objects() - objs, live_objects(Classifier) - clss)
+        del pol
+
+def gen_forwarding_policy(num_hosts, seed=0, num_switches=16, num_ports=8):
+    """ A learned-MAC style forwarding policy over num_hosts hosts, sending
+    unknown destinations out of port 1, and the hosts' MACs. """
+    rnd = random.Random(seed)
+    macs = [EthAddr('00:00:00:00:%02x:%02x' % (i // 256 % 256, i % 256))
+            for i in range(num_hosts)]
+    known = drop
+    fwds = drop
+    for mac in macs:
+        m = match(switch=rnd.randint(1, num_switches), dstmac=mac)
+        known |= m
+        fwds += m >> fwd(rnd.randint(1, num_ports))
+    pol = if_(match(ethtype=IP_TYPE),
+              if_(known, fwds, fwd(1)),
+              drop)
+    return (pol, macs)
+
+def gen_packets(num_pkts, macs, seed=0, num_switches=16, num_ports=8):
+    rnd = random.Random(seed)
+    pkts = []
+    for i in range(num_pkts):
+        pkts.append(Packet({'switch' : rnd.randint(1, num_switches),
+                            'port' : rnd.randint(1, num_ports),
+                            'srcmac' : rnd.choice(macs),
+                            'dstmac' : rnd.choice(macs),
+                            'ethtype' : rnd.choice([IP_TYPE, IP_TYPE, ARP_TYPE]),
+                            'srcip' : '10.0.0.1',
+                            'dstip' : '10.0.0.2'}))
+    return pkts
+
+def interpreter_eval(pol, pkts):
+    """ Packet evaluation as in Runtime.handle_packet_in. """
+    out = []
+    for pkt in pkts:
+        queries_in_eval((set(), {pkt}), pol)
+        out.append(pol.eval(pkt))
+    return out
+
+def compiled_eval(tree, pkts):
+    return [tree.eval(pkt) for pkt in pkts]
+
+def bench_eval(sizes, naive_limit, num_pkts=10000):
+    print "%-8s %-8s %-14s %-14s %-12s %-10s" % (
+        'hosts', 'rules', 'interp(pkt/s)', 'compiled(pkt/s)', 'compile(s)',
+        'tree(s)')
+    for n in sizes:
+        (pol, macs) = gen_forwarding_policy(n)
+        pkts = gen_packets(num_pkts, macs)
+        (c, t_compile) = timed(pol.compile)
+        (tree, t_tree) = timed(DecisionTree, c.rules)
+        (res_i, t_i) = timed(interpreter_eval, pol, pkts)
+        (res_c, t_c) = timed(compiled_eval, tree, pkts)
+        assert res_i == res_c
+        print "%-8d %-8d %-14.0f %-14.0f %-12.3f %-10.3f" % (
+            n, len(c), num_pkts / t_i, num_pkts / t_c, t_compile, t_tree)
+
+def compile_workloads(n):
+    (fwds, macs) = gen_forwarding_policy(n)
+    rnd = random.Random(0)
+    acl = drop
+    for i in range(n // 10 + 1):
+        acl |= match(srcmac=rnd.choice(macs),
+                     dstip='10.%d.%d.0/24' % (i // 256, i % 256))
+    return [('forwarding', fwds, macs),
+            ('acl >> fwd', ~acl >> fwds, macs),
+            ('fabric', fabric_policy(4 * n), macs)]
+
+def bench_compile(sizes, naive_limit, num_pkts=1000):
+    print "%-12s %-6s %-10s %-10s %-10s %-10s" % (
+        'policy', 'n', 'rules', 'fdd rules', 'native(s)', 'fdd(s)')
+    for n in sizes:
+        # fresh policies for each compiler, as both cache classifiers
+        workloads = zip(compile_workloads(n), compile_workloads(n))
+        for ((name, pol, macs), (_, fdd_pol, _)) in workloads:
+            (c_fdd, t_fdd) = timed(lambda: fdd_pol.fdd_compile()[0])
+            rules = '-'
+            t_native = '-'
+            if n <= naive_limit:
+                (c, t) = timed(pol.compile)
+                (rules, t_native) = (len(c), '%.3f' % t)
+            for pkt in gen_packets(num_pkts, macs):
+                assert c_fdd.eval(pkt) == pol.eval(pkt)
+            print "%-12s %-6d %-10s %-10d %-10s %-10.3f" % (
+                name, n, rules, len(c_fdd), t_native, t_fdd)
+
+def gen_churn(num_rules, num_updates, seed=0):
+    """ Generate the successive rule lists (match, action) of one switch
+    table, each update inserting, deleting or rewriting one ACL line. """
+    rnd = random.Random(seed)
+    table = [(gen_match(rnd, num_switches=1), rnd.randint(1, 8))
+             for i in range(num_rules)]
+    yield list(table)
+    for u in range(num_updates):
+        op = rnd.random()
+        if op < 0.4:
+            table.insert(rnd.randint(0, len(table)),
+                         (gen_match(rnd, num_switches=1), rnd.randint(1, 8)))
+        elif op < 0.8:
+            table.pop(rnd.randrange(len(table)))
+        else:
+            i = rnd.randrange(len(table))
+            table[i] = (table[i][0], rnd.randint(1, 8))
+        yield list(table)
+
+def flow_mods(old, new):
+    """ Number of flow-mods the incremental diff sends to move from one
+    table, mapping (match, priority) to actions, to another. """
+    mods = 0
+    for (k, act) in new.iteritems():
+        if old.get(k, act) != act:
+            mods += 1  # modify
+        elif not k in old:
+            mods += 1  # add
+    return mods + sum(1 for k in old if not k in new)
+
+def bench_priority(sizes, naive_limit, num_updates=200):
+    print "%-10s %-14s %-14s %-12s %-10s" % (
+        'rules', 'position mods', 'stable mods', 'rebalances', 'stable(s)')
+    for n in sizes:
+        allocator = PriorityAllocator()
+        (old_pos, old_stable) = ({}, {})
+        (pos_mods, stable_mods, t_stable) = (0, 0, 0)
+        for (u, table) in enumerate(gen_churn(n, num_updates)):
+            pos = dict(((m, TABLE_START_PRIORITY - i), a)
+                       for (i, (m, a)) in enumerate(table))
+            (prios, t) = timed(allocator.allocate, [m for (m, a) in table])
+            stable = dict(((m, p), a) for ((m, a), p) in zip(table, prios))
+            if u > 0:
+                pos_mods += flow_mods(old_pos, pos)
+                stable_mods += flow_mods(old_stable, stable)
+                t_stable += t
+            (old_pos, old_stable) = (pos, stable)
+        print "%-10d %-14.1f %-14.1f %-12d %-10.4f" % (
+            n, float(pos_mods) / num_updates, float(stable_mods) / num_updates,
+            allocator.rebalances, t_stable / num_updates)
+
+def reactive_switch(tree, pkts, wildcard):
+    """ Send pkts through a switch whose table starts empty and gets rules
+    for each packet-in, matching all of its fields (reactive0) or its
+    wildcard region, plus the region at each outport unless it matches on
+    the inport (reactive1). Returns the (rules, packet-ins) counts. """
+    exact = set()
+    regions = []
+    rules = 0
+    for pkt in pkts:
+        entry = tree.lookup(pkt)
+        if pkt.header in exact:
+            continue
+        hit = [e for (m, e) in regions if m.eval(pkt)]
+        if hit:
+            assert same_actions(hit[0][0].actions, entry[0].actions)
+            continue
+        region = None
+        if wildcard:
+            region = wildcard_region(tree.entries, entry, pkt)
+        if region is None:
+            exact.add(pkt.header)
+            rules += 1
+        else:
+            regions.append((region, entry))
+            outports = set(a.map['port'] for a in entry[0].actions
+                           if isinstance(a, modify) and 'port' in a.map)
+            rules += 1 + (0 if 'port' in region.map else len(outports))
+    return (rules, len(exact) + len(regions))
+
+def bench_reactive(sizes, naive_limit, num_pkts=10000):
+    print "%-8s %-8s %-8s %-10s %-12s %-10s %-12s" % (
+        'hosts', 'flows', 'rules', 'r0 rules', 'r0 pkt-ins', 'r1 rules',
+        'r1 pkt-ins')
+    for n in sizes:
+        (pol, macs) = gen_forwarding_policy(n)
+        pkts = gen_packets(num_pkts, macs)
+        tree = DecisionTree(pol.compile().rules)
+        (r0_rules, r0_ins) = reactive_switch(tree, pkts, False)
+        (r1_rules, r1_ins) = reactive_switch(tree, pkts, True)
+        print "%-8d %-8d %-8d %-10d %-12d %-10d %-12d" % (
+            n, len(set(p.header for p in pkts)), len(tree.entries),
+            r0_rules, r0_ins, r1_rules, r1_ins)
+
+BENCHMARKS = {'ast': bench_ast,
+              'compile': bench_compile,
+              'eval': bench_eval,
+              'memo': bench_memo,
+              'shadow': bench_shadow,
+              'parallel': bench_parallel,
+              'priority': bench_priority,
+              'reactive': bench_reactive}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Classifier micro-benchmarks")
+    parser.add_argument('--bench', '-b', choices=sorted(BENCHMARKS.keys()),
+                        default='shadow', help='benchmark to run')
+    parser.add_argument('--sizes', '-n', type=int, nargs='+',
+                        default=[1000, 10000, 50000],
+                        help='classifier sizes (number of rules)')
+    parser.add_argument('--naive_limit', type=int, default=5000,
+                        help='largest size to also run the baseline on')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    BENCHMARKS[args.bench](args.sizes, args.naive_limit)
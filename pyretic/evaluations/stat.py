@@ -9,6 +9,8 @@ class Stat(object):
     times = {}
     classifiers = {}
     general_stats = {}
+    part_times = {}
+    caches = {}
     monitoring = False
     ################
 
@@ -43,6 +45,9 @@ class Stat(object):
         cls.times = {}
         cls.classifiers = {}
         cls.general_stats = {}
+        cls.part_times = {}
+        for cache in cls.caches.values():
+            cache.reset_stats()
         
         if results_folder:
             cls.results_path = os.path.join(cls.base_path, results_folder)
@@ -98,8 +103,51 @@ class Stat(object):
         
         cls.report_dfa(f)
         f.write(str(cls.general_stats) + "\n--------------\n")
+        cls.report_part_times(f)
+        cls.report_caches(f)
         f.close()
 
+    @classmethod
+    def collect_times(cls, name, times):
+        '''
+        Record the times taken by the parts of a compilation (e.g. by the
+        states of a QuerySwitch), as a list of (part, time) pairs.
+        '''
+        if cls.monitoring:
+            if name not in cls.part_times:
+                cls.part_times[name] = []
+            cls.part_times[name].append(times)
+
+    @classmethod
+    def report_part_times(cls, f):
+        f.write('############# Part Times ###############\n')
+        for (name, runs) in sorted(cls.part_times.items()):
+            for times in runs:
+                slowest = sorted(times, key=lambda (part, t): -t)[:5]
+                f.write('%s : %d parts, total %f, slowest %s\n' % (
+                    name, len(times), sum(t for (part, t) in times),
+                    str(slowest)))
+        f.write('--------------------\n')
+
+    @classmethod
+    def register_cache(cls, name, cache):
+        '''
+        Report the hit/miss counters of cache (which has stats() and
+        reset_stats() methods) under name, for every monitoring run.
+        '''
+        cls.caches[name] = cache
+
+    @classmethod
+    def cache_stats(cls):
+        return dict((name, cache.stats()) for (name, cache) in cls.caches.items())
+
+    @classmethod
+    def report_caches(cls, f):
+        f.write('############# Cache Stats ###############\n')
+        for (name, stats) in sorted(cls.cache_stats().items()):
+            f.write('%s : %s\n' % (name, str(stats)))
+        f.write('--------------------\n')
+
     @classmethod
     def elapsed_time(cls, func):
 
@@ -66,13 +66,11 @@ MAX_STAGES = 13
 # Runtime write log, for a single place to log everything from the runtime
 # Default is None.
 rt_write_log=None
-# QuerySwitch compilation parallelism has this limit on maximum number of
-# spawned processes.
-QS_MAX_PROCESSES = 6
-# Flag to remember if parallel Frenetic compilers have started
-par_frenetics_started=False
 # Maximum number of states allowed
 NUM_PATH_TAGS=32000
+# Build DFAs for the ragel_enabled compilation with the `ragel` binary, through
+# temporary files, rather than in-process with make_table_dfa.
+RAGEL_BINARY=False
 # virtual stage identifier for virtual virtual headers. An unreasonably high
 # number that can never be a "stage" for virtual header fields that actually
 # live in the data plane.
@@ -1844,11 +1842,11 @@ class QuerySwitch(Policy):
         return c
 
     def netkat_compile(self, switch_cnt=None, multistage=True):
-        """ QuerySwitch netkat compilation. """
+        """ QuerySwitch netkat compilation. The policies of the states are
+        compiled concurrently by the NetKAT workers, and their rules put
+        together in the order of the states. """
         from pyretic.core.classifier import Rule, Classifier
-        import time
-        tot_time = 0
-        t_s = time.time()
+        from pyretic.core.netkat import netkat_backend
         def resolve_virtual_fields(act):
             try:
                 if isinstance(act, modify):
@@ -1862,74 +1860,17 @@ class QuerySwitch(Policy):
             except:
                 return act
 
-        comp_defaults = set(map(resolve_virtual_fields, self.default))
-        final_rules = []
-        for tag_value in self.policy_dic:
-            tot_time += time.time() - t_s
+        def compile_state(tag_value, server_port):
+            """ Compile the policy of a state, specializing its rules to the
+            state's tag value. """
             p_class = self.policy_dic[tag_value].netkat_compile(
                 switch_cnt=switch_cnt,
-                multistage=multistage)
-            p_rules = p_class[0].rules
-            tot_time += float(p_class[1])
-            t_s = time.time()
-            for r in p_rules:
-                new_match = r.match.intersect(match(**{self.tag : tag_value}))
-                new_match = new_match.compile().rules[0].match
-                if new_match == drop:
-                    raise TypeError
-                new_r = copy.copy(r)
-                new_r.match = new_match
-                if not new_r.actions:
-                    new_r.actions = comp_defaults
-                new_r.parents = [r]
-                new_r.op = "switch"
-                final_rules.append(new_r)
-
-        final_rules.append(Rule(identity, comp_defaults, [self], "switch"))
-        c = Classifier(final_rules)
-        tot_time += time.time() - t_s
-        return (c, str(tot_time))
-
-    def netkat_compile_par(self, switch_cnt=None, multistage=True):
-        """ QuerySwitch netkat compilation; the parallel version. """
-        global rt_write_log
-        import multiprocessing
-        from multiprocessing import Process
-        from pyretic.core.classifier import Rule, Classifier
-        import cProfile, pstats, StringIO
-        import time
-        from Queue import Empty as QE
-        import subprocess, shlex
-        from pyretic.core.netkat import NETKAT_PORT
-        global par_frenetics_started
-
-        def resolve_virtual_fields(act):
-            try:
-                if isinstance(act, modify):
-                    r = act.compile().rules[0]
-                    (mod_act,) =  r.actions
-                    return mod_act
-                if isinstance(act, match):
-                    return act.compile().rules[0].match
-                
-                return act
-            except:
-                return act
-
-        def tagwise_helper(tag_field, tag_value, tag_policy, switch_cnt,
-                           multistage, comp_defaults, frenetic_port):
-            """ This function computes the classifier for a given state
-            (tag_value) specialized by the value of the state on all
-            matches. This is core to the compilation logic of QuerySwitch. """
-            p_class = tag_policy.netkat_compile(switch_cnt=switch_cnt,
-                                                multistage=multistage,
-                                                server_port=frenetic_port)
-            p_rules = p_class[0].rules
-            netkat_time = float(p_class[1])
+                multistage=multistage,
+                server_port=server_port)
             t_s = time.time()
             final_rules = []
-            for r in p_rules:
-                new_match = r.match.intersect(match(**{tag_field : tag_value}))
+            for r in p_class[0].rules:
+                new_match = r.match.intersect(match(**{self.tag : tag_value}))
                 new_match = new_match.compile().rules[0].match
                 if new_match == drop:
                     raise TypeError
@@ -1940,251 +1881,20 @@ class QuerySwitch(Policy):
                 new_r.parents = [r]
                 new_r.op = "switch"
                 final_rules.append(new_r)
-            other_time = time.time() - t_s
-            return (tag_value, final_rules, netkat_time, other_time)
-
-        def tagwise_process(tag_field, outq, tag_value, tag_policy,
-                            switch_cnt, multistage, comp_defaults,
-                            frenetic_port):
-            outq.put(tagwise_helper(tag_field, tag_value, tag_policy,
-                                    switch_cnt, multistage, comp_defaults,
-                                    frenetic_port))
-            return 0
-
-        def setwise_process(tag_field, outq, tag_policy_set, switch_cnt,
-                            multistage, comp_defaults, frenetic_port):
-            """ Compile a set of tag -> policy policies from the
-            QuerySwitch. This is the core compilation logic in QuerySwitch. """
-            for (tag_value, tag_policy) in tag_policy_set:
-                final_rules = []
-                p_class = tag_policy.netkat_compile(switch_cnt=switch_cnt,
-                                                    multistage=multistage,
-                                                    server_port=frenetic_port)
-                t_s = time.time()
-                p_rules = p_class[0].rules
-                netkat_time = float(p_class[1])
-                for r in p_rules:
-                    new_match = r.match.intersect(match(**{tag_field : tag_value}))
-                    new_match = new_match.compile().rules[0].match
-                    if new_match == drop:
-                        raise TypeError
-                    new_r = copy.copy(r)
-                    new_r.match = new_match
-                    if not new_r.actions:
-                        new_r.actions = comp_defaults
-                    new_r.parents = [r]
-                    new_r.op = "switch"
-                    final_rules.append(new_r)
-                other_time = time.time() - t_s
-                outq.put((tag_value, final_rules, netkat_time, other_time))
-            return 0
-
-        def wait_outputs(unscheduled_remaining, num_completed, num_total,
-                         tagwise_rules, outputs, queue_timeout=2,
-                         max_retries=5):
-            """ This function implements the logic to wait for a spawned process
-            to complete its execution. Used by the process pool to implement
-            parallelized compilation over states. """
-            num_retries = max_retries
-            while True:
-                try:
-                    next_ruleset = outputs.get(block=True, timeout=2)
-                    tagwise_rules.append(next_ruleset)
-                    num_completed += 1
-                    num_retries = max_retries
-                    rt_write_log.info("%d outputs have completed (%d total)" %
-                                      (num_completed, num_total))
-                    if unscheduled_remaining or (num_completed == num_total):
-                        return num_completed
-                except QE:
-                    rt_write_log.error("Empty queue after waiting 2 sec")
-                    rt_write_log.info("%d outputs have completed" %
-                                      num_completed)
-                    if num_completed > 0:
-                        # only subtract retries if we know outputs have started
-                        # coming already. Note: this is dangerous because it is
-                        # possible that the process waits indefinitely
-                        # for outputs forever.
-                        num_retries -= 1
-                    if num_retries == 0:
-                        return 0
-
-        def chunks(l, n):
-            """ generate successive n-sized from a list l. """
-            for i in xrange(0, len(l), n):
-                yield l[i:i+n]
-
-        def pset_pool_compile(policy_dic, comp_defaults, tag,
-                               use_standard_port=False):
-            """ Implement a process pool where the querySwitch policies are
-            partitioned off among a pre-generated static number of
-            processes. There are no more than QS_MAX_PROCESSES spawned through
-            the entire time. """
-            outputs = multiprocessing.Queue()
-            q_timeout = 2
-            q_maxretries = 20
-            all_tagpols = [x for x in policy_dic.iteritems()]
-            chunk_size = (len(all_tagpols) / QS_MAX_PROCESSES) + 1
-            tagpolsets = list(chunks(all_tagpols, chunk_size))
-            assert len(tagpolsets) <= QS_MAX_PROCESSES
-            iter_tagpolsets = zip(range(1, len(tagpolsets)+1), tagpolsets)
-            for (index, tagpolset) in iter_tagpolsets:
-                rt_write_log.info("Spawning a new process with %d items" %
-                                  len(tagpolset))
-                proc_port = 0 if use_standard_port else index
-                proc_port += NETKAT_PORT
-                p = Process(target=setwise_process,
-                            args=((tag, outputs,tagpolset,switch_cnt,
-                                   multistage, comp_defaults, proc_port)))
-                p.start()
-            num_completed = 0
-            num_total = len(policy_dic.keys())
-            tagwise_rules = []
-            completed = wait_outputs(False, num_completed, num_total,
-                                     tagwise_rules, outputs,
-                                     q_timeout, q_maxretries)
-            if completed > 0:
-                assert completed == num_total
-            else:
-                raise RuntimeError("Processes did not make enough progress in %d"
-                                   " seconds" % (q_timeout * q_maxretries))
-            rt_write_log.info("Got ALL the outputs back from processes!")
-            return tagwise_rules
-
-        def process_pool_compile(policy_dic, comp_defaults, tag,
-                                 use_standard_port=False):
-            """ Implement a process pool to parallelize the compilation of
-            QuerySwitch over at most QS_MAX_PROCESSES processes. This method
-            spawns a new process for each new tag policy that's being
-            compiled."""
-            outputs = multiprocessing.Queue()
-            q_timeout = 2
-            q_maxretries = 5
-            rt_write_log.info("Parallelizing %d jobs into %d processes" % (
-                len(policy_dic.keys()), QS_MAX_PROCESSES))
-            num_active_procs = 0
-            num_completed = 0
-            num_total = len(policy_dic.keys())
-            tagwise_rules = []
-            total_scheduled = 0
-            for tagpol in policy_dic.iteritems():
-                if num_active_procs >= QS_MAX_PROCESSES:
-                    rt_write_log.info("Max process threshold: wait for process results...")
-                    completed = wait_outputs(True, num_completed, num_total,
-                                             tagwise_rules, outputs,
-                                             q_timeout, q_maxretries)
-                    if completed > 0:
-                        num_completed = completed
-                        num_active_procs -= 1
-                    else:
-                        raise RuntimeError("Processes did not make enough progress"
-                                           "in %d seconds" % (q_timeout *
-                                                          q_maxretries))
-                assert num_active_procs < QS_MAX_PROCESSES
-                rt_write_log.info("Schedule new compile process...")
-                # TODO: this isn't *ideal* load balancing; since processes don't
-                # necessarily complete in the order they were spawned.
-                proc_port = 0 if use_standard_port else (total_scheduled %
-                                                         QS_MAX_PROCESSES)
-                proc_port += NETKAT_PORT
-                p = Process(target=tagwise_process,
-                            args=((tag, outputs,) + tagpol +
-                                  (switch_cnt, multistage, comp_defaults,
-                                   proc_port)))
-                p.start()
-                total_scheduled += 1
-                num_active_procs += 1
-                rt_write_log.info("Scheduled %d'th process (%d active)" %
-                                  (total_scheduled, num_active_procs))
-            # At most QS_MAX_PROCESSES compilations remain to finish; and
-            # they've all been scheduled by now.
-            completed = wait_outputs(False, num_completed, num_total,
-                                     tagwise_rules, outputs,
-                                     q_timeout, q_maxretries)
-            if completed > 0:
-                assert completed == num_total
-            else:
-                raise RuntimeError("Processes did not make enough progress in %d"
-                                   " seconds" % (q_timeout * q_maxretries))
-            rt_write_log.info("Got ALL the outputs back from processes!")
-            return tagwise_rules
-
-        def start_frenetics(docker_start):
-            global par_frenetics_started
-            par_frenetics_started = True
-            num_servers = QS_MAX_PROCESSES
-            plist = []
-            for proc in range(1, num_servers+1):
-                port = NETKAT_PORT + proc
-                if docker_start:
-                    netkat_cmd = ("bash start-docker.sh %d" % port)
-                else:
-                    netkat_cmd = ("./frenetic compile-server --http-port %d"
-                                  " --verbosity error" % port)
-                try:
-                    phandle = subprocess.Popen(shlex.split(netkat_cmd), #shell=True,
-                                               stderr=subprocess.STDOUT)
-                    rt_write_log.info("Executed command %s" % netkat_cmd)
-                    plist.append(phandle)
-                except Exception as e:
-                    print "Could not start frenetic server successfully."
-                    print e
-                    sys.exit(1)
-            time.sleep(2) # to allow daemons to be started
-            return plist
-
-        def kill_frenetics(phandles):
-            for p in phandles:
-                p.terminate()
+            return (final_rules, float(p_class[1]) + time.time() - t_s)
 
-        t_s = time.time()
-        profile_enabled = False
-        if profile_enabled:
-            pr = cProfile.Profile()
-            pr.enable()
         comp_defaults = set(map(resolve_virtual_fields, self.default))
-        parallelize_frenetic = True
-        parallelize_compilation = False
-        docker_start = True
-        if parallelize_compilation:
-            phandles = (start_frenetics(docker_start) if parallelize_frenetic
-                        else [])
-            time.sleep(1)
-            # Try the "process-set" pool, instead of "process" pool, for compilation.
-            pool_method = pset_pool_compile
-            tagwise_rules = pool_method(self.policy_dic, comp_defaults, self.tag,
-                                        use_standard_port=not
-                                        parallelize_frenetic)
-            kill_frenetics(phandles)
-        else:
-            frenetic_port = NETKAT_PORT
-            tagwise_rules = []
-            for (tag_value, tag_policy) in self.policy_dic.iteritems():
-                tagwise_rules.append(tagwise_helper(self.tag, tag_value, tag_policy,
-                                                    switch_cnt, multistage, comp_defaults,
-                                                    frenetic_port))
-        # Aggregate results and return the final classifier
-        netkat_tot_time = 0.0
-        other_tot_time = 0.0
-        tot_time = 0.0
+        tag_values = sorted(self.policy_dic.keys())
+        results = netkat_backend.workers.map(compile_state, tag_values)
         final_rules = []
-        for (tag_value, tag_rules, netkat_time, other_time) in tagwise_rules:
+        tot_time = 0.0
+        for (tag_rules, state_time) in results:
             final_rules += tag_rules
-            netkat_tot_time += netkat_time
-            other_tot_time += other_time
-            tot_time += (netkat_time + other_time)
+            tot_time += state_time
         final_rules.append(Rule(identity, comp_defaults, [self], "switch"))
         c = Classifier(final_rules)
-        if profile_enabled:
-            pr.disable()
-            s = StringIO.StringIO()
-            sortby = 'cumulative'
-            ps = pstats.Stats(pr, stream=s).sort_stats(sortby)
-            ps.print_stats()
-        wall_clock_time = time.time() - t_s
-        rt_write_log.info("netkat time: %f; other time: %f" % (netkat_tot_time,
-                                                               other_tot_time))
-        rt_write_log.info("wall clock time: %f" % wall_clock_time)
+        Stat.collect_times('querySwitch', zip(tag_values,
+                                              [t for (r, t) in results]))
         return (c, str(tot_time))
 
     def __repr__(self):
@@ -3417,52 +3127,19 @@ class ragel_dfa_utils(common_dfa_utils):
     
     @classmethod
     def get_extended_edges_contracted(cls, output):
-        res = []
-        edge_ordinals = {}
-        dfa_dict = {}
-        for line in output.splitlines():
-            if not '->' in line or 'IN' in line or 'main' in line:
-                continue
-            
-            line = line.strip()
+        return cls.contract_edges(*cls.get_extended_edges(output))
 
-            label = line[line.index('=') + 3: line.index(']') - 2]
-            
-            dst = line[line.index('->') + 3 : line.index('[') - 1]
-            src = line[:line.index('->') - 1]
-            dst = cls.get_state(dst)
-            src = cls.get_state(src)
-            
+    @classmethod
+    def contract_edges(cls, edges, edge_ordinals):
+        """ Replace the edges between two states on all the symbols of the
+        identity predicate by a single IN_ID or OUT_ID edge. """
+        res = edges
+        dfa_dict = {}
+        for edge in edges:
+            (src, sym, dst) = edge
             if not (src, dst) in dfa_dict:
                 dfa_dict[(src, dst)] = []
-
-            parts = [s.strip() for s in label.split('/')]
-            exp_list = []
-            if len(parts) > 1:
-                for exp_num in [s.strip() for s in parts[1].split(',')]:
-                    try:
-                        exp_num = int(exp_num[1:])
-                        exp_list.append(exp_num)
-                    except:
-                        pass
-
-            syms = [s.strip().replace('"','') for s in parts[0].split(',')]
-            for s in syms:
-                if '..' in s:
-                    index = s.index('..')
-                    start = int(s[:index])
-                    end = int(s[index + 2:])
-                    for i in range(start, end + 1):
-                        edge = (src, i, dst)
-                        dfa_dict[(src,dst)].append( edge)
-                        res.append(edge)
-                        edge_ordinals[edge] = exp_list
-                else:
-                    edge = (src, int(s), dst)
-                    dfa_dict[(src, dst)].append(edge)
-                    res.append(edge)
-                    edge_ordinals[edge] = exp_list
-
+            dfa_dict[(src, dst)].append(edge)
 
         def create_id_list(re_tree):
             if isinstance(re_tree, re_symbol):
@@ -3574,6 +3251,23 @@ class ragel_dfa_utils(common_dfa_utils):
                     edge_ordinals[edge] = exp_list
         return (res, edge_ordinals)
 
+    @classmethod
+    def get_table_edges(cls, table_dfa):
+        """ The accepting states, number of states, edges and edge ordinals of
+        a re_table_dfa, numbered as get_accepting_states and
+        get_extended_edges number those of ragel's output. """
+        state = lambda q: None if q == 0 else q
+        accepting_states = [state(q) for q in range(table_dfa.num_states)
+                            if table_dfa.final[q]]
+        res = []
+        edge_ordinals = {}
+        for (src, syms, dst, ords) in table_dfa.edges():
+            for sym in syms:
+                edge = (state(src), sym, state(dst))
+                res.append(edge)
+                edge_ordinals[edge] = list(ords)
+        return (accepting_states, table_dfa.num_states, res, edge_ordinals)
+
     @classmethod
     def get_edges(cls, dfa):
         return dfa.edges
@@ -3689,44 +3383,22 @@ class ragel_dfa_utils(common_dfa_utils):
                 edges.append((s, sym, dead))
 
     @classmethod
-    @Stat.elapsed_time
-    def regexes_to_dfa(cls, re_list, use_fdd=False):
-        import cProfile, pstats, StringIO
-        import time
-        global rt_write_log
-        profile_enabled = True
-        lex_gen_time = 0.0
-        lex_write_time = 0.0
-        ragel_time = 0.0
-        graph_read_time = 0.0
-        dfa_attr_gen_time = 0.0
-        leaf_gen_time = 0.0
-        dfa_gen_time = 0.0
-        if profile_enabled:
-            pr = cProfile.Profile()
-            pr.enable()
-        t_s = time.time()
-        re_list = zip(range(len(re_list)), re_list)
-        lex_input = cls.regex_to_ragel_format(re_list, use_fdd)
-        lex_gen_time = time.time() - t_s
-
-        t_s = time.time()
+    def run_ragel(cls, re_list, use_fdd):
+        """ Compile the regular expressions with the ragel binary, and return
+        its DOT output. """
+        lex_input = cls.regex_to_ragel_format(zip(range(len(re_list)),
+                                                  re_list), use_fdd)
         lex_input_file = '/tmp/pyretic-regexes.txt'
         f = open(lex_input_file, 'w')
         f.write(lex_input)
         f.close()
-        lex_write_time = time.time() - t_s
         try:
             g = open('/tmp/graph.dot', 'w')
-            t_s = time.time()
             subprocess.call(['ragel', '-V', lex_input_file], stdout=g)
             g.close()
-            ragel_time = time.time() - t_s
-            t_s = time.time()
             g = open('/tmp/graph.dot')
             output = g.read()
             g.close()
-            graph_read_time = time.time() - t_s
         except subprocess.CalledProcessError as e:
             
             print "Error occured while running ragel"
@@ -3734,44 +3406,45 @@ class ragel_dfa_utils(common_dfa_utils):
             print e.returncode
             print e.cmd
             print e.output
+        return output
 
+    @classmethod
+    @Stat.elapsed_time
+    def regexes_to_dfa(cls, re_list, use_fdd=False):
+        import time
+        global rt_write_log
         t_s = time.time()
-        (accepting_states, state_num) = cls.get_accepting_states(output)
-        if cls.edge_contraction_enabled:
-            (edges, edge_ordinal) = cls.get_extended_edges_contracted(output)
-        else:
+        if RAGEL_BINARY:
+            output = cls.run_ragel(re_list, use_fdd)
+            (accepting_states, state_num) = cls.get_accepting_states(output)
             (edges, edge_ordinal) = cls.get_extended_edges(output)
+        else:
+            alphabet = sorted(cls.in_cg.symbol_to_pred.keys() +
+                              cls.out_cg.symbol_to_pred.keys())
+            table_dfa = make_table_dfa(re_list, alphabet)
+            if Stat.monitoring:
+                dfa_utils.__dump_file__(table_dfa.dot_repr(), Stat.dfa_path)
+            (accepting_states, state_num, edges,
+             edge_ordinal) = cls.get_table_edges(table_dfa)
+        dfa_gen_time = time.time() - t_s
+
+        t_s = time.time()
+        if cls.edge_contraction_enabled:
+            (edges, edge_ordinal) = cls.contract_edges(edges, edge_ordinal)
         # Add missing edges going to dead states, if needed.
         cls.add_dead_edges(edges, state_num)
         dfa_attr_gen_time = time.time() - t_s
        
-        #print 'dfa stat count', state_num
-        #print 'dfa edge count', len(edges)  
-        t_s = time.time()
-        leaf_preds = (cls.in_cg.get_leaf_preds() +
-                      cls.out_cg.get_leaf_preds())
-       
-        dfa_utils.__dump_file__(leaf_preds, '/tmp/symbols.txt')
-        leaf_gen_time = time.time() - t_s
+        if RAGEL_BINARY or Stat.monitoring:
+            leaf_preds = (cls.in_cg.get_leaf_preds() +
+                          cls.out_cg.get_leaf_preds())
+            dfa_utils.__dump_file__(leaf_preds, Stat.symbol_path)
 
-        t_s = time.time()
         dfa = ragel_dfa(state_num, accepting_states, None, edges, edge_ordinal)
-        dfa_gen_time = time.time() - t_s
-        if profile_enabled:
-            pr.disable()
-            s = StringIO.StringIO()
-            sortby = 'cumulative'
-            ps = pstats.Stats(pr, stream=s).sort_stats(sortby)
-            ps.print_stats()
-            rt_write_log.info(s.getvalue())
-        rt_write_log.info("Times:\n" +
-                          "lex_gen_time: %f\n" % lex_gen_time +
-                          "lex_write_time: %f\n" % lex_write_time +
-                          "ragel_time: %f\n" % ragel_time +
-                          "graph_read_time: %f\n" % graph_read_time +
-                          "dfa_attr_gen_time: %f\n" % dfa_attr_gen_time +
-                          "leaf_gen_time: %f\n" % leaf_gen_time +
-                          "dfa_gen_time: %f\n" % dfa_gen_time)
+        if rt_write_log:
+            rt_write_log.info("Times:\n" +
+                              "dfa_gen_time: %f\n" % dfa_gen_time +
+                              "dfa_attr_gen_time: %f\n" % dfa_attr_gen_time)
         return dfa
 
 
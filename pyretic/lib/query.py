@@ -27,6 +27,7 @@
 ################################################################################
 
 from pyretic.core.language import identity, match, union, DerivedPolicy, DynamicFilter, Query, FwdBucket, CountBucket, DynamicPolicy
+from pyretic.core.event_loop import get_event_loop
 import time
 import copy
 import re
@@ -125,9 +126,12 @@ class counts(DynamicPolicy):
         self.queried_preds_lock = Lock()
 
     def set_up_polling(self,interval):
-        """Setup polling of stats from switches every `interval` seconds. If
-        interval is None, the application needs to call pull_stats directly."""
-        if interval:
+        """Setup polling of stats from switches every `interval` seconds, on
+        the runtime's event loop if it has one. If interval is None, the
+        application needs to call pull_stats directly."""
+        if interval and get_event_loop():
+            self.qt = get_event_loop().call_every(interval, self.pull_stats)
+        elif interval:
             self.qt = Thread(target=self.query_thread, args=(interval,))
             self.qt.daemon = True
             self.qt.start()
@@ -216,9 +220,18 @@ class AggregateFwdBucket(FwdBucket):
                     callback(aggregate)
                 time.sleep(interval)
 
-        self.query_thread = Thread(target=report_count,args=(self.callbacks,self.aggregate,self.interval))
-        self.query_thread.daemon = True
-        self.query_thread.start()
+        loop = get_event_loop()
+        if loop:
+            def report():
+                for callback in self.callbacks:
+                    callback(aggregate)
+            aggregate = self.aggregate
+            loop.call_soon(report)
+            self.query_thread = loop.call_every(self.interval, report)
+        else:
+            self.query_thread = Thread(target=report_count,args=(self.callbacks,self.aggregate,self.interval))
+            self.query_thread.daemon = True
+            self.query_thread.start()
 
     def aggregator(self,aggregate,pkt):
         raise NotImplementedError
@@ -29,6 +29,7 @@
 # for regular expressions.                                                     #
 ################################################################################
 from pyretic.evaluations.stat import Stat
+from array import array
 import string
 try:
     import pyretic.vendor
@@ -1407,3 +1408,477 @@ def makeDFA_vector(re_list, alphabet_list):
     explore_vector(states, tt, q0, alphabet_list)
     f = states.get_final_states()
     return re_vector_dfa(states, q0, f, tt, alphabet_list)
+
+################################################################################
+# Table-driven DFA construction                                                #
+################################################################################
+# makeDFA_vector explores every symbol from every state, comparing whole regex
+# trees. The builder below hash-conses expressions into integer nodes, takes
+# derivatives once per class of symbols that no expression tells apart, and
+# minimizes the resulting DFA, keeping its transitions in flat arrays.
+
+RE_EMPTY   = 0
+RE_EPSILON = 1
+RE_SYMBOLS = 2
+RE_CONCAT  = 3
+RE_ALTER   = 4
+RE_STAR    = 5
+RE_INTERS  = 6
+RE_NEGATE  = 7
+
+class re_node_table(object):
+    """ Regular expressions as integer nodes. Each distinct expression, in the
+    normal form enforced by the constructors below, is made once, so that
+    expressions are compared, hashed and memoized as integers. A RE_SYMBOLS
+    node matches any one symbol of a set. """
+    def __init__(self, alphabet=()):
+        self.alphabet = alphabet
+        self.nodes = []
+        self.index = {}
+        self.nullable = []
+        self.derivs = {}
+        self.empty = self.node(RE_EMPTY, ())
+        self.epsilon = self.node(RE_EPSILON, ())
+        self.anything = self.node(RE_NEGATE, (self.empty,))
+
+    def node(self, kind, args):
+        key = (kind, args)
+        n = self.index.get(key)
+        if n is None:
+            n = len(self.nodes)
+            self.nodes.append(key)
+            self.index[key] = n
+            if kind == RE_CONCAT:
+                null = self.nullable[args[0]] and self.nullable[args[1]]
+            elif kind == RE_ALTER:
+                null = any(self.nullable[a] for a in args)
+            elif kind == RE_INTERS:
+                null = all(self.nullable[a] for a in args)
+            elif kind == RE_NEGATE:
+                null = not self.nullable[args[0]]
+            else:
+                null = kind in [RE_EPSILON, RE_STAR]
+            self.nullable.append(null)
+        return n
+
+    def symbols(self, syms):
+        syms = frozenset(syms)
+        if not syms:
+            return self.empty
+        return self.node(RE_SYMBOLS, syms)
+
+    def concat(self, r, s):
+        if r == self.empty or s == self.empty:
+            return self.empty
+        if r == self.epsilon:
+            return s
+        if s == self.epsilon:
+            return r
+        (kind, args) = self.nodes[r]
+        if kind == RE_CONCAT:
+            return self.concat(args[0], self.concat(args[1], s))
+        return self.node(RE_CONCAT, (r, s))
+
+    def combine(self, kind, rs, unit, zero):
+        """ Flatten, merge symbol sets and sort the operands of an
+        associative, commutative and idempotent operator. """
+        operands = set()
+        syms = None
+        for r in rs:
+            (k, args) = self.nodes[r]
+            for r in (args if k == kind else (r,)):
+                if r == zero:
+                    return zero
+                if r == unit:
+                    continue
+                (k, args) = self.nodes[r]
+                if k != RE_SYMBOLS:
+                    operands.add(r)
+                elif syms is None:
+                    syms = args
+                elif kind == RE_ALTER:
+                    syms = syms | args
+                else:
+                    syms = syms & args
+        if syms is not None:
+            r = self.symbols(syms)
+            if r == zero:
+                return zero
+            operands.add(r)
+        if not operands:
+            return unit
+        if len(operands) == 1:
+            return operands.pop()
+        return self.node(kind, tuple(sorted(operands)))
+
+    def alter(self, rs):
+        return self.combine(RE_ALTER, rs, self.empty, self.anything)
+
+    def inters(self, rs):
+        return self.combine(RE_INTERS, rs, self.anything, self.empty)
+
+    def star(self, r):
+        if r == self.empty or r == self.epsilon:
+            return self.epsilon
+        if self.nodes[r][0] == RE_STAR:
+            return r
+        return self.node(RE_STAR, (r,))
+
+    def negate(self, r):
+        (kind, args) = self.nodes[r]
+        if kind == RE_NEGATE:
+            return args[0]
+        return self.node(RE_NEGATE, (r,))
+
+    def deriv(self, r, a):
+        """ Derivative of node r with respect to symbol a. """
+        key = (r, a)
+        try:
+            return self.derivs[key]
+        except KeyError:
+            pass
+        (kind, args) = self.nodes[r]
+        if kind == RE_SYMBOLS:
+            d = self.epsilon if a in args else self.empty
+        elif kind == RE_CONCAT:
+            d = self.concat(self.deriv(args[0], a), args[1])
+            if self.nullable[args[0]]:
+                d = self.alter([d, self.deriv(args[1], a)])
+        elif kind == RE_ALTER:
+            d = self.alter([self.deriv(s, a) for s in args])
+        elif kind == RE_STAR:
+            d = self.concat(self.deriv(args[0], a), r)
+        elif kind == RE_INTERS:
+            d = self.inters([self.deriv(s, a) for s in args])
+        elif kind == RE_NEGATE:
+            d = self.negate(self.deriv(args[0], a))
+        else:
+            d = self.empty
+        self.derivs[key] = d
+        return d
+
+    def from_re(self, r):
+        """ The node of an re_deriv expression (dropping its metadata). """
+        if isinstance(r, re_symbol):
+            return self.symbols([r.char])
+        elif isinstance(r, re_epsilon):
+            return self.epsilon
+        elif isinstance(r, re_empty):
+            return self.empty
+        elif isinstance(r, re_concat):
+            return self.concat(self.from_re(r.re1), self.from_re(r.re2))
+        elif isinstance(r, re_alter):
+            return self.alter(map(self.from_re, r.re_list))
+        elif isinstance(r, re_star):
+            return self.star(self.from_re(r.re))
+        elif isinstance(r, re_inters):
+            return self.inters(map(self.from_re, r.re_list))
+        elif isinstance(r, re_negate):
+            return self.negate(self.from_re(r.re))
+        else:
+            raise TypeError('unexpected type for from_re!')
+
+    RE_WORDS = ['^any', 'any', 'epsilon', 'zlen']
+
+    def from_string(self, s):
+        """ The node of an expression in the subset of ragel syntax produced
+        by re_string_repr and path_policy.gen_re_string: symbol numbers,
+        `.` (or juxtaposition), `|`, `&`, `*`, `!` (complement), `^any`
+        (nothing) and `any`. """
+        tokens = []
+        pos = 0
+        while pos < len(s):
+            if s[pos].isspace():
+                pos += 1
+            elif s[pos].isdigit():
+                end = pos
+                while end < len(s) and s[end].isdigit():
+                    end += 1
+                tokens.append(s[pos:end])
+                pos = end
+            elif s[pos] in '()|&.*!':
+                tokens.append(s[pos])
+                pos += 1
+            else:
+                for w in self.RE_WORDS:
+                    if s.startswith(w, pos):
+                        tokens.append(w)
+                        pos += len(w)
+                        break
+                else:
+                    raise ValueError('unexpected character in regex at %d: %s'
+                                     % (pos, s))
+        tokens.append(None)
+        pos = [0]
+        def peek():
+            return tokens[pos[0]]
+        def take(tok=None):
+            t = tokens[pos[0]]
+            if tok is not None and t != tok:
+                raise ValueError('expected %s in regex, got %s: %s' %
+                                 (tok, t, s))
+            pos[0] += 1
+            return t
+        def union():
+            r = concat()
+            while peek() in ['|', '&']:
+                op = take()
+                r = (self.alter if op == '|' else self.inters)([r, concat()])
+            return r
+        def concat():
+            r = unary()
+            while peek() is not None and peek() not in ['|', '&', ')', '*']:
+                if peek() == '.':
+                    take()
+                r = self.concat(r, unary())
+            return r
+        def unary():
+            if peek() == '!':
+                take()
+                return self.negate(unary())
+            r = atom()
+            while peek() == '*':
+                take()
+                r = self.star(r)
+            return r
+        def atom():
+            t = take()
+            if t == '(':
+                r = union()
+                take(')')
+                return r
+            elif t == '^any':
+                return self.empty
+            elif t == 'any':
+                return self.symbols(self.alphabet)
+            elif t in ['epsilon', 'zlen']:
+                return self.epsilon
+            elif t is not None and t.isdigit():
+                return self.symbols([int(t)])
+            raise ValueError('unexpected %s in regex: %s' % (t, s))
+        r = union()
+        take(None)
+        return r
+
+class re_table_dfa(object):
+    """ A minimal DFA over classes of symbols, whose states are numbered from
+    the start state 0, with final states last. The transitions of state q are
+    transitions[q * len(classes) + c], for the symbols classes[c], -1 going
+    to the (implicit) dead state; outputs, laid out the same way, are the
+    ordinals of the expressions accepting on each transition. """
+    def __init__(self, classes, num_states, transitions, outputs, final,
+                 start_output):
+        self.classes = classes
+        self.num_states = num_states
+        self.transitions = transitions
+        self.outputs = outputs
+        self.final = final
+        self.start_output = start_output
+
+    def edges(self):
+        """ Yield the transitions (src, symbols, dst, ordinals) of the DFA, by
+        source state and class. """
+        k = len(self.classes)
+        for q in range(self.num_states):
+            for c in range(k):
+                dst = self.transitions[q * k + c]
+                if dst >= 0:
+                    yield (q, self.classes[c], dst, self.outputs[q * k + c])
+
+    def accepting_exps(self, syms):
+        """ The ordinals of the expressions accepting the list of symbols. """
+        k = len(self.classes)
+        class_of = dict((a, c) for c in range(k) for a in self.classes[c])
+        (q, out) = (0, self.start_output)
+        for a in syms:
+            if not a in class_of:
+                return ()
+            i = q * k + class_of[a]
+            (q, out) = (self.transitions[i], self.outputs[i])
+            if q < 0:
+                return ()
+        return out
+
+    def dot_repr(self):
+        """ The DFA in the DOT format of `ragel -V`, whose states are numbered
+        from 1. """
+        def label(syms):
+            ranges = []
+            for a in sorted(syms):
+                if ranges and ranges[-1][1] == a - 1:
+                    ranges[-1][1] = a
+                else:
+                    ranges.append([a, a])
+            return ', '.join(str(lo) if lo == hi else '%d..%d' % (lo, hi)
+                             for (lo, hi) in ranges)
+        by_pair = {}
+        for (src, syms, dst, out) in self.edges():
+            by_pair.setdefault((src, dst, out), []).extend(syms)
+        lines = ['digraph pyretic {', '\trankdir=LR;',
+                 '\tnode [ shape = point ];', '\tENTRY;',
+                 '\tnode [ shape = circle, height = 0.2 ];',
+                 '\tnode [ fixedsize = true, height = 0.65, '
+                 'shape = doublecircle ];']
+        lines += ['\t%d;' % (q + 1) for q in range(self.num_states)
+                  if self.final[q]]
+        lines.append('\tnode [ shape = circle ];')
+        for ((src, dst, out), syms) in sorted(by_pair.items()):
+            acts = (' / ' + ', '.join('_%d' % o for o in out)) if out else ''
+            lines.append('\t%d -> %d [ label = "%s%s" ];' % (
+                src + 1, dst + 1, label(syms), acts))
+        lines.append('\tENTRY -> 1 [ label = "IN" ];')
+        lines.append('}')
+        return '\n'.join(lines) + '\n'
+
+def symbol_classes(table, roots, alphabet):
+    """ Partition the alphabet into classes of symbols belonging to the same
+    symbol sets in the expressions of roots, which they don't tell apart. """
+    sigs = dict((a, []) for a in alphabet)
+    seen = set(roots)
+    todo = list(roots)
+    while todo:
+        n = todo.pop()
+        (kind, args) = table.nodes[n]
+        if kind == RE_SYMBOLS:
+            for a in args:
+                sigs.setdefault(a, []).append(n)
+        elif kind not in [RE_EMPTY, RE_EPSILON]:
+            for m in args:
+                if not m in seen:
+                    seen.add(m)
+                    todo.append(m)
+    classes = {}
+    for a in sorted(sigs):
+        classes.setdefault(tuple(sigs[a]), []).append(a)
+    return sorted(classes.values())
+
+def minimize_dfa(k, transitions, outputs, final):
+    """ Hopcroft's partition refinement on a DFA of states 0.. with k symbol
+    classes. States first split by finality and the outputs of their
+    transitions (-1 transitions go to a dead state of their own). Returns
+    the block of each state. """
+    n = len(final)
+    dead = n
+    block_keys = {}
+    block_of = array('i', [0] * (n + 1))
+    for q in range(n):
+        key = (final[q], tuple(outputs[q * k : (q + 1) * k]))
+        block_of[q] = block_keys.setdefault(key, len(block_keys))
+    block_of[dead] = len(block_keys)
+    blocks = [[] for i in range(len(block_keys) + 1)]
+    for q in range(n + 1):
+        blocks[block_of[q]].append(q)
+    inverse = [dict() for c in range(k)]
+    for q in range(n):
+        for c in range(k):
+            dst = transitions[q * k + c]
+            inverse[c].setdefault(dead if dst < 0 else dst, []).append(q)
+    for c in range(k):
+        inverse[c].setdefault(dead, []).append(dead)
+    work = set((b, c) for b in range(len(blocks)) for c in range(k))
+    while work:
+        (b, c) = work.pop()
+        touched = {}
+        for q in blocks[b]:
+            for p in inverse[c].get(q, []):
+                touched.setdefault(block_of[p], set()).add(p)
+        for (y, xs) in touched.items():
+            if len(xs) == len(blocks[y]):
+                continue
+            z = len(blocks)
+            blocks.append([q for q in blocks[y] if q in xs])
+            blocks[y] = [q for q in blocks[y] if not q in xs]
+            for q in blocks[z]:
+                block_of[q] = z
+            for c2 in range(k):
+                if (y, c2) in work or len(blocks[z]) <= len(blocks[y]):
+                    work.add((z, c2))
+                else:
+                    work.add((y, c2))
+    return block_of
+
+@Stat.elapsed_time
+def make_table_dfa(exps, alphabet):
+    """ Make a minimal DFA from a list of expressions (re_deriv trees or
+    strings of ragel syntax, see re_node_table.from_string) over a list of
+    integer symbols. A transition's outputs are the ordinals of the
+    expressions accepting the strings ending with it, as ragel's finishing
+    actions (`@`) do: states are minimized with respect to them, and states
+    from which nothing is accepted are dropped. """
+    table = re_node_table(alphabet)
+    q0 = tuple((table.from_string(e) if isinstance(e, str) else
+                table.from_re(e)) for e in exps)
+    classes = symbol_classes(table, q0, alphabet)
+    reps = [syms[0] for syms in classes]
+    k = len(classes)
+    accepting = lambda q: tuple(i for (i, r) in enumerate(q)
+                                if table.nullable[r])
+    # explore the states reachable from q0
+    states = [q0]
+    index = {q0 : 0}
+    transitions = array('i')
+    dead = tuple([table.empty] * len(q0))
+    i = 0
+    while i < len(states):
+        q = states[i]
+        for a in reps:
+            dst = tuple(table.deriv(r, a) for r in q)
+            if dst == dead:
+                transitions.append(-1)
+                continue
+            if not dst in index:
+                index[dst] = len(states)
+                states.append(dst)
+            transitions.append(index[dst])
+        i += 1
+    n = len(states)
+    final = [bool(accepting(q)) for q in states]
+    # drop states from which no final state is reachable
+    preds = [[] for q in range(n)]
+    for q in range(n):
+        for c in range(k):
+            if transitions[q * k + c] >= 0:
+                preds[transitions[q * k + c]].append(q)
+    live = [False] * n
+    todo = [q for q in range(n) if final[q]]
+    for q in todo:
+        live[q] = True
+    while todo:
+        for p in preds[todo.pop()]:
+            if not live[p]:
+                live[p] = True
+                todo.append(p)
+    outputs = []
+    for i in range(n * k):
+        if transitions[i] >= 0 and not live[transitions[i]]:
+            transitions[i] = -1
+        outputs.append(accepting(states[transitions[i]])
+                       if transitions[i] >= 0 else ())
+    if not live[0]:
+        return re_table_dfa(classes, 1, array('i', [-1] * k), [()] * k,
+                            [False], ())
+    block_of = minimize_dfa(k, transitions, outputs, final)
+    # number the blocks reachable from the start, with final ones last
+    order = [block_of[0]]
+    rep_of = {block_of[0] : 0}
+    i = 0
+    while i < len(order):
+        q = rep_of[order[i]]
+        for c in range(k):
+            dst = transitions[q * k + c]
+            if dst >= 0 and not block_of[dst] in rep_of:
+                rep_of[block_of[dst]] = dst
+                order.append(block_of[dst])
+        i += 1
+    order = order[:1] + sorted(order[1:], key=lambda b: final[rep_of[b]])
+    number = dict((b, i) for (i, b) in enumerate(order))
+    min_transitions = array('i')
+    min_outputs = []
+    for b in order:
+        q = rep_of[b]
+        for c in range(k):
+            dst = transitions[q * k + c]
+            min_transitions.append(number[block_of[dst]] if dst >= 0 else -1)
+            min_outputs.append(outputs[q * k + c])
+    return re_table_dfa(classes, len(order), min_transitions, min_outputs,
+                        [final[rep_of[b]] for b in order], accepting(q0))
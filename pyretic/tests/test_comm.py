@@ -0,0 +1,113 @@
+
+################################################################################
+# The Pyretic Project                                                          #
+# author: Cole Schlesinger (cschlesi@cs.princeton.edu)                         #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+
+import asynchat
+import asyncore
+import socket
+import threading
+
+from pyretic.backend.comm import *
+
+msg = ['install', {'switch' : 1, 'inport' : 2,
+                   'srcmac' : '\x00\x01\x02\x03\x04\x05'},
+       60000, [{'outport' : 3}], 7, False, 0]
+
+class ReadChannel(MessageChannel, asynchat.async_chat):
+    def __init__(self, sock, framed, map):
+        asynchat.async_chat.__init__(self, sock, map)
+        self.received_data = []
+        self.messages = []
+        self.set_terminator(TERM_CHAR)
+        if framed:
+            self.start_framed_input()
+
+    def collect_incoming_data(self, data):
+        self.received_data.append(data)
+
+    def found_terminator(self):
+        msg = self.read_message()
+        if msg is not NO_MESSAGE:
+            self.messages.append(msg)
+
+def read_back(data, framed):
+    (a, b) = socket.socketpair()
+    m = {}
+    c = ReadChannel(b, framed, m)
+    def send():
+        a.sendall(data)
+        a.close()
+    threading.Thread(target=send).start()
+    while m:
+        asyncore.loop(timeout=0.1, count=1, map=m)
+    return c.messages
+
+packet_in = ['packet', {'switch' : 2**40, 'port' : 3,
+                        'raw' : ''.join(map(chr, range(256))) * 36}, 2**63]
+
+def test_frame_round_trip():
+    data = frame(msg)
+    (length, kind) = FRAME_HEADER.unpack(data[:FRAME_HEADER.size])
+    assert (length, kind) == (len(data) - FRAME_HEADER.size, MESSAGE_FRAME)
+    assert unframe(kind, data[FRAME_HEADER.size:]) == msg
+
+def test_frame_packet():
+    data = frame(packet_in)
+    assert FRAME_HEADER.unpack(data[:FRAME_HEADER.size])[1] == PACKET_FRAME
+    assert data.endswith(packet_in[1]['raw'])
+    assert unframe(PACKET_FRAME, data[FRAME_HEADER.size:]) == packet_in
+    # packet-outs carry no cookie, and headers other than the switch, port
+    # and raw bytes are left out
+    packet_out = dict(packet_in[1], srcmac='\x00\x01\x02\x03\x04\x05')
+    data = frame(['packet', packet_out])
+    assert (unframe(PACKET_FRAME, data[FRAME_HEADER.size:]) ==
+            ['packet', packet_in[1], 0])
+    assert not is_raw_packet(['packet', dict(packet_out, port=-1)])
+
+def test_read_framed():
+    c = MessageChannel()
+    c.framed_out = True
+    assert read_back(c.encode(msg) * 3, True) == [msg] * 3
+
+def test_read_json():
+    c = MessageChannel()
+    assert read_back(c.encode(msg) * 3, False) == [deserialize([serialize(msg)[:-1]])] * 3
+
+def test_encode_batch():
+    msgs = [[i, 'x' * i] for i in range(2 * BATCH_SIZE + 1)]
+    c = MessageChannel()
+    c.framed_out = True
+    batches = read_back(c.encode_batch(msgs), True)
+    assert [len(b[1]) for b in batches] == [BATCH_SIZE, BATCH_SIZE, 1]
+    assert sum([b[1] for b in batches], []) == msgs
+    assert read_back(MessageChannel().encode_batch(msgs[:5]), False) == msgs[:5]
+
+def test_encode_batch_packets():
+    msgs = [msg, packet_in, msg, msg, packet_in]
+    c = MessageChannel()
+    c.framed_out = True
+    assert read_back(c.encode_batch(msgs), True) == [
+        ['batch', [msg]], packet_in, ['batch', [msg, msg]], packet_in]
+    assert read_back(MessageChannel().encode_batch(msgs), False) == msgs
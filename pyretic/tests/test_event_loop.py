@@ -0,0 +1,85 @@
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+import threading
+import time
+
+from pyretic.core.event_loop import EventLoop
+
+def test_call_soon_order():
+    loop = EventLoop('test').start()
+    done = threading.Event()
+    ran = []
+    for i in range(5):
+        loop.call_soon(ran.append, i)
+    loop.call_soon(done.set)
+    assert done.wait(2)
+    assert ran == range(5)
+    loop.stop()
+
+def test_timers():
+    loop = EventLoop('test').start()
+    done = threading.Event()
+    ran = []
+    loop.call_later(0.1, ran.append, 'late')
+    loop.call_later(0.05, ran.append, 'early')
+    loop.call_later(0.01, ran.append, 'cancelled').cancel()
+    ticks = []
+    timer = loop.call_every(0.02, ticks.append, 1)
+    loop.call_later(0.15, done.set)
+    assert done.wait(2)
+    timer.cancel()
+    assert ran == ['early', 'late']
+    assert len(ticks) >= 3
+    n = len(ticks)
+    time.sleep(0.05)
+    assert len(ticks) == n
+    loop.stop()
+
+def test_bounded_queue():
+    loop = EventLoop('test', maxsize=2).start()
+    gate = threading.Event()
+    started = threading.Event()
+    def block():
+        started.set()
+        gate.wait()
+    loop.call_soon(block)
+    assert started.wait(2)
+    assert loop.call_soon(lambda: None)
+    assert loop.call_soon(lambda: None)
+    assert not loop.call_soon(lambda: None)
+    assert loop.dropped == 1
+    gate.set()
+    loop.stop()
+
+def test_failing_callback():
+    loop = EventLoop('test').start()
+    done = threading.Event()
+    loop.call_soon(lambda: 1 / 0)
+    loop.call_soon(done.set)
+    assert done.wait(2)
+    loop.stop()
@@ -0,0 +1,125 @@
+
+################################################################################
+# The Pyretic Project                                                          #
+# author: Cole Schlesinger (cschlesi@cs.princeton.edu)                         #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+
+from pyretic.core.language import *
+from pyretic.core.packet import *
+from pyretic.core.fdd import FDDCompiler, Leaf, Node
+from pyretic.lib.std import *
+
+import random
+from pyretic.evaluations.eval_classifier import (gen_forwarding_policy,
+                                                 gen_packets, fabric_policy)
+
+def packets(macs, num_pkts=300):
+    rnd = random.Random(1)
+    ips = ['10.0.0.1', '10.0.0.11', '10.0.1.5', '10.1.0.1']
+    pkts = []
+    for pkt in gen_packets(num_pkts, macs + [EthAddr('FF:FF:FF:FF:FF:FF')]):
+        pkts.append(pkt.modifymany({'srcip' : rnd.choice(ips),
+                                    'dstip' : rnd.choice(ips),
+                                    'switch' : rnd.randint(1, 3),
+                                    'port' : rnd.randint(1, 5)}))
+    return pkts
+
+class ClassifierPolicy(Policy):
+    """ A policy only known through its classifier, like
+    evaluations/Tests/common_modules/stanford_forwarding.py. """
+    def __init__(self, rules):
+        self.rules = rules
+        self._classifier = None
+
+    def eval(self, pkt):
+        return self.compile().eval(pkt)
+
+    def __eq__(self, other):
+        return id(self) == id(other)
+
+    def compile(self):
+        if not self._classifier:
+            self._classifier = Classifier(self.rules)
+        return self._classifier
+
+def policies():
+    ip1 = IPAddr('10.0.0.1')
+    p = IPAddr('10.0.0.11')
+    mac1 = EthAddr('00:00:00:00:00:01')
+    macB = EthAddr('FF:FF:FF:FF:FF:FF')
+    (fwds, macs) = gen_forwarding_policy(30)
+    pols = [
+        if_(match(srcip=ip1), modify(srcip=p),
+            if_(match(dstip=p), modify(dstip=ip1))) >>
+        ((match(dstmac=mac1) | match(dstmac=macB)) >> fwd(1)),
+        if_(match(port=2), fwd(1), match(port=4) >> fwd(2)),
+        match(port=1) >> match(switch=2) >> fwd(3),
+        xfwd(1) + xfwd(2) + xfwd(3),
+        fwds,
+        match(dstip='10.0.0.0/24') >> modify(dstip='10.1.0.1') >>
+        if_(match(dstip='10.1.0.0/16'), fwd(1), fwd(2)),
+        (match(srcip='10.0.0.0/16') | match(port=3)) >>
+        ~match(dstip='10.0.1.0/24') >> xfwd(4),
+        if_(match(switch=1), fwd(2) + (match(port=2) >> fwd(3)), drop) >>
+        if_(match(port=3), modify(srcip='10.0.0.11'), identity),
+        fabric_policy(80, num_switches=3, num_ports=5),
+        ClassifierPolicy([
+            Rule(match(switch=1, dstip='10.0.0.11'), {modify(port=1)}),
+            Rule(match(switch=1, dstip='10.0.0.0/24'), {modify(port=2)}),
+            Rule(match(dstip='10.0.0.0/16'), {modify(port=3)}),
+            Rule(match(port=2), {identity}),
+            Rule(identity, set())]) >> fwds]
+    return (pols, macs)
+
+def test_fdd_compile_eval():
+    (pols, macs) = policies()
+    for pol in pols:
+        c = pol.fdd_compile(force_compile=True)[0]
+        for pkt in packets(macs):
+            assert c.eval(pkt) == pol.eval(pkt)
+
+def test_fdd_compile_size():
+    (fwds, macs) = gen_forwarding_policy(100)
+    for pol in [fwds, fabric_policy(400)]:
+        assert (len(pol.fdd_compile(force_compile=True)[0]) <=
+                len(pol.generate_classifier()))
+
+def test_fdd_compile_queries():
+    q = FwdBucket()
+    pol = (match(port=1) >> q) + fwd(2)
+    c = pol.fdd_compile()[0]
+    assert list(c.rules)[0].match == match(port=1)
+    assert Controller in list(c.rules)[0].actions
+    assert not Controller in list(c.rules)[1].actions
+
+def test_fdd_hash_consing():
+    comp = FDDCompiler()
+    d1 = comp.translate(match(switch=1, port=2) | match(switch=2))
+    d2 = comp.translate(match(switch=2) | (match(port=2) & match(switch=1)))
+    assert d1 is d2
+    assert comp.translate(match(port=2) | ~match(port=2)) is comp.id
+    assert comp.translate(match(port=2) & ~match(port=2)) is comp.drop
+    assert (comp.translate(match(dstip='10.0.0.0/8') |
+                           match(dstip='10.1.0.0/16')) is
+            comp.translate(match(dstip='10.0.0.0/8')))
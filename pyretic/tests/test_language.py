@@ -33,6 +33,7 @@ from pyretic.core.language import *
 from pyretic.core.packet import *
 from pyretic.lib.std import *
 
+import copy
 import pytest
 
 ### Equality tests ###
@@ -77,6 +78,47 @@ def test_covers_2():
 def test_covers_3():
     assert not match(inport=1).covers(identity)
 
+def test_match_interning():
+    m = match(switch=1, dstip='10.0.0.0/24')
+    assert m is match(dstip='10.0.0.0/24', switch=1)
+    assert m is not match(switch=1, dstip='10.0.0.1/24')
+    assert match(port=1) is not match(port=True)
+    m_copy = copy.copy(m)
+    assert m_copy is not m and m_copy == m
+
+def test_match_memo():
+    import pyretic.core.language as lang
+    m1 = match(switch=1)
+    m2 = match(port=2)
+    hits = lang._intersect_memo.hits
+    assert m1.intersect(m2) is m1.intersect(m2)
+    assert lang._intersect_memo.hits == hits + 1
+    m3 = match(switch=1, port=2)
+    hits = lang._covers_memo.hits
+    assert m1.covers(m3)
+    assert m1.covers(m3)
+    assert lang._covers_memo.hits == hits + 1
+
+def test_lru_cache_threads():
+    import threading
+    from pyretic.core.util import LRUCache
+    cache = LRUCache(64)
+    errors = []
+    def work(n):
+        try:
+            for i in range(5000):
+                cache.put((n, i), i)
+                cache.get((n, i - 1))
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=work, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+    assert len(cache) <= 64
+
 # TODO check this test
 def test_most_specific_prefix_matching():
     c1 = if_(
@@ -220,6 +262,37 @@ def test_sequencing_match_match():
 def test_empty_parallel_composition():
     assert parallel() == drop
 
+def test_parallel_partitioned_order():
+    c1 = Classifier([
+        Rule(match(switch=1, dstip='10.0.0.0/24'), {modify(port=1)}),
+        Rule(match(switch=2), {modify(port=2)}),
+        Rule(identity, set()) ])
+    c2 = Classifier([
+        Rule(match(switch=2, port=3), {modify(port=4)}),
+        Rule(match(port=1), {modify(port=5)}),
+        Rule(match(switch=1, dstip='10.0.0.1'), {modify(port=6)}),
+        Rule(identity, set()) ])
+    c3 = c1 + c2
+    assert [(r.match, set(a.map['port'] for a in r.actions))
+            for r in c3.rules] == [
+        (match(switch=1, dstip='10.0.0.0/24', port=1), {1, 5}),
+        (match(switch=1, dstip='10.0.0.1'), {1, 6}),
+        (match(switch=1, dstip='10.0.0.0/24'), {1}),
+        (match(switch=2, port=3), {2, 4}),
+        (match(switch=2, port=1), {2, 5}),
+        (match(switch=2), {2}),
+        (match(port=1), {5}),
+        (identity, set()) ]
+
+def test_parallel_partitioned_generated():
+    from pyretic.evaluations.eval_classifier import (gen_mac_classifier,
+                                                     gen_classifier,
+                                                     naive_parallel)
+    c1 = gen_mac_classifier(100, seed=1)
+    c2 = gen_classifier(100, seed=2)
+    assert c1 + c2 == naive_parallel(c1, c2)
+    assert c2 + c1 == naive_parallel(c2, c1)
+
 
 # Intersection
 
@@ -473,6 +546,15 @@ def test_flood_compilation():
         Rule(match(switch='s1'), [modify(outport=1), modify(outport=2)]),
         Rule(identity, [drop]) ]
 
+def test_lazy_leaf_classifiers():
+    m = match(switch=7, port=3)
+    a = modify(port=4)
+    assert '_lazy_classifier' not in m.__dict__
+    assert '_lazy_classifier' not in a.__dict__
+    assert m.compile().rules[0] == Rule(m, [identity])
+    assert a.compile().rules[0] == Rule(identity, [a])
+    assert m.compile() is m.compile()
+
 # Optimization
 
 def test_remove_shadow_cover_single():
@@ -490,3 +572,159 @@ def test_optimize_bug_1():
     print 'classifier.optimize():'
     print classifier.optimize()
     assert classifier == classifier.optimize()
+
+def _naive_remove_shadowed_cover_single(c):
+    opt_c = Classifier()
+    for r in c.rules:
+        if not reduce(lambda acc, new_r: acc or
+                      new_r.match.covers(r.match),
+                      opt_c.rules,
+                      False):
+            opt_c.rules.append(r)
+    return opt_c
+
+def test_remove_shadow_cover_prefix():
+    c = Classifier([
+        Rule(match(switch=1, dstip='10.0.0.0/16'), [modify(port=1)]),
+        Rule(match(switch=1, dstip='10.0.1.0/24'), [modify(port=2)]),
+        Rule(match(switch=1, dstip='10.1.0.0/24'), [modify(port=2)]),
+        Rule(match(switch=2, dstip='10.0.1.0/24'), [modify(port=3)]),
+        Rule(match(switch=1, port=2, dstip='10.0.1.1'), [modify(port=4)]),
+        Rule(match(switch=1), [drop]),
+        Rule(match(switch=1, port=2), [drop]),
+        Rule(identity, [drop]),
+        Rule(match(switch=3), [drop]) ])
+    c = c.remove_shadowed_cover_single()
+    assert list(c.rules) == [
+        Rule(match(switch=1, dstip='10.0.0.0/16'), [modify(port=1)]),
+        Rule(match(switch=1, dstip='10.1.0.0/24'), [modify(port=2)]),
+        Rule(match(switch=2, dstip='10.0.1.0/24'), [modify(port=3)]),
+        Rule(match(switch=1), [drop]),
+        Rule(identity, [drop]) ]
+
+def test_remove_shadow_cover_generated():
+    from pyretic.evaluations.eval_classifier import gen_classifier
+    for seed in range(3):
+        c = gen_classifier(300, seed)
+        assert (c.remove_shadowed_cover_single() ==
+                _naive_remove_shadowed_cover_single(c))
+
+# Decision tree evaluation
+
+def test_decision_tree_eval():
+    from pyretic.core.classifier import DecisionTree
+    from pyretic.evaluations.eval_classifier import (gen_forwarding_policy,
+                                                     gen_packets)
+    (fwds, macs) = gen_forwarding_policy(40)
+    policies = [fwds,
+                if_(match(port=2), fwd(1), match(port=4) >> fwd(2)),
+                match(dstmac=macs[0]) >> modify(dstip='10.0.0.3') >> fwd(3),
+                ~match(switch=1, port=1) >> xfwd(2)]
+    for pol in policies:
+        tree = DecisionTree(pol.compile().rules, leaf_size=1)
+        for pkt in gen_packets(500, macs):
+            assert tree.eval(pkt) == pol.eval(pkt)
+
+def test_decision_tree_query():
+    from pyretic.core.classifier import DecisionTree
+    q = FwdBucket()
+    pol = (match(port=1) >> q) + fwd(2)
+    tree = DecisionTree(pol.compile().rules)
+    pkt = Packet({'switch' : 1, 'port' : 1, 'ethtype' : IP_TYPE})
+    assert tree.eval(pkt) is None
+    pkt = pkt.modify(port=3)
+    assert tree.eval(pkt) == pol.eval(pkt)
+
+# Compilation cache
+
+def test_compile_cache_structural():
+    from pyretic.core import language
+    def build(port):
+        return if_(match(dstmac=EthAddr('00:00:00:00:00:01')), fwd(port),
+                   match(switch=1) >> fwd(2))
+    p1 = build(1)
+    c1 = p1.compile()
+    assert build(1).compile() is c1
+    assert build(3).compile() is not c1
+    assert build(3).compile() == Classifier(
+        [Rule(match(dstmac=EthAddr('00:00:00:00:00:01')), [modify(port=3)]),
+         Rule(match(switch=1), [modify(port=2)]),
+         Rule(identity, set())])
+    language.COMPILE_CACHE = False
+    try:
+        assert build(1).compile() is not c1
+    finally:
+        language.COMPILE_CACHE = True
+
+def test_compile_cache_keys():
+    from pyretic.core.language import structural_key
+    assert structural_key(match(port=1) + fwd(2)) is structural_key(
+        match(port=1) + fwd(2))
+    assert structural_key(match(port=1) + fwd(2)) is not structural_key(
+        fwd(2) + match(port=1))
+    assert structural_key(modify(dstip='10.0.0.1')) is not structural_key(
+        modify(dstip=IPAddr('10.0.0.1')))
+    # queries are only ever equal to themselves
+    q = FwdBucket()
+    assert structural_key(match(port=1) >> q) is structural_key(
+        match(port=1) >> q)
+    assert structural_key(match(port=1) >> q) is not structural_key(
+        match(port=1) >> FwdBucket())
+
+def test_compile_cache_dynamic():
+    d = DynamicPolicy(fwd(1))
+    pol = match(switch=1) >> d
+    assert pol.compile() == (match(switch=1) >> fwd(1)).compile()
+    d.policy = fwd(2)
+    pol.invalidate_classifier()
+    assert pol.compile() == (match(switch=1) >> fwd(2)).compile()
+
+def test_compile_cache_prefix():
+    from pyretic.core import language
+    done = []
+    for i in range(5):
+        done.append(match(srcmac=EthAddr('00:00:00:00:00:0%d' % i), port=i))
+        c = (~union(done)).compile()
+    language.COMPILE_CACHE = False
+    try:
+        assert c == (~union(list(done))).compile()
+    finally:
+        language.COMPILE_CACHE = True
+
+def test_if_compilation_prepend():
+    from pyretic.evaluations.eval_classifier import gen_packets
+    macs = [EthAddr('00:00:00:00:00:0%d' % i) for i in range(1, 8)]
+    chain = fwd(1)
+    for (i, mac) in enumerate(macs):
+        chain = if_(match(dstmac=mac, switch=i % 2), fwd(i + 2), chain)
+    policies = [chain,
+                if_(match(switch=1), modify(port=3) >> (match(port=3) >> fwd(2)),
+                    if_(match(switch=1, port=2), fwd(1), drop)),
+                if_(match(dstip='10.0.0.0/8'),
+                    if_(match(dstip='10.1.0.0/16'), fwd(2), fwd(3)), fwd(4))]
+    for pol in policies:
+        c = pol.compile()
+        assert list(c.rules) == list(pol.policy.generate_classifier().rules)
+        for pkt in gen_packets(200, macs):
+            assert c.eval(pkt) == pol.eval(pkt)
+
+def test_if_compilation_derivation():
+    from pyretic.core.classifier import (get_rule_derivation_leaves,
+                                         get_rule_derivation_tree)
+    pol = if_(match(switch=1), fwd(2), fwd(3))
+    r = pol.compile().rules[0]
+    assert r.match == match(switch=1)
+    leaves = get_rule_derivation_leaves(r)
+    assert match(switch=1) in leaves and modify(port=2) in leaves
+    assert 'switch' in get_rule_derivation_tree(r)
+
+def test_policy_snapshot():
+    from pyretic.core.language_tools import policy_snapshot
+    static = if_(match(switch=1), fwd(1), fwd(2))
+    dyn = DynamicPolicy(fwd(3))
+    pol = static + (match(port=1) >> dyn)
+    assert policy_snapshot(static) is static
+    snap = policy_snapshot(pol)
+    assert snap.policies[0] is static
+    dyn.policy = fwd(4)
+    assert snap.compile() == (static + (match(port=1) >> fwd(3))).compile()
@@ -0,0 +1,300 @@
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+import BaseHTTPServer
+import SocketServer
+import json
+import socket
+import threading
+
+import pytest
+
+from pyretic.core.netkat import NetKATConnectionPool, NETKAT_DOM
+from pyretic.core.netkat import NetKATCache, PolicyJSON, blocks
+from pyretic.core.netkat import iter_netkat, iter_switch_tables
+from pyretic.core.language import match, fwd, modify, if_, CountBucket
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Answers compile requests with the server's output (an empty classifier
+    by default), over keep-alive connections unless the server says
+    otherwise. """
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        server.requests.append((self.client_address, body))
+        out = server.out
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(out)))
+        if server.close:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(out)
+
+    def log_message(self, *args):
+        pass
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def process_request(self, request, client_address):
+        self.conns.append(request)
+        SocketServer.ThreadingMixIn.process_request(self, request,
+                                                    client_address)
+
+def stub_server(port=0, close=False, out='[]'):
+    server = StubServer(('localhost', port), StubHandler)
+    server.out = out
+    server.requests = []
+    server.conns = []
+    server.close = close
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
+
+def stop(server):
+    server.shutdown()
+    server.server_close()
+    for conn in server.conns:
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+def post(pool, server, body):
+    return pool.post(server.server_address[1], NETKAT_DOM, body, {})
+
+def test_keep_alive():
+    server = stub_server()
+    pool = NetKATConnectionPool()
+    for i in range(3):
+        (resp, data) = post(pool, server, '{"type": "true"}')
+        assert resp.status == 200
+        assert data == '[]'
+    assert [body for (addr, body) in server.requests] == ['{"type": "true"}'] * 3
+    assert len(set(addr for (addr, body) in server.requests)) == 1
+    pool.close()
+    stop(server)
+
+def test_server_closes():
+    server = stub_server(close=True)
+    pool = NetKATConnectionPool()
+    for i in range(2):
+        post(pool, server, '')
+    assert len(set(addr for (addr, body) in server.requests)) == 2
+    stop(server)
+
+def test_reconnect():
+    server = stub_server()
+    port = server.server_address[1]
+    pool = NetKATConnectionPool(retries=0)
+    post(pool, server, '')
+    # the idle connection dies with the server
+    stop(server)
+    server = stub_server(port)
+    post(pool, server, '')
+    assert len(server.requests) == 1
+    stop(server)
+
+def test_retries():
+    server = stub_server()
+    port = server.server_address[1]
+    stop(server)
+    pool = NetKATConnectionPool(retries=2, backoff=0.01)
+    with pytest.raises(RuntimeError):
+        pool.post(port, NETKAT_DOM, '', {})
+    # the server comes up while the pool backs off
+    servers = []
+    t = threading.Timer(0.1, lambda: servers.append(stub_server(port)))
+    t.start()
+    pool = NetKATConnectionPool(retries=5, backoff=0.05)
+    (resp, data) = pool.post(port, NETKAT_DOM, '', {})
+    assert data == '[]'
+    stop(servers[0])
+
+def test_streaming_post():
+    server = stub_server()
+    pool = NetKATConnectionPool()
+    body = ['{"type": ', '"true"}']
+    (resp, data) = pool.post(server.server_address[1], NETKAT_DOM, body,
+                             {'Content-Length' : '16'})
+    assert data == '[]'
+    assert server.requests[0][1] == '{"type": "true"}'
+    stop(server)
+
+def test_iter_netkat():
+    filter_sw = {"type": "filter",
+                 "pred": {"type": "and", "preds": [
+                     {"type": "test", "header": "switch", "value": 1}]}}
+    fwd_2 = {"type": "mod", "header": "location",
+             "value": {"type": "physical", "port": 2}}
+    def netkat(pol):
+        return json.loads(''.join(iter_netkat(pol, {})))
+    assert netkat(match(switch=1)) == filter_sw
+    assert netkat(fwd(2)) == fwd_2
+    assert netkat(match(switch=1) >> fwd(2)) == {"type": "seq",
+                                                 "pols": [filter_sw, fwd_2]}
+    assert netkat(match(switch=1) + fwd(2)) == {"type": "union",
+                                                "pols": [filter_sw, fwd_2]}
+    neg_sw = {"type": "filter",
+              "pred": {"type": "neg", "pred": filter_sw["pred"]}}
+    assert netkat(if_(match(switch=1), fwd(2), fwd(3))) == {
+        "type": "union", "pols": [
+            {"type": "seq", "pols": [filter_sw, fwd_2]},
+            {"type": "seq", "pols": [neg_sw, netkat(fwd(3))]}]}
+
+def test_policy_json():
+    (b1, b2, b3, b4) = [CountBucket() for i in range(4)]
+    j1 = PolicyJSON((match(switch=1) >> b1) + (match(switch=2) >> b2))
+    j2 = PolicyJSON((match(switch=1) >> b3) + (match(switch=2) >> b4))
+    assert str(j1) == str(j2)
+    assert j1.digest == j2.digest
+    assert j1.length == len(str(j1))
+    assert j1.names == {str(id(b1)) : 'q0', str(id(b2)) : 'q1'}
+    assert j2.names == {str(id(b3)) : 'q0', str(id(b4)) : 'q1'}
+    j3 = PolicyJSON((match(switch=1) >> b3) + (match(switch=3) >> b4))
+    assert j3.digest != j1.digest
+    assert list(blocks(['ab', 'c', 'de', 'f'], 3)) == ['abc', 'def']
+
+def test_iter_switch_tables():
+    tables = [{"switch_id": i, "tbl": [{"pattern": [], "action": [[]]}] * i}
+              for i in range(1, 6)]
+    text = json.dumps(tables)
+    for n in [1, 2, 7, 64, len(text)]:
+        chunks = [text[i:i+n] for i in range(0, len(text), n)]
+        assert list(iter_switch_tables(chunks)) == tables
+    assert list(iter_switch_tables(['[]'])) == []
+    with pytest.raises(ValueError):
+        list(iter_switch_tables([text[:-5]]))
+
+def test_cache(tmpdir):
+    key = NetKATCache.key('{"type": "true"}', 2, False)
+    assert key != NetKATCache.key('{"type": "true"}', 3, False)
+    assert key != NetKATCache.key('{"type": "true"}', 2, True)
+    cache = NetKATCache(directory=str(tmpdir.join('netkat')))
+    assert cache.get(key) is None
+    cache.put(key, '[]')
+    assert cache.get(key) == '[]'
+    # a restarted controller finds the output on disk
+    cache = NetKATCache(directory=str(tmpdir.join('netkat')))
+    assert cache.get(key) == '[]'
+    assert cache.get(key) == '[]'
+    assert cache.stats() == {'hits' : 1, 'misses' : 1, 'size' : 1,
+                             'disk hits' : 1}
+    assert NetKATCache().get(key) is None
+
+def test_generate_classifier():
+    from pyretic.core.netkat import netkat_backend
+    server = stub_server()
+    netkat_backend.cache.clear()
+    def compile(pol):
+        return netkat_backend.generate_classifier(
+            pol, 1, False, server_port=server.server_address[1])
+    (classifier, ctime) = compile(match(switch=1) >> CountBucket())
+    assert len(classifier.rules) == 0
+    assert '"name": "q0"' in server.requests[0][1]
+    # the same policy over another bucket is served from the cache
+    (classifier, ctime) = compile(match(switch=1) >> CountBucket())
+    assert ctime == '0'
+    assert len(server.requests) == 1
+    netkat_backend.cache.clear()
+    stop(server)
+
+def test_workers():
+    from pyretic.core.netkat import NetKATWorkers
+    workers = NetKATWorkers(workers=3, ports=[1, 2])
+    threads = set()
+    def square(x, port):
+        threads.add(threading.current_thread())
+        assert port in [1, 2]
+        return x * x
+    assert workers.map(square, range(20)) == [x * x for x in range(20)]
+    assert threading.current_thread() not in threads
+    # calls from a worker run in that worker
+    def nested(x, port):
+        return workers.map(lambda y, p: (y, p), [x, x + 1])
+    assert [len(set(p for (y, p) in res)) for res in
+            workers.map(nested, range(6))] == [1] * 6
+    def fail(x, port):
+        if x % 4 == 3:
+            raise ValueError(x)
+        return x
+    with pytest.raises(ValueError) as e:
+        workers.map(fail, range(10))
+    assert e.value.args == (3,)
+
+def test_query_switch():
+    from pyretic.core.netkat import netkat_backend
+    from pyretic.lib.path import QuerySwitch
+    server = stub_server()
+    netkat_backend.cache.clear()
+    ports = netkat_backend.workers.ports
+    netkat_backend.workers.ports = [server.server_address[1]]
+    policy_dic = dict((i, match(switch=i) >> fwd(i)) for i in range(1, 9))
+    (classifier, ctime) = QuerySwitch('switch', policy_dic, set([fwd(1)])
+                                      ).netkat_compile(switch_cnt=1)
+    assert len(server.requests) == 8
+    assert len(classifier.rules) == 1
+    netkat_backend.workers.ports = ports
+    netkat_backend.cache.clear()
+    stop(server)
+
+def test_query_switch_shared_caches():
+    from pyretic.core import language
+    from pyretic.core.netkat import netkat_backend, NetKATWorkers
+    from pyretic.lib.path import QuerySwitch
+    tables = [{"switch_id": 1,
+               "tbl": [{"priority": 100, "pattern": {"inPort": p},
+                        "action": [[]]} for p in range(1, 41)]}]
+    server = stub_server(out=json.dumps(tables))
+    port = server.server_address[1]
+    workers = netkat_backend.workers
+    memo_size = language._intersect_memo.maxsize
+    # evict while the states are compiled
+    language._intersect_memo.maxsize = 16
+    def compile(n):
+        netkat_backend.workers = NetKATWorkers(workers=n, ports=[port])
+        netkat_backend.cache.clear()
+        language.clear_compile_cache()
+        # states share policies (and classifiers) three by three
+        policy_dic = dict((i, match(switch=1, srcport=i % 3) >> fwd(i % 3))
+                          for i in range(1, 25))
+        return QuerySwitch('dstport', policy_dic, set([fwd(1)])
+                           ).netkat_compile(switch_cnt=1)[0]
+    try:
+        expected = list(compile(1).rules)
+        assert len(expected) == 24 * 40 + 1
+        for i in range(5):
+            assert list(compile(6).rules) == expected
+    finally:
+        language._intersect_memo.maxsize = memo_size
+        netkat_backend.workers = workers
+        netkat_backend.cache.clear()
+        stop(server)
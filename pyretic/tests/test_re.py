@@ -544,6 +544,48 @@ def test_dot_vector():
         f.close()
         # output = subprocess.check_output(['dot', '-Tx11', fname])
 
+def test_table_dfa():
+    import itertools
+    a = re_symbol(1)
+    b = re_symbol(2)
+    c = re_symbol(3)
+    d = re_symbol(4)
+    exps = [(a ^ b) | (a ^ c),
+            (+a) | (b ^ c),
+            (+a) & ~(a ^ a ^ a),
+            (+c ^ a ^ b ^ a) | (c ^ d ^ b ^ a)]
+    symbol_list = [1, 2, 3, 4]
+    dfa = make_table_dfa(exps, symbol_list)
+    # the same DFA from the expressions in ragel syntax
+    dfa_str = make_table_dfa([e.re_string_repr() for e in exps], symbol_list)
+    assert dfa.num_states == dfa_str.num_states
+    for n in range(6):
+        for s in itertools.product(symbol_list, repeat=n):
+            ords = tuple(i for (i, e) in enumerate(exps) if
+                         nullable(reduce(lambda r, x: deriv(r, re_symbol(x)),
+                                         s, e)) == re_epsilon())
+            assert dfa.accepting_exps(s) == ords
+            assert dfa_str.accepting_exps(s) == ords
+    # symbols told apart by no expression share transitions
+    assert len(make_table_dfa([(a | b) ^ c], [1, 2, 3, 4]).classes) == 3
+    # minimal: a* and a*.a* are the same
+    assert make_table_dfa([+a ^ +a], [1]).num_states == 1
+    assert make_table_dfa([a & b], [1, 2]).num_states == 1
+
+def test_table_dfa_dot():
+    from pyretic.lib.path import ragel_dfa_utils as du
+    a = re_symbol(1)
+    b = re_symbol(2)
+    c = re_symbol(3)
+    dfa = make_table_dfa([(a ^ b) | (a ^ c), +a ^ c, b ^ +c],
+                         [1, 2, 3])
+    output = dfa.dot_repr()
+    (accepting, state_num, edges, ords) = du.get_table_edges(dfa)
+    assert du.get_accepting_states(output) == (accepting, state_num)
+    assert sorted(du.get_extended_edges(output)[0]) == sorted(edges)
+    assert du.get_extended_edges(output)[1] == ords
+    assert [ords[e] for e in edges if e[:2] == (None, 2)] == [[2]]
+
 # Just in case: keep these here to run unit tests in vanilla python
 if __name__ == "__main__":
     test_normal_forms()
@@ -558,6 +600,8 @@ if __name__ == "__main__":
     test_dfa_metadata()
     test_dfa_vector()
     test_dot_vector()
+    test_table_dfa()
+    test_table_dfa_dot()
 
     print "If this message is printed without errors before it, we're good."
     print "Also ensure all unit tests are listed above this line in the source."
@@ -0,0 +1,498 @@
+
+################################################################################
+# The Pyretic Project                                                          #
+# author: Cole Schlesinger (cschlesi@cs.princeton.edu)                         #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import pytest
+
+from pyretic.core.runtime import RuleStore, PriorityAllocator
+from pyretic.core.runtime import InstallBatch, InstallScheduler, UpdateQueue
+from pyretic.core.runtime import PacketAdmission, packet_flow_key
+from pyretic.core.runtime import microflow_transforms, wildcard_region
+from pyretic.core.runtime import version_tag, consistent_update_phases
+from pyretic.core.packet import Packet
+from pyretic.core.language import *
+from pyretic.core.classifier import DecisionTree
+
+class StoredRule(object):
+    def __init__(self, mat, priority):
+        self.mat = mat
+        self.priority = priority
+
+def test_rule_store():
+    rules = [StoredRule({'switch' : s, 'port' : p}, 60000 - p)
+             for s in range(1, 4) for p in range(1, 5)]
+    store = RuleStore(rules)
+    assert len(store) == 12
+    assert list(store) == rules
+    r = rules[5]
+    assert store.find(StoredRule(dict(r.mat), r.priority)) is r
+    assert store.find(StoredRule(dict(r.mat), r.priority - 1)) is None
+    assert store.find(StoredRule({'switch' : 9, 'port' : 1}, 59999)) is None
+    store.remove(r)
+    assert store.find(r) is None
+    assert len(store) == 11
+    store.add(r)
+    assert store.find(r) is r
+
+def test_rule_store_unhashable():
+    r = StoredRule({'switch' : 1, 'port' : [1, 2]}, 10)
+    store = RuleStore([r, StoredRule({'switch' : 1}, 9)])
+    assert store.find(StoredRule({'switch' : 1, 'port' : [1, 2]}, 10)) is r
+    store.remove(r)
+    assert len(store) == 1
+
+def check_priorities(prios, low, high):
+    assert all(low <= p <= high for p in prios)
+    assert all(p1 > p2 for (p1, p2) in zip(prios, prios[1:]))
+
+def test_priority_allocator_stable():
+    a = PriorityAllocator(1, 1000)
+    keys = range(10)
+    prios = dict(zip(keys, a.allocate(keys)))
+    check_priorities([prios[k] for k in keys], 1, 1000)
+    # insertions and a deletion keep the other rules' priorities
+    keys = ['a'] + keys[:4] + ['b'] + keys[5:] + ['c']
+    new_prios = a.allocate(keys)
+    check_priorities(new_prios, 1, 1000)
+    for (k, p) in zip(keys, new_prios):
+        if not k in ['a', 'b', 'c']:
+            assert prios[k] == p
+    # a moved rule gets a new priority
+    prios = dict(zip(keys, new_prios))
+    keys = keys[1:5] + keys[:1] + keys[5:]
+    new_prios = a.allocate(keys)
+    check_priorities(new_prios, 1, 1000)
+    assert sum(1 for (k, p) in zip(keys, new_prios) if prios[k] != p) == 1
+    assert a.rebalances == 0
+
+def test_priority_allocator_rebalance():
+    import random
+    rnd = random.Random(0)
+    a = PriorityAllocator(1, 40)
+    keys = range(10)
+    for i in range(200):
+        keys.insert(rnd.randint(0, len(keys)), 'new%d' % i)
+        if len(keys) > 30:
+            keys.pop(rnd.randrange(len(keys)))
+        check_priorities(a.allocate(keys), 1, 40)
+    assert a.rebalances > 0
+    keys = [None, None] + keys
+    check_priorities(a.allocate(keys), 1, 40)
+
+def flow(switch, port, priority=100, notify=False, table_id=0):
+    return ({'switch' : switch, 'port' : port}, priority, [{'port' : 1}], 0,
+            notify, table_id)
+
+def test_install_batch_coalesce():
+    (r1, r2, r3) = (flow(1, 1), flow(1, 2), flow(1, 3, notify=True))
+    b = InstallBatch()
+    b.add(('delete', r1))
+    b.add(('install', r1))
+    b.add(('install', r2))
+    b.add(('install', r3))
+    # a later update of the same rules
+    r1b = flow(1, 1)
+    r1b[2].append({'port' : 2})
+    b.add(('modify', r1b))
+    b.add(('delete', r2))
+    b.add(('delete', r3))
+    assert list(b) == [('delete', r1), ('install', r3), ('install', r1b),
+                       ('delete', r3)]
+    b.add(('install', flow(1, 4, table_id=1)))
+    b.add(('clear', 0))
+    assert list(b) == [('install', flow(1, 4, table_id=1)), ('clear', 0)]
+
+class FakeBackend(object):
+    def __init__(self, runtime):
+        self.runtime = runtime
+
+    @contextmanager
+    def install_batch(self, switch):
+        self.runtime.sent.append('batch')
+        yield
+
+class FakeRuntime(object):
+    def __init__(self, reply=True, reconcile=False):
+        self.log = logging.getLogger('test_runtime')
+        self.backend = FakeBackend(self)
+        self.reply = reply
+        self.sent = []
+        self.flow_stats = []
+        self.barrier_sent = threading.Event()
+        self.gate = threading.Event()
+        self.gate.set()
+        self.scheduler = InstallScheduler(self, barrier_timeout=0.2,
+                                          reconcile=reconcile)
+
+    def install_rule(self, rule):
+        self.sent.append(('install', rule))
+
+    def modify_rule(self, rule):
+        self.sent.append(('modify', rule))
+
+    def delete_rule(self, rule):
+        self.sent.append(('delete', rule))
+
+    def send_clear(self, switch, table_id):
+        self.sent.append(('clear', switch))
+
+    def install_defaults(self, switch, table_id):
+        pass
+
+    def default_rules(self, switch, table_id):
+        return []
+
+    def request_flow_stats(self, switch):
+        def reply():
+            self.scheduler.flow_stats_reply(switch, self.flow_stats)
+        threading.Thread(target=reply).start()
+
+    def send_barrier(self, switch, xid=None):
+        if xid is not None:
+            self.sent.append(('barrier', switch))
+            self.barrier_sent.set()
+            if self.reply:
+                def reply():
+                    self.gate.wait()
+                    self.scheduler.barrier_reply(switch, xid)
+                threading.Thread(target=reply).start()
+
+def test_install_scheduler():
+    rt = FakeRuntime()
+    f = rt.scheduler.submit({1 : [('install', flow(1, 1))],
+                             2 : [('install', flow(2, 1))], 3 : []})
+    assert f.wait(2) and f.ok
+    assert rt.sent.count('batch') == 2
+    assert sorted(op for op in rt.sent if op != 'batch') == [
+        ('barrier', 1), ('barrier', 2),
+        ('install', flow(1, 1)), ('install', flow(2, 1))]
+    # updates queued while a barrier is outstanding are coalesced
+    rt.gate.clear()
+    del rt.sent[:]
+    rt.barrier_sent.clear()
+    f1 = rt.scheduler.submit({1 : [('install', flow(1, 2))]})
+    assert rt.barrier_sent.wait(2)
+    f2 = rt.scheduler.submit({1 : [('install', flow(1, 4))]})
+    f3 = rt.scheduler.submit({1 : [('delete', flow(1, 4))]})
+    f4 = rt.scheduler.submit({1 : [('install', flow(1, 3))]})
+    assert not f1.done()
+    rt.gate.set()
+    assert f4.wait(2) and f2.done() and f3.ok
+    assert rt.sent == ['batch', ('install', flow(1, 2)), ('barrier', 1),
+                       'batch', ('install', flow(1, 3)), ('barrier', 1)]
+
+def test_install_scheduler_switch_part():
+    rt = FakeRuntime()
+    rt.gate.clear()
+    f1 = rt.scheduler.submit({1 : [('install', flow(1, 1))]})
+    f2 = rt.scheduler.submit({1 : [('install', flow(1, 2))],
+                              2 : [('install', flow(2, 2))]})
+    rt.scheduler.switch_part(1)
+    assert f1.wait(2) and not f1.ok
+    rt.gate.set()
+    assert f2.wait(2) and not f2.ok
+
+def test_install_scheduler_no_replies():
+    rt = FakeRuntime(reply=False)
+    f = rt.scheduler.submit({1 : [('install', flow(1, 1))]})
+    assert f.wait(2) and not f.ok
+    assert rt.scheduler.replies_missing
+    f = rt.scheduler.submit({1 : [('install', flow(1, 2))]})
+    assert f.wait(0.1)
+
+def flow_stat(port, output, priority=100):
+    return {'table_id' : 0, 'priority' : priority, 'cookie' : 0,
+            'match' : {'port' : port}, 'actions' : [{'output' : output}]}
+
+def test_install_scheduler_reconcile():
+    rt = FakeRuntime(reconcile=True)
+    (r1, r2, r3) = (flow(1, 1), flow(1, 2), flow(1, 3))
+    rt.scheduler.switch_join(1)
+    # r1 is on the switch (forwarding out of its inport), r2 differs, r3 is
+    # missing and an entry for port 4 is extra
+    rt.flow_stats = [flow_stat(1, 0xfff8), flow_stat(2, 5), flow_stat(4, 1)]
+    f = rt.scheduler.submit({1 : [('install', r1), ('install', r2),
+                                  ('install', r3)]})
+    assert f.wait(2) and f.ok
+    assert rt.sent == ['batch', ('install', r2),
+                       ('delete', ({'port' : 4, 'switch' : 1}, 100)),
+                       ('install', r3), ('barrier', 1)]
+    stats = rt.scheduler.reconcile_stats[1]
+    assert (stats['missing'], stats['extra'], stats['different']) == (1, 1, 1)
+    # operations on a switch which left only update its shadow
+    rt.scheduler.switch_part(1)
+    del rt.sent[:]
+    f = rt.scheduler.submit({1 : [('delete', r3)]})
+    assert f.done() and rt.sent == []
+    rt.scheduler.switch_join(1)
+    rt.flow_stats = [flow_stat(1, 0xfff8), flow_stat(2, 1), flow_stat(3, 1)]
+    f = rt.scheduler.submit({1 : [('install', flow(1, 5))]})
+    assert f.wait(2) and f.ok
+    assert rt.sent == ['batch', ('delete', ({'port' : 3, 'switch' : 1}, 100)),
+                       ('install', flow(1, 5)), ('barrier', 1)]
+
+def test_update_queue():
+    q = UpdateQueue(logging.getLogger('test_runtime'))
+    gate = threading.Event()
+    ran = []
+    def update(name, ok=True):
+        def f():
+            gate.wait()
+            ran.append(name)
+            return ok
+        return f
+    f1 = q.submit(0, update('a'))
+    f2 = q.submit(1, update('b', ok=False))
+    f3 = q.submit(1, update('c'))
+    f4 = q.submit(0, update('d'))
+    gate.set()
+    assert all(f.wait(2) for f in [f1, f2, f3, f4])
+    # 'a' may have started before the others were queued
+    assert ran in [['a', 'c', 'd'], ['c', 'd']]
+    assert f2.ok and f3.ok
+
+def raw_packet(srcport, ethtype='\x08\x00'):
+    eth = '\x00\x00\x00\x00\x00\x02' + '\x00\x00\x00\x00\x00\x01' + ethtype
+    ip = ('\x45\x00\x00\x28\x00\x00\x00\x00\x40\x06\x00\x00' +
+          '\x0a\x00\x00\x01' + '\x0a\x00\x00\x02')
+    tcp = chr(srcport >> 8) + chr(srcport & 0xff) + '\x00\x50' + '\x00' * 16
+    return eth + ip + tcp
+
+def packet_in(switch, srcport, ethtype='\x08\x00'):
+    return {'switch' : switch, 'port' : 1,
+            'raw' : raw_packet(srcport, ethtype)}
+
+def test_packet_flow_key():
+    assert (packet_flow_key(packet_in(1, 1000)) ==
+            packet_flow_key(dict(packet_in(1, 1000),
+                                 raw=raw_packet(1000) + 'payload')))
+    assert packet_flow_key(packet_in(1, 1000)) != packet_flow_key(
+        packet_in(1, 1001))
+    assert packet_flow_key(packet_in(1, 1000)) != packet_flow_key(
+        packet_in(2, 1000))
+
+def test_packet_admission_rate():
+    a = PacketAdmission(rate=0.001, burst=3)
+    assert [a.admit(packet_in(1, p)) for p in range(5)] == [
+        True, True, True, False, False]
+    assert a.admit(packet_in(2, 0))
+    # discovery packets are not rate limited
+    assert a.admit(packet_in(1, 0, ethtype='\x88\xcc'))
+    assert a.dropped[1]['rate limited'] == 2
+    assert a.admitted[1] == 4
+    # no rate limit by default
+    a = PacketAdmission()
+    assert all(a.admit(packet_in(1, p)) for p in range(5000))
+
+def test_packet_admission_coalesce():
+    forwarded = []
+    a = PacketAdmission(coalesce=True, hold=0.05,
+                        forward=lambda p, c, d: forwarded.append((p, c, d)))
+    p = packet_in(1, 1000)
+    assert a.admit(p)
+    held = packet_in(1, 1000)
+    assert not a.admit(held)
+    assert a.admit(packet_in(1, 1001))
+    # in another table
+    assert a.admit(packet_in(1, 1000), cookie=1)
+    assert forwarded == []
+    a.release(p, ['decision'])
+    assert forwarded == [(held, None, ['decision'])]
+    later = packet_in(1, 1000)
+    assert not a.admit(later)
+    assert forwarded[1] == (later, None, ['decision'])
+    time.sleep(0.06)
+    assert a.admit(packet_in(1, 1000))
+    assert not a.admit(packet_in(1, 1000))
+    a.drop(p, 'queue full')
+    assert a.admit(packet_in(1, 1000))
+    # without a decision, later packet-ins are handled again
+    a.release(p, None)
+    assert a.admit(packet_in(1, 1000))
+    assert a.forwarded[1] == 2
+    assert a.dropped[1] == {'queue full' : 2}
+
+def test_coalesced_packet_in_delivery():
+    from pyretic.core.runtime import Runtime
+    rt = Runtime.__new__(Runtime)
+    rt.admission = PacketAdmission(coalesce=True, hold=1,
+                                   forward=rt.forward_packet_in)
+    rt.concrete2pyretic = lambda concrete: Packet(concrete)
+    rt.pyretic2concrete = lambda pkt: dict(pkt.header)
+    sent = []
+    rt.send_packet = sent.append
+    interpreted = []
+    def interpret(concrete, cookie):
+        interpreted.append(concrete)
+        sent.append(dict(concrete, port=2))
+        return [{'port' : 2}]
+    rt.interpret_packet_in = interpret
+    pkts = [dict(packet_in(1, 1000), seq=i) for i in range(4)]
+    assert rt.admission.admit(pkts[0])
+    assert not rt.admission.admit(pkts[1])
+    assert not rt.admission.admit(pkts[2])
+    rt.handle_packet_in(pkts[0], None)
+    assert not rt.admission.admit(pkts[3])
+    assert interpreted == [pkts[0]]
+    # every packet is delivered, as the first one was
+    assert sent == [dict(p, port=2) for p in pkts]
+
+def test_microflow_transforms():
+    pkt = Packet({'switch' : 1, 'port' : 1, 'srcip' : '10.0.0.1',
+                  'vlan_id' : 5})
+    output = {pkt.modify(port=2), pkt.modify(port=3).modify(vlan_id=None),
+              pkt.modify(srcip='10.0.0.2')}
+    transforms = microflow_transforms(pkt, output)
+    assert {pkt.modifymany(t) for t in transforms} == output
+    other = pkt.modify(srcip='10.0.0.9')
+    assert ({other.modifymany(t) for t in transforms} ==
+            {other.modify(port=2), other.modify(port=3).modify(vlan_id=None),
+             other.modify(srcip='10.0.0.2')})
+    assert microflow_transforms(pkt, set()) == []
+
+def test_wildcard_region():
+    pol = if_(match(dstip='10.0.1.0/24'), fwd(2),
+              if_(match(srcmac=EthAddr('00:00:00:00:00:09')), drop, fwd(3)))
+    tree = DecisionTree(pol.compile().rules)
+    def region(dstip, srcmac='00:00:00:00:00:01'):
+        pkt = Packet({'switch' : 1, 'port' : 1, 'ethtype' : IP_TYPE,
+                      'srcmac' : EthAddr(srcmac), 'dstip' : dstip})
+        return wildcard_region(tree.entries, tree.lookup(pkt), pkt)
+    assert region('10.0.1.5') == match(switch=1, dstip='10.0.1.0/24')
+    assert region('10.0.1.6') == region('10.0.1.5')
+    # narrowed to exclude the earlier rules with other actions
+    assert region('10.0.2.5') == match(switch=1, dstip='10.0.2.0/24',
+                                       srcmac=EthAddr('00:00:00:00:00:01'))
+    assert region('10.0.2.5', '00:00:00:00:00:09') == match(
+        switch=1, dstip='10.0.2.0/24', srcmac=EthAddr('00:00:00:00:00:09'))
+
+def test_background_recompile():
+    from pyretic.core.runtime import Runtime
+    rt = Runtime.__new__(Runtime)
+    rt.log = logging.getLogger('test_runtime')
+    rt.policy_lock = threading.RLock()
+    dyn = DynamicPolicy(fwd(1))
+    rt.policy = match(switch=1) >> dyn
+    rt.policy_map = {1 : rt.policy}
+    rt.policy_version = 0
+    rt.mode = 'proactive0'
+    rt.use_nx = False
+    rt.pending_network_update = False
+    rt.in_network_update = False
+    compiling = threading.Event()
+    gate = threading.Event()
+    def generate(policy, policy_map):
+        compiling.set()
+        gate.wait()
+        return [(1, policy.compile())]
+    rt.generate_switch_classifiers = generate
+    installed = []
+    rt.install_switch_classifiers = installed.extend
+    t = threading.Thread(target=rt.background_recompile)
+    t.start()
+    assert compiling.wait(2)
+    # packet-ins can take the lock meanwhile, and updates don't reach the
+    # snapshot being compiled
+    assert rt.policy_lock.acquire(False)
+    dyn.policy = fwd(2)
+    rt.policy_version += 1
+    rt.policy_lock.release()
+    gate.set()
+    t.join(2)
+    assert installed == [(1, (match(switch=1) >> fwd(1)).compile())]
+    assert not rt.policy.has_active_classifier()
+    rt.background_recompile()
+    assert installed[1] == (1, (match(switch=1) >> fwd(2)).compile())
+    assert rt.policy.compile() == installed[1][1]
+
+class TaggedRule(object):
+    def __init__(self, mat, priority, actions):
+        self.mat = mat
+        self.priority = priority
+        self.actions = actions
+        self.version = 1
+        self.cookie = 0
+        self.table_id = 0
+        self.parents = None
+        self.op = 'policy'
+        self.notify = False
+
+def test_version_tag():
+    from pyretic.core.runtime import CONSISTENT_VLAN_TAGS
+    tag = CONSISTENT_VLAN_TAGS[1]
+    rules = [TaggedRule({'switch' : 1}, 60000, [{'port' : 2}, {'port' : 3}]),
+             TaggedRule({'switch' : 1, 'port' : 3}, 59999, [{'port' : 2}])]
+    tagged = version_tag(rules, 1, {1 : set([2])})
+    untag = {'port' : 3, 'vlan_id' : None}
+    stamp = {'port' : 2, 'vlan_id' : tag, 'vlan_pcp' : 0,
+             'vlan_total_stages' : 1}
+    assert [(r.mat, r.priority, r.actions) for r in tagged] == [
+        ({'switch' : 1, 'vlan_id' : 0xffff, 'vlan_total_stages' : 1},
+         30000, [stamp, untag]),
+        ({'switch' : 1, 'vlan_id' : tag, 'vlan_total_stages' : 1},
+         30000, [stamp, untag]),
+        # packets from outside the network only come in untagged
+        ({'switch' : 1, 'port' : 3, 'vlan_id' : 0xffff,
+          'vlan_total_stages' : 1}, 29999, [stamp])]
+    assert rules[0].mat == {'switch' : 1}
+    with pytest.raises(TypeError):
+        version_tag([TaggedRule({'switch' : 1, 'vlan_id' : 5}, 60000, [])],
+                    0, {})
+
+def test_consistent_update_phases():
+    def rule(vlan_id, priority):
+        return ({'switch' : 1, 'vlan_id' : vlan_id}, priority)
+    to_add = [rule(4093, 30000), rule(0xffff, 30000)]
+    to_delete = [rule(4094, 60000), rule(0xffff, 60000)]
+    calls = []
+    acks = []
+    def run(kind, rules, descending):
+        calls.append((kind, [r[0]['vlan_id'] for r in rules]))
+        return acks.pop(0) if acks else True
+    def flip():
+        calls.append('flip')
+    (ok, phases) = consistent_update_phases(run, to_add, to_delete, flip,
+                                            gc_delay=0)
+    assert ok and len(phases) == 3
+    assert calls == [('install', [4093]), 'flip', ('install', [0xffff]),
+                     ('delete', [0xffff]), ('delete', [4094])]
+    # retried until acknowledged
+    calls = []
+    acks = [False, True]
+    assert consistent_update_phases(run, to_add, to_delete, flip,
+                                    gc_delay=0)[0]
+    assert calls[:3] == [('install', [4093]), ('install', [4093]), 'flip']
+    # never acknowledged: the new version is removed, and never stamped
+    calls = []
+    acks = [False] * 3
+    assert consistent_update_phases(run, to_add, to_delete, flip,
+                                    attempts=3, gc_delay=0) == (False, None)
+    assert calls == [('install', [4093])] * 3 + [('delete', [4093])]
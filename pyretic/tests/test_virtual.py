@@ -28,6 +28,7 @@
 
 """ Fresh tests for the overhauled virtual header implementation. """
 from pyretic.core.language import *
+from pyretic.core.language import _match
 from pyretic.core.runtime import virtual_field
 from pyretic.lib.corelib import *
 from pyretic.lib.std import *
@@ -177,6 +178,50 @@ def test_multi_stage_3():
     assert m2['vlan_nbits'] == 3
     success()
 
+def test_redeclare_fields():
+    start_new_test()
+    virtual_field("field2", range(0,10), type="integer", stage=1)
+    m = match(field2=3)
+    internal = _match(field2=3)
+    assert internal.map['vlan_id'] == 3 and internal.map['vlan_offset'] == 0
+    assert vdict(field2=3)['vlan_id'] == 3
+    # a new stage-0 field moves field2 up by 7 bits
+    virtual_field("field1", range(0,100), type="integer", stage=0)
+    assert match(field2=3) is not m
+    for fmap in [_match(field2=3).map, m.internal_match.map,
+                 m.compile().rules[0].match.map, vdict(field2=3)]:
+        assert fmap['vlan_offset'] == 7
+        assert fmap['vlan_id'] == 3 << 7
+    assert internal.map['vlan_offset'] == 0
+    success()
+
+def test_modify_translation_cache():
+    start_new_test()
+    virtual_field("field2", range(0,10), type="integer", stage=1)
+    mod = modify(field2=3)
+    internal = mod.internal_modify
+    assert mod.internal_modify is internal
+    assert internal.map['vlan_id'] == 3
+    virtual_field("field1", range(0,100), type="integer", stage=0)
+    assert mod.internal_modify is not internal
+    assert mod.internal_modify.map['vlan_id'] == 3 << 7
+    success()
+
+def test_if_compilation():
+    start_new_test()
+    virtual_field("vf1", range(0,10), type="integer")
+    def full_if(pred, t_branch, f_branch):
+        return (pred >> t_branch) + (~pred >> f_branch)
+    pol = if_(match(vf1=3), fwd(1),
+              if_(match(vf1=4, switch=1), fwd(2), fwd(3)))
+    full = full_if(match(vf1=3), fwd(1),
+                   full_if(match(vf1=4, switch=1), fwd(2), fwd(3)))
+    rules = list(pol.compile().rules)
+    assert rules == list(full.compile().rules)
+    for r in rules:
+        assert 'vf1' not in getattr(r.match, 'map', {})
+    success()
+
 if __name__ == "__main__":
     test_single_field_1()
     test_single_field_2()
@@ -187,3 +232,6 @@ if __name__ == "__main__":
     test_multi_stage_2()
     test_decode()
     test_multi_stage_3()
+    test_redeclare_fields()
+    test_modify_translation_cache()
+    test_if_compilation()